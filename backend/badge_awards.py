@@ -0,0 +1,109 @@
+"""
+Cấp huy hiệu theo sự kiện ghi (đăng bài, nhận tim, viết comment, lưu pin, kết bạn).
+
+user_stats.bump() gọi award_crossed() ngay sau khi cộng bộ đếm: ngưỡng huy hiệu của
+từng requirement_type lấy từ danh mục cache sẵn (cache.py), sắp xếp tăng dần, nên chỉ cần
+so giá trị cũ/mới của bộ đếm với ngưỡng kế tiếp - thường không vượt ngưỡng nào và
+không tốn truy vấn nào.
+
+Huy hiệu mới cấp nằm trong user_badges với notified_at IS NULL (migrations/005),
+client lấy về qua /badges/check (đánh dấu đã thông báo trong cùng câu lệnh).
+
+Cấp bù cho dữ liệu có sẵn trước khi bật (hoặc sau khi sửa ngưỡng huy hiệu):
+    python badge_awards.py backfill [--user-id N]
+"""
+import argparse
+from bisect import bisect_right
+
+from cache import aget_badge_catalog
+from connection import get_database_connection
+
+# Cột user_stats -> badges.requirement_type tương ứng
+STAT_REQUIREMENT_TYPES = {
+    "post_count": "posts",
+    "reaction_received_count": "reactions",
+    "comment_made_count": "comments",
+    "pin_count": "pins",
+    "friend_count": "friends",
+}
+
+
+def crossed_badge_ids(thresholds, stats_row: dict, deltas: dict) -> list[int]:
+    """badge_id có ngưỡng nằm trong (giá trị cũ, giá trị mới] của các bộ đếm vừa tăng."""
+    badge_ids = []
+    for column, delta in deltas.items():
+        requirement_type = STAT_REQUIREMENT_TYPES.get(column)
+        if delta <= 0 or requirement_type not in thresholds:
+            continue
+        values, ids = thresholds[requirement_type]
+        new_value = stats_row[column]
+        start = bisect_right(values, new_value - delta)
+        end = bisect_right(values, new_value)
+        badge_ids.extend(ids[start:end])
+    return badge_ids
+
+
+async def award_crossed(cur, stats_row: dict | None, deltas: dict) -> list[int]:
+    """Cấp các huy hiệu vừa đạt sau một lần bump(), trả về badge_id được cấp mới."""
+    if not stats_row or not any(delta > 0 for delta in deltas.values()):
+        return []
+    catalog = await aget_badge_catalog(cur)
+    badge_ids = crossed_badge_ids(catalog.thresholds, stats_row, deltas)
+    if not badge_ids:
+        return []
+    await cur.execute(
+        """
+        INSERT INTO user_badges (user_id, badge_id)
+        SELECT %s, unnest(%s::integer[])
+        ON CONFLICT DO NOTHING
+        RETURNING badge_id;
+        """,
+        (stats_row["user_id"], badge_ids)
+    )
+    return [row["badge_id"] for row in await cur.fetchall()]
+
+
+# Lấy badge_id chưa thông báo của 1 user và đánh dấu đã thông báo
+POP_NEWLY_EARNED_SQL = """
+    UPDATE user_badges
+    SET notified_at = now()
+    WHERE user_id = %s AND notified_at IS NULL
+    RETURNING badge_id, earned_at;
+"""
+
+
+def backfill(connection, user_id: int | None = None) -> int:
+    """Cấp mọi huy hiệu user đã đủ điều kiện theo user_stats, trả về số huy hiệu cấp thêm."""
+    user_filter = "" if user_id is None else "AND s.user_id = %(user_id)s"
+    stat_value = "CASE b.requirement_type {} END".format(
+        " ".join(f"WHEN '{t}' THEN s.{c}" for c, t in STAT_REQUIREMENT_TYPES.items())
+    )
+    with connection:
+        with connection.cursor() as cur:
+            cur.execute(
+                f"""
+                INSERT INTO user_badges (user_id, badge_id)
+                SELECT s.user_id, b.badge_id
+                FROM user_stats s
+                JOIN badges b ON {stat_value} >= b.requirement_value
+                WHERE true {user_filter}
+                ON CONFLICT DO NOTHING;
+                """,
+                {"user_id": user_id}
+            )
+            return cur.rowcount
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Cấp huy hiệu theo user_stats")
+    sub = parser.add_subparsers(dest="command", required=True)
+    backfill_parser = sub.add_parser("backfill", help="Cấp bù huy hiệu đã đủ điều kiện")
+    backfill_parser.add_argument("--user-id", type=int, default=None)
+    args = parser.parse_args()
+
+    connection = get_database_connection()
+    try:
+        awarded = backfill(connection, args.user_id)
+        print(f"Đã cấp bù {awarded} huy hiệu")
+    finally:
+        connection.close()
@@ -1,5 +1,8 @@
-from fastapi import APIRouter, HTTPException
-from connection import get_database_connection
+from fastapi import APIRouter, Depends, HTTPException
+from connection import get_db
+import badge_awards
+from cache import get_badge_catalog
+import user_stats
 from pydantic import BaseModel
 from typing import List
 
@@ -8,6 +11,12 @@ router = APIRouter(
     tags=["badges"]
 )
 
+BADGE_DISPLAY_FIELDS = ("badge_id", "name", "description", "icon_name", "tier")
+
+
+def _badge_display(badge: dict) -> dict:
+    return {field: badge[field] for field in BADGE_DISPLAY_FIELDS}
+
 # ==================================================
 #              LẤY TẤT CẢ HUY HIỆU CỦA USER
 # ==================================================
@@ -25,33 +34,27 @@ class BadgeSchema(BaseModel):
     is_earned: bool
 
 @router.post("/user")
-def get_user_badges(body: GetUserBadgesRequest):
+def get_user_badges(body: GetUserBadgesRequest, connection = Depends(get_db)):
     """
     Lấy tất cả huy hiệu và trạng thái của user
+    (danh mục huy hiệu lấy từ cache, DB chỉ đọc user_badges của user)
     """
-    connection = get_database_connection()
-    try:
-        with connection.cursor() as cur:
-            cur.execute(
-                """
-                SELECT 
-                    b.badge_id,
-                    b.name,
-                    b.description,
-                    b.icon_name,
-                    b.tier,
-                    ub.earned_at,
-                    CASE WHEN ub.user_id IS NOT NULL THEN true ELSE false END as is_earned
-                FROM badges b
-                LEFT JOIN user_badges ub ON b.badge_id = ub.badge_id AND ub.user_id = %s
-                ORDER BY b.requirement_type, b.requirement_value;
-                """,
-                (body.user_id,)
-            )
-            badges = cur.fetchall()
-            return badges
-    finally:
-        connection.close()
+    with connection.cursor() as cur:
+        cur.execute(
+            "SELECT badge_id, earned_at FROM user_badges WHERE user_id = %s;",
+            (body.user_id,)
+        )
+        earned_at = {row["badge_id"]: row["earned_at"] for row in cur.fetchall()}
+        catalog = get_badge_catalog(cur, earned_at)
+
+    return [
+        {
+            **_badge_display(badge),
+            "earned_at": earned_at.get(badge["badge_id"]),
+            "is_earned": badge["badge_id"] in earned_at,
+        }
+        for badge in catalog.badges
+    ]
 
 # ==================================================
 #       LẤY HUY HIỆU ĐÃ ĐẠT ĐƯỢC CỦA USER (ĐỂ HIỂN THỊ)
@@ -62,34 +65,28 @@ class GetEarnedBadgesRequest(BaseModel):
     limit: int = 3  # Số lượng huy hiệu hiển thị (mặc định 3)
 
 @router.post("/earned")
-def get_earned_badges(body: GetEarnedBadgesRequest):
+def get_earned_badges(body: GetEarnedBadgesRequest, connection = Depends(get_db)):
     """
     Lấy các huy hiệu user đã đạt được, sắp xếp theo thời gian mới nhất
     """
-    connection = get_database_connection()
-    try:
-        with connection.cursor() as cur:
-            cur.execute(
-                """
-                SELECT 
-                    b.badge_id,
-                    b.name,
-                    b.description,
-                    b.icon_name,
-                    b.tier,
-                    ub.earned_at
-                FROM user_badges ub
-                JOIN badges b ON ub.badge_id = b.badge_id
-                WHERE ub.user_id = %s
-                ORDER BY ub.earned_at DESC
-                LIMIT %s;
-                """,
-                (body.user_id, body.limit)
-            )
-            badges = cur.fetchall()
-            return badges
-    finally:
-        connection.close()
+    with connection.cursor() as cur:
+        cur.execute(
+            """
+            SELECT badge_id, earned_at
+            FROM user_badges
+            WHERE user_id = %s
+            ORDER BY earned_at DESC
+            LIMIT %s;
+            """,
+            (body.user_id, body.limit)
+        )
+        earned = cur.fetchall()
+        catalog = get_badge_catalog(cur, [row["badge_id"] for row in earned])
+
+    return [
+        {**_badge_display(catalog.by_id[row["badge_id"]]), "earned_at": row["earned_at"]}
+        for row in earned
+    ]
 
 # ==================================================
 #       KIỂM TRA VÀ CẤP HUY HIỆU CHO USER
@@ -110,100 +107,34 @@ class CheckBadgesResponse(BaseModel):
     total_badges: int
 
 @router.post("/check")
-def check_and_award_badges(body: CheckAndAwardBadgesRequest):
+def check_and_award_badges(body: CheckAndAwardBadgesRequest, connection = Depends(get_db)):
     """
-    Kiểm tra và tự động cấp huy hiệu cho user dựa trên thành tích
-    Trả về danh sách huy hiệu mới đạt được
+    Trả về các huy hiệu mới đạt được kể từ lần gọi trước.
+    Huy hiệu được cấp ngay khi ghi (badge_awards.py), ở đây chỉ lấy hàng đợi chưa thông báo
     """
-    connection = get_database_connection()
-    newly_earned = []
-
-    try:
-        with connection:
-            with connection.cursor() as cur:
-                # 1. Lấy thống kê của user
-                cur.execute(
-                    """
-                    SELECT 
-                        (SELECT COUNT(*) FROM posts WHERE user_id = %s) as total_posts,
-                        (SELECT COUNT(*) FROM reactions r
-                         JOIN posts p ON r.post_id = p.post_id
-                         WHERE p.user_id = %s) as total_reactions,
-                        (SELECT COUNT(*) FROM comments WHERE user_id = %s) as total_comments,
-                        (SELECT COUNT(*) FROM user_pins WHERE user_id = %s) as total_pins,
-                        (SELECT COUNT(*) FROM friends WHERE user_id = %s) as total_friends;
-                    """,
-                    (body.user_id, body.user_id, body.user_id, body.user_id, body.user_id)
-                )
-                stats = cur.fetchone()
-
-                if not stats:
-                    return CheckBadgesResponse(newly_earned=[], total_badges=0)
-
-                # 2. Lấy tất cả huy hiệu có thể đạt được
-                cur.execute(
-                    """
-                    SELECT badge_id, name, description, icon_name, tier, requirement_type, requirement_value
-                    FROM badges
-                    WHERE badge_id NOT IN (
-                        SELECT badge_id FROM user_badges WHERE user_id = %s
-                    )
-                    ORDER BY requirement_value;
-                    """,
-                    (body.user_id,)
-                )
-                available_badges = cur.fetchall()
-
-                # 3. Kiểm tra từng huy hiệu
-                for badge in available_badges:
-                    requirement_type = badge['requirement_type']
-                    requirement_value = badge['requirement_value']
-
-                    # Map requirement_type với stats
-                    stat_mapping = {
-                        'posts': stats['total_posts'],
-                        'reactions': stats['total_reactions'],
-                        'comments': stats['total_comments'],
-                        'pins': stats['total_pins'],
-                        'friends': stats['total_friends']
-                    }
-
-                    user_value = stat_mapping.get(requirement_type, 0)
-
-                    # Nếu đạt yêu cầu, cấp huy hiệu
-                    if user_value >= requirement_value:
-                        cur.execute(
-                            """
-                            INSERT INTO user_badges (user_id, badge_id)
-                            VALUES (%s, %s)
-                            ON CONFLICT DO NOTHING;
-                            """,
-                            (body.user_id, badge['badge_id'])
-                        )
-
-                        if cur.rowcount > 0:
-                            newly_earned.append(NewlyEarnedBadge(
-                                badge_id=badge['badge_id'],
-                                name=badge['name'],
-                                description=badge['description'],
-                                icon_name=badge['icon_name'],
-                                tier=badge['tier']
-                            ))
-
-                # 4. Đếm tổng số huy hiệu hiện có
-                cur.execute(
-                    "SELECT COUNT(*) as total FROM user_badges WHERE user_id = %s;",
-                    (body.user_id,)
-                )
-                total_badges = cur.fetchone()['total']
+    with connection:
+        with connection.cursor() as cur:
+            # 1. Lấy và đánh dấu đã thông báo các huy hiệu mới
+            cur.execute(badge_awards.POP_NEWLY_EARNED_SQL, (body.user_id,))
+            popped = sorted(cur.fetchall(), key=lambda row: (row["earned_at"], row["badge_id"]))
+            catalog = get_badge_catalog(cur, [row["badge_id"] for row in popped])
+            newly_earned = [
+                NewlyEarnedBadge(**_badge_display(catalog.by_id[row["badge_id"]]))
+                for row in popped
+            ]
+
+            # 2. Đếm tổng số huy hiệu hiện có
+            cur.execute(
+                "SELECT COUNT(*) as total FROM user_badges WHERE user_id = %s;",
+                (body.user_id,)
+            )
+            total_badges = cur.fetchone()['total']
 
-                return CheckBadgesResponse(
-                    newly_earned=newly_earned,
-                    total_badges=total_badges
-                )
+            return CheckBadgesResponse(
+                newly_earned=newly_earned,
+                total_badges=total_badges
+            )
 
-    finally:
-        connection.close()
 
 # ==================================================
 #       LẤY TIẾN TRÌNH ĐẠT HUY HIỆU
@@ -225,77 +156,52 @@ class BadgeProgress(BaseModel):
     is_earned: bool
 
 @router.post("/progress")
-def get_badge_progress(body: GetBadgeProgressRequest):
+def get_badge_progress(body: GetBadgeProgressRequest, connection = Depends(get_db)):
     """
     Lấy tiến trình đạt huy hiệu của user
     """
-    connection = get_database_connection()
-    try:
-        with connection.cursor() as cur:
-            # 1. Lấy thống kê
-            cur.execute(
-                """
-                SELECT 
-                    (SELECT COUNT(*) FROM posts WHERE user_id = %s) as total_posts,
-                    (SELECT COUNT(*) FROM reactions r
-                     JOIN posts p ON r.post_id = p.post_id
-                     WHERE p.user_id = %s) as total_reactions,
-                    (SELECT COUNT(*) FROM comments WHERE user_id = %s) as total_comments,
-                    (SELECT COUNT(*) FROM user_pins WHERE user_id = %s) as total_pins,
-                    (SELECT COUNT(*) FROM friends WHERE user_id = %s) as total_friends;
-                """,
-                (body.user_id, body.user_id, body.user_id, body.user_id, body.user_id)
-            )
-            stats = cur.fetchone()
-
-            # 2. Lấy tất cả huy hiệu
-            cur.execute(
-                """
-                SELECT 
-                    b.badge_id,
-                    b.name,
-                    b.description,
-                    b.icon_name,
-                    b.tier,
-                    b.requirement_type,
-                    b.requirement_value,
-                    CASE WHEN ub.user_id IS NOT NULL THEN true ELSE false END as is_earned
-                FROM badges b
-                LEFT JOIN user_badges ub ON b.badge_id = ub.badge_id AND ub.user_id = %s
-                ORDER BY b.requirement_type, b.requirement_value;
-                """,
-                (body.user_id,)
-            )
-            badges = cur.fetchall()
-
-            # 3. Tính tiến trình
-            stat_mapping = {
-                'posts': stats['total_posts'],
-                'reactions': stats['total_reactions'],
-                'comments': stats['total_comments'],
-                'pins': stats['total_pins'],
-                'friends': stats['total_friends']
-            }
-
-            progress_list = []
-            for badge in badges:
-                current_value = stat_mapping.get(badge['requirement_type'], 0)
-                progress_percentage = min(100.0, (current_value / badge['requirement_value']) * 100)
-
-                progress_list.append(BadgeProgress(
-                    badge_id=badge['badge_id'],
-                    name=badge['name'],
-                    description=badge['description'],
-                    icon_name=badge['icon_name'],
-                    tier=badge['tier'],
-                    requirement_type=badge['requirement_type'],
-                    requirement_value=badge['requirement_value'],
-                    current_value=current_value,
-                    progress_percentage=round(progress_percentage, 1),
-                    is_earned=badge['is_earned']
-                ))
-
-            return progress_list
-
-    finally:
-        connection.close()
\ No newline at end of file
+    with connection.cursor() as cur:
+        # 1. Lấy thống kê
+        cur.execute(
+            f"""
+            SELECT {user_stats.BADGE_STATS_COLUMNS}
+            FROM (SELECT %s::integer AS user_id) u
+            LEFT JOIN user_stats s ON s.user_id = u.user_id;
+            """,
+            (body.user_id,)
+        )
+        stats = cur.fetchone()
+
+        # 2. Huy hiệu user đã có (danh mục huy hiệu lấy từ cache)
+        cur.execute("SELECT badge_id FROM user_badges WHERE user_id = %s;", (body.user_id,))
+        earned_ids = {row["badge_id"] for row in cur.fetchall()}
+        catalog = get_badge_catalog(cur, earned_ids)
+
+        # 3. Tính tiến trình
+        stat_mapping = {
+            'posts': stats['total_posts'],
+            'reactions': stats['total_reactions'],
+            'comments': stats['total_comments'],
+            'pins': stats['total_pins'],
+            'friends': stats['total_friends']
+        }
+
+        progress_list = []
+        for badge in catalog.badges:
+            current_value = stat_mapping.get(badge['requirement_type'], 0)
+            progress_percentage = min(100.0, (current_value / badge['requirement_value']) * 100)
+
+            progress_list.append(BadgeProgress(
+                badge_id=badge['badge_id'],
+                name=badge['name'],
+                description=badge['description'],
+                icon_name=badge['icon_name'],
+                tier=badge['tier'],
+                requirement_type=badge['requirement_type'],
+                requirement_value=badge['requirement_value'],
+                current_value=current_value,
+                progress_percentage=round(progress_percentage, 1),
+                is_earned=badge['badge_id'] in earned_ids
+            ))
+
+        return progress_list
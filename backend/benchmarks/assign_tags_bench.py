@@ -0,0 +1,99 @@
+"""
+So sánh /tag/assign cũ (3-4 câu lệnh cho mỗi tag) với bản set-based (tag.assign_tag_names).
+
+Chạy trên database trong .env, mỗi lần gắn tag nằm trong 1 transaction rồi rollback
+nên không để lại dữ liệu:
+    cd backend && python benchmarks/assign_tags_bench.py --post-id 1 --user-id 1 --tags 10
+"""
+import argparse
+import sys
+from pathlib import Path
+from time import perf_counter
+
+from psycopg2.extras import RealDictCursor
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import cache  # noqa: E402
+from connection import get_database_connection  # noqa: E402
+from tag import assign_tag_names  # noqa: E402
+
+
+class CountingCursor(RealDictCursor):
+    executed = 0
+
+    def execute(self, query, vars=None):
+        CountingCursor.executed += 1
+        return super().execute(query, vars)
+
+
+def assign_per_row(cur, post_id: int, user_id: int, tags_unique):
+    """Cách cũ: từng tag một."""
+    for tag_name in tags_unique:
+        cur.execute(
+            "INSERT INTO tags(name) VALUES (%s) ON CONFLICT (name) DO NOTHING RETURNING tag_id",
+            (tag_name,),
+        )
+        row = cur.fetchone()
+        if row is None:
+            cur.execute("SELECT tag_id FROM tags WHERE name = %s", (tag_name,))
+            row = cur.fetchone()
+        tag_id = row["tag_id"]
+        cur.execute(
+            "INSERT INTO post_tags(post_id, tag_id) VALUES (%s, %s) ON CONFLICT (post_id, tag_id) DO NOTHING",
+            (post_id, tag_id),
+        )
+        cur.execute(
+            """
+            INSERT INTO users_tags(user_id, tag_id, cnt) VALUES (%s, %s, 1)
+            ON CONFLICT (user_id, tag_id) DO UPDATE SET cnt = users_tags.cnt + 1
+            """,
+            (user_id, tag_id),
+        )
+
+
+def run(connection, fn, args, tags, rounds: int) -> tuple[float, float]:
+    """(số câu lệnh trung bình, ms trung bình) cho mỗi lần gắn tag."""
+    CountingCursor.executed = 0
+    started = perf_counter()
+    for _ in range(rounds):
+        with connection.cursor() as cur:
+            fn(cur, args.post_id, args.user_id, tags)
+        connection.rollback()
+    elapsed = perf_counter() - started
+    return CountingCursor.executed / rounds, elapsed * 1000 / rounds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--post-id", type=int, required=True)
+    parser.add_argument("--user-id", type=int, required=True)
+    parser.add_argument("--tags", type=int, default=10, help="số tag mỗi lần gắn")
+    parser.add_argument("--rounds", type=int, default=200)
+    args = parser.parse_args()
+
+    connection = get_database_connection()
+    connection.cursor_factory = CountingCursor
+    try:
+        # Nửa số tag đã có trong DB, nửa là tag mới (bị rollback sau mỗi lần)
+        with connection.cursor() as cur:
+            cur.execute("SELECT name FROM tags ORDER BY tag_id LIMIT %s;", (args.tags // 2,))
+            existing = [row["name"] for row in cur.fetchall()]
+        connection.rollback()
+        tags = existing + [f"bench-tag-{i}" for i in range(args.tags - len(existing))]
+
+        # Làm nóng cache tag trước khi đo
+        with connection.cursor() as cur:
+            cache.get_tag_ids(cur, tags)
+        connection.rollback()
+
+        print(f"{len(tags)} tag ({len(existing)} đã có), {args.rounds} lần")
+        for label, fn in (("per-row", assign_per_row), ("set-based", assign_tag_names)):
+            statements, ms = run(connection, fn, args, tags, args.rounds)
+            print(f"  {label:<10} {statements:5.1f} câu lệnh/lần  {ms:7.2f} ms/lần")
+    finally:
+        connection.close()
+
+
+if __name__ == "__main__":
+    main()
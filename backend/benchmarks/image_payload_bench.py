@@ -0,0 +1,139 @@
+"""
+So sánh payload gửi Vision / OpenAI moderation trước và sau image_prep (ảnh gốc vs bản thu nhỏ).
+
+Với mỗi ảnh: số byte JSON gửi đi, thời gian thu nhỏ, và độ trễ end-to-end (chuẩn bị +
+mã hóa + POST tới endpoint). Mặc định POST tới một server cục bộ giả lập đường truyền
+--mbps Mbit/s; --vision gọi thẳng Vision API thật (cần VISION_API_KEY, tốn quota).
+    cd backend && python benchmarks/image_payload_bench.py photo1.jpg photo2.jpg
+Không truyền ảnh -> tự tạo 1 ảnh JPEG 4032x3024 (cỡ ảnh điện thoại).
+"""
+import argparse
+import base64
+import io
+import json
+import random
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from time import perf_counter, sleep
+
+import httpx
+from PIL import Image, ImageDraw
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import image_prep  # noqa: E402
+
+
+def sample_photo() -> bytes:
+    """Ảnh nhiễu + hình khối cỡ 12MP, nén JPEG q92 - khó nén như ảnh chụp thật."""
+    rng = random.Random(0)
+    image = Image.effect_noise((4032, 3024), 40).convert("RGB")
+    draw = ImageDraw.Draw(image)
+    for _ in range(200):
+        x, y = rng.randrange(4000), rng.randrange(3000)
+        draw.ellipse([x, y, x + rng.randrange(20, 600), y + rng.randrange(20, 600)],
+                     fill=tuple(rng.randrange(256) for _ in range(3)))
+    out = io.BytesIO()
+    image.save(out, "JPEG", quality=92)
+    return out.getvalue()
+
+
+def vision_payload(data: bytes) -> bytes:
+    """Giống tag._detect_labels."""
+    return json.dumps({
+        "requests": [{
+            "image": {"content": base64.b64encode(data).decode("utf-8")},
+            "features": [{"type": "LABEL_DETECTION", "maxResults": 10}],
+        }]
+    }).encode()
+
+
+def moderation_payload(data: bytes, content_type: str) -> bytes:
+    """Giống sensitive.moderate_image_bytes."""
+    url = f"data:{content_type};base64,{base64.b64encode(data).decode('utf-8')}"
+    return json.dumps({
+        "model": "omni-moderation-latest",
+        "input": [{"type": "image_url", "image_url": {"url": url}}],
+    }).encode()
+
+
+def start_sink(mbps: float) -> str:
+    """Server đọc hết body với tốc độ mbps Mbit/s rồi trả {} - giả lập upload lên API."""
+    chunk = 64 * 1024
+
+    class Sink(BaseHTTPRequestHandler):
+        def do_POST(self):
+            remaining = int(self.headers["Content-Length"])
+            while remaining:
+                read = len(self.rfile.read(min(chunk, remaining)))
+                remaining -= read
+                sleep(read * 8 / (mbps * 1_000_000))
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", "2")
+            self.end_headers()
+            self.wfile.write(b"{}")
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Sink)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}/"
+
+
+def measure(client: httpx.Client, url: str, params: dict, build, data: bytes, max_side: int | None,
+            rounds: int) -> tuple[int, float, float]:
+    """(byte payload, ms thu nhỏ, ms end-to-end) trung bình qua rounds lần."""
+    prep_ms = total_ms = 0.0
+    size = 0
+    for _ in range(rounds):
+        started = perf_counter()
+        image = data
+        if max_side is not None:
+            image = image_prep.downscale(data, max_side) or data
+        prepared = perf_counter()
+        payload = build(image)
+        client.post(url, params=params, content=payload, headers={"Content-Type": "application/json"})
+        finished = perf_counter()
+        size = len(payload)
+        prep_ms += (prepared - started) * 1000
+        total_ms += (finished - started) * 1000
+    return size, prep_ms / rounds, total_ms / rounds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("images", nargs="*", help="file ảnh (mặc định: ảnh 12MP tự tạo)")
+    parser.add_argument("--mbps", type=float, default=20, help="tốc độ upload giả lập (Mbit/s)")
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--vision", action="store_true", help="gọi Vision API thật thay vì server giả lập")
+    args = parser.parse_args()
+
+    images = {path: Path(path).read_bytes() for path in args.images} or {"sample-12MP.jpg": sample_photo()}
+
+    if args.vision:
+        from tag import VISION_API_KEY, VISION_ENDPOINT
+        targets = [("vision", VISION_ENDPOINT, {"key": VISION_API_KEY}, vision_payload,
+                    image_prep.VISION_IMAGE_MAX_SIDE)]
+    else:
+        sink = start_sink(args.mbps)
+        targets = [
+            ("vision", sink, {}, vision_payload, image_prep.VISION_IMAGE_MAX_SIDE),
+            ("moderation", sink, {}, lambda data: moderation_payload(data, "image/jpeg"),
+             image_prep.MODERATION_IMAGE_MAX_SIDE),
+        ]
+
+    print(f"{'ảnh':<24}{'API':<12}{'':<8}{'payload':>12}{'thu nhỏ':>12}{'end-to-end':>14}")
+    with httpx.Client(timeout=120) as client:
+        for name, data in images.items():
+            for api, url, params, build, max_side in targets:
+                for label, side in (("gốc", None), (f"{max_side}px", max_side)):
+                    size, prep_ms, total_ms = measure(client, url, params, build, data, side, args.rounds)
+                    print(f"{name:<24}{api:<12}{label:<8}{size / 1024:>10.0f}KB{prep_ms:>10.1f}ms{total_ms:>12.1f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""
+Bộ lọc từ cấm cục bộ chạy trước moderation từ xa (/sensitive/text, /text/batch).
+
+Danh sách cụm từ nằm trong file BLOCKLIST_PATH (mỗi dòng một cụm, '#' là chú thích).
+Văn bản và cụm từ đều được chuẩn hóa: bỏ dấu tiếng Việt (đ -> d), chữ thường, ký tự
+không phải chữ/số thành khoảng trắng - nên "Đồ  NGU!" khớp với cụm "do ngu".
+Cụm từ chỉ khớp nguyên từ ("ass" không khớp "class").
+
+Tất cả cụm từ được dựng thành một automaton Aho-Corasick: quét văn bản một lượt dù
+danh sách dài bao nhiêu. File được đọc lại tự động khi thay đổi (kiểm tra mtime tối đa
+mỗi BLOCKLIST_CHECK_SECONDS giây), không cần khởi động lại server.
+"""
+import os
+import re
+import unicodedata
+from pathlib import Path
+from threading import Lock
+from time import monotonic
+
+BLOCKLIST_PATH = os.getenv("BLOCKLIST_PATH", str(Path(__file__).with_name("blocklist.txt")))
+BLOCKLIST_CHECK_SECONDS = float(os.getenv("BLOCKLIST_CHECK_SECONDS", "10"))
+
+_NON_WORD = re.compile(r"[\W_]+", re.UNICODE)
+
+
+def normalize(text: str) -> str:
+    """Bỏ dấu, chữ thường, chỉ giữ chữ/số cách nhau 1 khoảng trắng."""
+    text = unicodedata.normalize("NFD", text.replace("đ", "d").replace("Đ", "D"))
+    text = "".join(ch for ch in text if not unicodedata.combining(ch))
+    return _NON_WORD.sub(" ", text.casefold()).strip()
+
+
+class AhoCorasick:
+    def __init__(self, patterns):
+        self._goto: list[dict[str, int]] = [{}]
+        self._fail: list[int] = [0]
+        self._output: list[str | None] = [None]  # cụm từ ngắn nhất kết thúc tại node (kể cả qua fail)
+        for pattern in patterns:
+            self._add(pattern)
+        self._build()
+
+    def _add(self, pattern: str):
+        node = 0
+        for ch in pattern:
+            next_node = self._goto[node].get(ch)
+            if next_node is None:
+                next_node = len(self._goto)
+                self._goto[node][ch] = next_node
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append(None)
+            node = next_node
+        self._output[node] = pattern
+
+    def _build(self):
+        queue = list(self._goto[0].values())
+        for node in queue:
+            for ch, child in self._goto[node].items():
+                queue.append(child)
+                fail = self._fail[node]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[child] = self._goto[fail].get(ch, 0)
+                if self._output[child] is None:
+                    self._output[child] = self._output[self._fail[child]]
+
+    def find(self, text: str) -> str | None:
+        """Cụm từ đầu tiên xuất hiện trong text, None nếu không có."""
+        node = 0
+        for ch in text:
+            while node and ch not in self._goto[node]:
+                node = self._fail[node]
+            node = self._goto[node].get(ch, 0)
+            if self._output[node] is not None:
+                return self._output[node]
+        return None
+
+
+class Blocklist:
+    def __init__(self, path: str):
+        self.path = path
+        self._matcher: AhoCorasick | None = None
+        self._size = 0
+        self._mtime: float | None = None
+        self._checked_at = float("-inf")
+        self._lock = Lock()
+
+    def __len__(self) -> int:
+        return self._size
+
+    def reload(self) -> int:
+        """Đọc lại file, trả về số cụm từ."""
+        try:
+            mtime = os.stat(self.path).st_mtime
+            with open(self.path, encoding="utf-8") as f:
+                lines = f.read().splitlines()
+        except FileNotFoundError:
+            mtime, lines = None, []
+
+        terms = {normalize(line.split("#", 1)[0]) for line in lines}
+        terms.discard("")
+        # Đệm khoảng trắng hai đầu để chỉ khớp nguyên từ
+        matcher = AhoCorasick(f" {term} " for term in terms) if terms else None
+        self._matcher, self._size, self._mtime = matcher, len(terms), mtime
+        return self._size
+
+    def _reload_if_changed(self):
+        now = monotonic()
+        if now - self._checked_at < BLOCKLIST_CHECK_SECONDS:
+            return
+        with self._lock:
+            if now - self._checked_at < BLOCKLIST_CHECK_SECONDS:
+                return
+            self._checked_at = now
+            try:
+                mtime = os.stat(self.path).st_mtime
+            except FileNotFoundError:
+                mtime = None
+            if mtime != self._mtime:
+                self.reload()
+
+    def match(self, text: str) -> str | None:
+        """Cụm từ cấm có trong text (dạng đã chuẩn hóa), None nếu không có."""
+        self._reload_if_changed()
+        matcher = self._matcher
+        if matcher is None:
+            return None
+        term = matcher.find(f" {normalize(text)} ")
+        return term.strip() if term is not None else None
+
+
+BLOCKLIST = Blocklist(BLOCKLIST_PATH)
@@ -0,0 +1,170 @@
+"""
+Cache trong process cho các bảng tham chiếu ít thay đổi (badges, tags).
+
+Mỗi cache giữ dữ liệu tối đa REFERENCE_CACHE_TTL giây. Hết hạn thì chỉ đọc số version
+trong reference_versions (migrations/006, tăng bằng trigger khi bảng gốc bị sửa/xóa):
+version không đổi -> gia hạn, không nạp lại; đổi -> nạp lại toàn bộ bảng.
+invalidate() bỏ cache ngay trong worker hiện tại (vd. sau khi tự sửa bảng).
+
+Hàm get() dùng với cursor psycopg2 (handler def), aget() với cursor psycopg 3 (async def).
+"""
+from os import getenv
+from time import monotonic
+
+REFERENCE_CACHE_TTL = float(getenv("REFERENCE_CACHE_TTL", "60"))
+
+VERSION_SQL = "SELECT version FROM reference_versions WHERE name = %s;"
+
+
+class ReferenceCache:
+    def __init__(self, name: str, load_sql: str, build, ttl: float = REFERENCE_CACHE_TTL):
+        self.name = name
+        self.load_sql = load_sql
+        self.build = build
+        self.ttl = ttl
+        # (giá trị, version, hết hạn lúc) - thay cả bộ một lần để an toàn giữa các thread
+        self._entry = None
+
+    def _fresh(self):
+        entry = self._entry
+        if entry is not None and monotonic() < entry[2]:
+            return entry[0]
+        return None
+
+    def _renew(self, version: int) -> bool:
+        entry = self._entry
+        if entry is None or entry[1] != version:
+            return False
+        self._entry = (entry[0], version, monotonic() + self.ttl)
+        return True
+
+    def _store(self, rows, version: int):
+        value = self.build(rows)
+        self._entry = (value, version, monotonic() + self.ttl)
+        return value
+
+    def get(self, cur):
+        value = self._fresh()
+        if value is not None:
+            return value
+        cur.execute(VERSION_SQL, (self.name,))
+        row = cur.fetchone()
+        version = row["version"] if row else 0
+        if self._renew(version):
+            return self._entry[0]
+        cur.execute(self.load_sql)
+        return self._store(cur.fetchall(), version)
+
+    async def aget(self, cur):
+        value = self._fresh()
+        if value is not None:
+            return value
+        await cur.execute(VERSION_SQL, (self.name,))
+        row = await cur.fetchone()
+        version = row["version"] if row else 0
+        if self._renew(version):
+            return self._entry[0]
+        await cur.execute(self.load_sql)
+        return self._store(await cur.fetchall(), version)
+
+    def invalidate(self):
+        self._entry = None
+
+
+# ==================================================
+#              DANH MỤC HUY HIỆU
+# ==================================================
+
+class BadgeCatalog:
+    def __init__(self, rows):
+        self.badges = sorted(
+            (dict(row) for row in rows),
+            key=lambda b: (b["requirement_type"], b["requirement_value"], b["badge_id"])
+        )
+        self.by_id = {badge["badge_id"]: badge for badge in self.badges}
+        # requirement_type -> [huy hiệu theo requirement_value tăng dần]
+        self.by_type: dict[str, list[dict]] = {}
+        for badge in self.badges:
+            self.by_type.setdefault(badge["requirement_type"], []).append(badge)
+        # requirement_type -> ([requirement_value tăng dần], [badge_id tương ứng]) để bisect
+        self.thresholds = {
+            requirement_type: ([b["requirement_value"] for b in badges], [b["badge_id"] for b in badges])
+            for requirement_type, badges in self.by_type.items()
+        }
+
+
+BADGES = ReferenceCache(
+    "badges",
+    """
+    SELECT badge_id, name, description, icon_name, tier, requirement_type, requirement_value
+    FROM badges;
+    """,
+    BadgeCatalog,
+)
+
+
+def _has_badges(catalog: BadgeCatalog, badge_ids) -> bool:
+    return all(badge_id in catalog.by_id for badge_id in badge_ids)
+
+
+def get_badge_catalog(cur, badge_ids=()) -> BadgeCatalog:
+    """Danh mục huy hiệu, nạp lại 1 lần nếu thiếu badge_id nào (huy hiệu mới thêm)."""
+    catalog = BADGES.get(cur)
+    if not _has_badges(catalog, badge_ids):
+        BADGES.invalidate()
+        catalog = BADGES.get(cur)
+    return catalog
+
+
+async def aget_badge_catalog(cur, badge_ids=()) -> BadgeCatalog:
+    catalog = await BADGES.aget(cur)
+    if not _has_badges(catalog, badge_ids):
+        BADGES.invalidate()
+        catalog = await BADGES.aget(cur)
+    return catalog
+
+
+# ==================================================
+#              TỪ ĐIỂN TAG (name -> tag_id)
+# ==================================================
+
+# Tag chỉ được thêm mới, nên tag mới tạo được ghi thẳng vào map (remember_tags)
+# và tag chưa có trong map được tra lại DB; version chỉ tăng khi tag bị sửa/xóa.
+TAGS = ReferenceCache(
+    "tags",
+    "SELECT tag_id, name FROM tags;",
+    lambda rows: {row["name"]: row["tag_id"] for row in rows},
+)
+
+LOOKUP_TAGS_SQL = "SELECT tag_id, name FROM tags WHERE name = ANY(%s);"
+
+
+def remember_tags(tag_ids: dict[str, int]):
+    entry = TAGS._entry
+    if entry is not None:
+        entry[0].update(tag_ids)
+
+
+def get_tag_ids(cur, names) -> dict[str, int]:
+    """{name: tag_id} cho các tag đã tồn tại trong names."""
+    tag_map = TAGS.get(cur)
+    found = {name: tag_map[name] for name in names if name in tag_map}
+    missing = [name for name in names if name not in found]
+    if missing:
+        cur.execute(LOOKUP_TAGS_SQL, (missing,))
+        looked_up = {row["name"]: row["tag_id"] for row in cur.fetchall()}
+        remember_tags(looked_up)
+        found.update(looked_up)
+    return found
+
+
+async def aget_tag_ids(cur, names) -> dict[str, int]:
+    tag_map = await TAGS.aget(cur)
+    found = {name: tag_map[name] for name in names if name in tag_map}
+    missing = [name for name in names if name not in found]
+    if missing:
+        await cur.execute(LOOKUP_TAGS_SQL, (missing,))
+        looked_up = {row["name"]: row["tag_id"] for row in await cur.fetchall()}
+        remember_tags(looked_up)
+        found.update(looked_up)
+    return found
@@ -1,9 +1,18 @@
+from contextlib import asynccontextmanager
 from dotenv import load_dotenv
-from os import getenv
-from functools import lru_cache
-from openai import OpenAI
-from psycopg2 import connect
+from os import getenv, getpid
+from threading import Condition, Lock
+from time import monotonic
+from weakref import WeakKeyDictionary
+from fastapi import HTTPException
+from openai import AsyncOpenAI
+from psycopg2 import connect, Error as PsycopgError
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
 from psycopg2.extras import RealDictCursor
+from psycopg.conninfo import make_conninfo
+from psycopg.rows import dict_row
+from psycopg_pool import AsyncConnectionPool, PoolTimeout as AsyncPoolTimeout
+from http_client import DEFAULT_TIMEOUT, get_http_client
 
 load_dotenv()
 
@@ -18,6 +27,318 @@ def get_database_connection():
         cursor_factory=RealDictCursor
     )
 
-@lru_cache(maxsize=1)
-def get_openai_connection():
-    return OpenAI()
\ No newline at end of file
+# ==================================================
+#              POOL KẾT NỐI DATABASE
+# ==================================================
+
+class PoolTimeout(Exception):
+    pass
+
+
+class DatabasePool:
+    """
+    Pool kết nối psycopg2 cho một worker:
+    - giữ tối thiểu min_size, tối đa max_size kết nối
+    - chờ tối đa timeout giây khi mượn, quá thì PoolTimeout
+    - kiểm tra kết nối khi mượn (ping nếu để rảnh lâu hơn check_idle giây)
+    - đóng kết nối sống quá max_age giây
+    """
+
+    def __init__(self, min_size: int, max_size: int, timeout: float,
+                 max_age: float, check_idle: float, connect_fn=get_database_connection):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_age = max_age
+        self.check_idle = check_idle
+        self._connect = connect_fn
+        self._cond = Condition()
+        self._idle = []         # [(connection, created_at, returned_at)]
+        self._created_at = {}   # id(connection) -> created_at
+        self._size = 0
+        self._waiting = 0
+        self._metrics = {
+            "checkouts": 0,
+            "timeouts": 0,
+            "connections_opened": 0,
+            "connections_closed": 0,
+            "failed_health_checks": 0,
+            "wait_seconds_total": 0.0,
+            "wait_seconds_max": 0.0,
+        }
+
+    def fill(self):
+        """Mở trước min_size kết nối."""
+        while True:
+            with self._cond:
+                if self._size >= self.min_size:
+                    return
+                self._size += 1
+            try:
+                connection = self._open()
+            except Exception:
+                with self._cond:
+                    self._size -= 1
+                    self._cond.notify()
+                raise
+            with self._cond:
+                self._idle.append((connection, self._created_at[id(connection)], monotonic()))
+                self._cond.notify()
+
+    def acquire(self):
+        started = monotonic()
+        deadline = started + self.timeout
+        while True:
+            entry = None
+            with self._cond:
+                while not self._idle and self._size >= self.max_size:
+                    remaining = deadline - monotonic()
+                    if remaining <= 0:
+                        self._metrics["timeouts"] += 1
+                        raise PoolTimeout(f"Không lấy được kết nối sau {self.timeout}s")
+                    self._waiting += 1
+                    try:
+                        self._cond.wait(remaining)
+                    finally:
+                        self._waiting -= 1
+
+                if self._idle:
+                    entry = self._idle.pop()
+                else:
+                    self._size += 1
+
+            if entry is None:
+                try:
+                    connection = self._open()
+                except Exception:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+            else:
+                connection, created_at, returned_at = entry
+                now = monotonic()
+                if now - created_at > self.max_age or not self._is_healthy(connection, now - returned_at):
+                    self._discard(connection)
+                    continue
+
+            self._record_checkout(monotonic() - started)
+            return connection
+
+    def release(self, connection):
+        if connection.closed:
+            self._discard(connection)
+            return
+
+        if connection.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+            # Handler quên commit hoặc lỗi giữa chừng -> trả kết nối về trạng thái sạch
+            try:
+                connection.rollback()
+            except PsycopgError:
+                self._discard(connection)
+                return
+
+        created_at = self._created_at.get(id(connection), 0.0)
+        if monotonic() - created_at > self.max_age:
+            self._discard(connection)
+            return
+
+        with self._cond:
+            self._idle.append((connection, created_at, monotonic()))
+            self._cond.notify()
+
+    def stats(self) -> dict:
+        with self._cond:
+            checkouts = self._metrics["checkouts"]
+            return {
+                "pid": getpid(),
+                "min_size": self.min_size,
+                "max_size": self.max_size,
+                "size": self._size,
+                "idle": len(self._idle),
+                "in_use": self._size - len(self._idle),
+                "waiting": self._waiting,
+                **self._metrics,
+                "wait_seconds_avg": self._metrics["wait_seconds_total"] / checkouts if checkouts else 0.0,
+            }
+
+    def close(self):
+        with self._cond:
+            idle, self._idle = self._idle, []
+        for connection, _, _ in idle:
+            self._discard(connection)
+
+    def _open(self):
+        connection = self._connect()
+        with self._cond:
+            self._created_at[id(connection)] = monotonic()
+            self._metrics["connections_opened"] += 1
+        return connection
+
+    def _discard(self, connection):
+        try:
+            connection.close()
+        except PsycopgError:
+            pass
+        with self._cond:
+            self._created_at.pop(id(connection), None)
+            self._size -= 1
+            self._metrics["connections_closed"] += 1
+            self._cond.notify()
+
+    def _is_healthy(self, connection, idle_for: float) -> bool:
+        if connection.closed or connection.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+            healthy = False
+        elif idle_for < self.check_idle:
+            healthy = True
+        else:
+            try:
+                with connection.cursor() as cur:
+                    cur.execute("SELECT 1;")
+                connection.rollback()
+                healthy = True
+            except PsycopgError:
+                healthy = False
+
+        if not healthy:
+            with self._cond:
+                self._metrics["failed_health_checks"] += 1
+        return healthy
+
+    def _record_checkout(self, waited: float):
+        with self._cond:
+            self._metrics["checkouts"] += 1
+            self._metrics["wait_seconds_total"] += waited
+            self._metrics["wait_seconds_max"] = max(self._metrics["wait_seconds_max"], waited)
+
+
+_pool: DatabasePool | None = None
+_pool_pid: int | None = None
+_pool_lock = Lock()
+
+
+def get_database_pool() -> DatabasePool:
+    """Mỗi worker (process) có pool riêng, tạo lại nếu process bị fork."""
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is None or _pool_pid != getpid():
+            # Chỉ còn vài endpoint đồng bộ (badges, /tag/assign) nên pool này nhỏ,
+            # cấu hình riêng để không nhân đôi số kết nối Postgres của pool async
+            _pool = DatabasePool(
+                min_size=int(getenv("PG_SYNC_POOL_MIN", "1")),
+                max_size=int(getenv("PG_SYNC_POOL_MAX", "4")),
+                timeout=float(getenv("PG_POOL_TIMEOUT", "5")),
+                max_age=float(getenv("PG_POOL_MAX_AGE", "1800")),
+                check_idle=float(getenv("PG_POOL_CHECK_IDLE", "30")),
+            )
+            _pool_pid = getpid()
+            _pool.fill()
+        return _pool
+
+
+def get_db():
+    """
+    FastAPI dependency: mượn một kết nối từ pool và trả lại sau request.
+    Dùng: def handler(body: ..., connection = Depends(get_db))
+    """
+    pool = get_database_pool()
+    try:
+        connection = pool.acquire()
+    except PoolTimeout as e:
+        raise HTTPException(status_code=503, detail=f"Database đang quá tải: {e}")
+    try:
+        yield connection
+    finally:
+        pool.release(connection)
+
+# ==================================================
+#              POOL KẾT NỐI ASYNC (psycopg 3)
+# ==================================================
+
+_async_pool: AsyncConnectionPool | None = None
+# connection -> lúc vừa mở hoặc vừa được trả về pool (monotonic), để chỉ ping kết nối đã rảnh lâu
+_async_used_at: WeakKeyDictionary = WeakKeyDictionary()
+
+
+async def _mark_used(connection):
+    _async_used_at[connection] = monotonic()
+
+
+async def _check_if_idle(connection):
+    """Như pool đồng bộ: chỉ ping (1 round trip) khi kết nối rảnh quá PG_POOL_CHECK_IDLE giây."""
+    used_at = _async_used_at.get(connection)
+    if used_at is None or monotonic() - used_at >= float(getenv("PG_POOL_CHECK_IDLE", "30")):
+        await AsyncConnectionPool.check_connection(connection)
+
+
+def create_async_database_pool() -> AsyncConnectionPool:
+    """
+    Pool async dùng chung cấu hình PG_* và PG_POOL_* (pool đồng bộ dùng PG_SYNC_POOL_MIN/MAX).
+    Được mở/đóng trong lifespan của app (mỗi worker một pool).
+    """
+    global _async_pool
+    conninfo = make_conninfo(
+        host=getenv("PG_HOST"),
+        port=getenv("PG_PORT"),
+        dbname=getenv("PG_DB"),
+        user=getenv("PG_USER"),
+        password=getenv("PG_PASSWORD"),
+        sslmode=getenv("PG_SSLMODE", "require"),
+    )
+    _async_pool = AsyncConnectionPool(
+        conninfo,
+        min_size=int(getenv("PG_POOL_MIN", "2")),
+        max_size=int(getenv("PG_POOL_MAX", "10")),
+        timeout=float(getenv("PG_POOL_TIMEOUT", "5")),
+        max_lifetime=float(getenv("PG_POOL_MAX_AGE", "1800")),
+        check=_check_if_idle,
+        configure=_mark_used,
+        reset=_mark_used,
+        kwargs={"row_factory": dict_row},
+        open=False,
+    )
+    return _async_pool
+
+
+def get_async_database_pool() -> AsyncConnectionPool:
+    if _async_pool is None:
+        raise RuntimeError("Async database pool chưa được mở (xem lifespan trong main.py)")
+    return _async_pool
+
+
+@asynccontextmanager
+async def async_db_connection():
+    """
+    Mượn kết nối async ngay trong thân handler, cho nhánh nào thật sự cần Postgres
+    (vd. pins.py trả lời từ index trong bộ nhớ, chỉ nhánh dự phòng mới truy vấn).
+    Dùng: async with async_db_connection() as connection: ...
+    """
+    pool = get_async_database_pool()
+    try:
+        async with pool.connection() as connection:
+            yield connection
+    except AsyncPoolTimeout as e:
+        raise HTTPException(status_code=503, detail=f"Database đang quá tải: {e}")
+
+
+async def get_async_db():
+    """
+    FastAPI dependency cho handler async def.
+    Kết nối tự commit khi request thành công, rollback khi có exception.
+    """
+    async with async_db_connection() as connection:
+        yield connection
+
+_async_openai: tuple | None = None  # (httpx client, AsyncOpenAI)
+
+
+def get_async_openai_connection() -> AsyncOpenAI:
+    """
+    OpenAI async đi qua HTTP client dùng chung: keep-alive, giới hạn HTTP_MAX_PER_HOST và
+    thử lại theo chính sách của http_client (SDK tắt thử lại riêng để không thử lặp hai tầng).
+    """
+    global _async_openai
+    http_client = get_http_client()
+    if _async_openai is None or _async_openai[0] is not http_client:
+        _async_openai = (http_client, AsyncOpenAI(http_client=http_client, max_retries=0, timeout=DEFAULT_TIMEOUT))
+    return _async_openai[1]
@@ -0,0 +1,34 @@
+"""Hàm hình học dùng chung cho các truy vấn pin theo tọa độ."""
+from math import asin, cos, degrees, radians, sin, sqrt
+
+EARTH_RADIUS_M = 6371000  # Bán kính Trái Đất ~ 6,371km (đơn vị mét)
+
+
+def bounding_box(lat: float, lng: float, radius_m: float) -> tuple[float, float, float, float]:
+    """
+    Hình chữ nhật (min_lat, max_lat, min_lng, max_lng) bao trọn hình tròn bán kính radius_m.
+    Dùng để lọc thô bằng index trên (latitude, longitude) trước khi tính khoảng cách chính xác.
+    """
+    angular = radius_m / EARTH_RADIUS_M
+    delta_lat = degrees(angular)
+    min_lat, max_lat = lat - delta_lat, lat + delta_lat
+
+    # Vòng tròn chạm cực hoặc vượt kinh tuyến 180 -> không lọc theo kinh độ
+    if min_lat <= -90 or max_lat >= 90 or angular >= radians(90 - abs(lat)):
+        return max(min_lat, -90.0), min(max_lat, 90.0), -180.0, 180.0
+
+    delta_lng = degrees(asin(sin(angular) / cos(radians(lat))))
+    min_lng, max_lng = lng - delta_lng, lng + delta_lng
+    if min_lng < -180 or max_lng > 180:
+        return min_lat, max_lat, -180.0, 180.0
+
+    return min_lat, max_lat, min_lng, max_lng
+
+
+def haversine_m(lat1: float, lng1: float, lat2: float, lng2: float) -> float:
+    """Khoảng cách mặt cầu giữa 2 điểm (mét)."""
+    phi1, phi2 = radians(lat1), radians(lat2)
+    dphi = phi2 - phi1
+    dlmb = radians(lng2 - lng1)
+    a = sin(dphi / 2) ** 2 + cos(phi1) * cos(phi2) * sin(dlmb / 2) ** 2
+    return 2 * EARTH_RADIUS_M * asin(min(1.0, sqrt(a)))
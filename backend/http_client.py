@@ -0,0 +1,169 @@
+"""
+HTTP client async dùng chung cho các API bên ngoài (Vision, Translate, OpenAI).
+
+- Một httpx.AsyncClient cho mỗi worker: giữ kết nối keep-alive (không bắt tay TLS lại mỗi request)
+- Tối đa HTTP_MAX_PER_HOST request đồng thời tới mỗi host
+- Timeout mặc định HTTP_TIMEOUT giây, từng lời gọi có thể đặt riêng; timeout là hạn chót cho
+  cả lời gọi (mọi lần thử + thời gian chờ), không phải cho từng lần thử
+- Thử lại HTTP_RETRIES lần khi lỗi mạng / 429 / 5xx, chờ lũy thừa (có jitter, tôn trọng Retry-After)
+
+Giới hạn host và thử lại nằm ở SharedTransport nên áp dụng cho mọi request đi qua client,
+kể cả OpenAI SDK (connection.get_async_openai_connection).
+Client được tạo khi dùng lần đầu và đóng trong lifespan của app (main.py).
+"""
+import asyncio
+import random
+from os import getenv
+from time import monotonic
+
+import httpx
+
+HTTP_TIMEOUT = float(getenv("HTTP_TIMEOUT", "30"))
+HTTP_CONNECT_TIMEOUT = float(getenv("HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_MAX_CONNECTIONS = int(getenv("HTTP_MAX_CONNECTIONS", "100"))
+HTTP_MAX_KEEPALIVE = int(getenv("HTTP_MAX_KEEPALIVE", "20"))
+HTTP_KEEPALIVE_EXPIRY = float(getenv("HTTP_KEEPALIVE_EXPIRY", "60"))
+HTTP_MAX_PER_HOST = int(getenv("HTTP_MAX_PER_HOST", "20"))
+HTTP_RETRIES = int(getenv("HTTP_RETRIES", "2"))
+HTTP_BACKOFF = float(getenv("HTTP_BACKOFF", "0.5"))
+HTTP_BACKOFF_MAX = float(getenv("HTTP_BACKOFF_MAX", "8"))
+
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+DEFAULT_TIMEOUT = httpx.Timeout(HTTP_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT)
+
+_client: httpx.AsyncClient | None = None
+_host_limits: dict[str, asyncio.Semaphore] = {}
+
+
+def get_http_client() -> httpx.AsyncClient:
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            timeout=DEFAULT_TIMEOUT,
+            transport=SharedTransport(httpx.AsyncHTTPTransport(limits=httpx.Limits(
+                max_connections=HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+                keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+            ))),
+        )
+    return _client
+
+
+async def aclose():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+    _host_limits.clear()
+
+
+def _host_limit(url: str) -> asyncio.Semaphore:
+    host = httpx.URL(url).host
+    limit = _host_limits.get(host)
+    if limit is None:
+        limit = _host_limits[host] = asyncio.Semaphore(HTTP_MAX_PER_HOST)
+    return limit
+
+
+def _backoff_seconds(attempt: int, response: httpx.Response | None) -> float:
+    if response is not None:
+        retry_after = response.headers.get("Retry-After", "")
+        if retry_after.isdigit():
+            return min(float(retry_after), HTTP_BACKOFF_MAX)
+    delay = min(HTTP_BACKOFF * (2 ** attempt), HTTP_BACKOFF_MAX)
+    return delay * (0.5 + random.random() / 2)
+
+
+class _HostLimitedStream(httpx.AsyncByteStream):
+    """Body của response; trả chỗ trong semaphore của host khi body được đóng."""
+
+    def __init__(self, stream: httpx.AsyncByteStream, limit: asyncio.Semaphore):
+        self._stream = stream
+        self._limit = limit
+        self._released = False
+
+    async def __aiter__(self):
+        async for chunk in self._stream:
+            yield chunk
+
+    async def aclose(self):
+        try:
+            await self._stream.aclose()
+        finally:
+            if not self._released:
+                self._released = True
+                self._limit.release()
+
+
+class SharedTransport(httpx.AsyncBaseTransport):
+    """
+    Bọc transport thật: tối đa HTTP_MAX_PER_HOST request đồng thời mỗi host và thử lại
+    theo chính sách chung. Số lần thử lại lấy từ request.extensions["retries"]
+    (mặc định HTTP_RETRIES); timeout của request là hạn chót cho mọi lần thử cộng lại.
+    """
+
+    def __init__(self, transport: httpx.AsyncBaseTransport):
+        self._transport = transport
+
+    async def _send(self, request: httpx.Request) -> httpx.Response:
+        limit = _host_limit(str(request.url))
+        await limit.acquire()
+        try:
+            response = await self._transport.handle_async_request(request)
+        except BaseException:
+            limit.release()
+            raise
+        if response.is_closed:
+            # Body đã nằm sẵn trong bộ nhớ, không còn gì để đọc từ host
+            limit.release()
+        else:
+            response.stream = _HostLimitedStream(response.stream, limit)
+        return response
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        retries = request.extensions.get("retries", HTTP_RETRIES)
+        timeout = dict(request.extensions.get("timeout") or {})
+        budget = max((value for value in timeout.values() if value is not None), default=None)
+        deadline = monotonic() + budget if budget is not None else None
+        attempt = 0
+        while True:
+            if deadline is not None:
+                # Lần thử sau chỉ được dùng phần thời gian còn lại
+                remaining = max(deadline - monotonic(), 0.001)
+                request.extensions["timeout"] = {
+                    key: remaining if value is None else min(value, remaining) for key, value in timeout.items()
+                }
+            response = error = None
+            try:
+                response = await self._send(request)
+                if response.status_code not in RETRY_STATUS_CODES or attempt >= retries:
+                    return response
+            except httpx.TransportError as e:
+                if attempt >= retries:
+                    raise
+                error = e
+            delay = _backoff_seconds(attempt, response)
+            if deadline is not None and monotonic() + delay >= deadline:
+                # Không kịp thử thêm trước hạn chót: trả kết quả lần cuối
+                if error is not None:
+                    raise error
+                return response
+            if response is not None:
+                await response.aclose()
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def aclose(self):
+        await self._transport.aclose()
+
+
+async def request(method: str, url: str, *, retries: int = HTTP_RETRIES, **kwargs) -> httpx.Response:
+    """
+    Gửi request qua client dùng chung, trả về response cuối cùng (kể cả 4xx/5xx).
+    Lỗi mạng sau lần thử cuối được ném ra dưới dạng httpx.HTTPError.
+    """
+    return await get_http_client().request(method, url, extensions={"retries": retries}, **kwargs)
+
+
+async def post(url: str, **kwargs) -> httpx.Response:
+    return await request("POST", url, **kwargs)
@@ -0,0 +1,109 @@
+"""
+Perceptual hash (dHash 64 bit) cho ảnh và index tra ảnh gần giống theo khoảng cách Hamming.
+
+Ảnh đăng lại, nén lại hay đổi kích thước cho ra dHash chỉ lệch vài bit, nên
+/sensitive/image dùng lại kết quả kiểm duyệt của ảnh gần giống thay vì gửi lại OpenAI.
+
+HammingIndex chia hash thành HASH_BANDS dải 8 bit: hai hash lệch nhau không quá
+HASH_BANDS - 1 bit thì chắc chắn trùng nhau ít nhất một dải (nguyên lý Dirichlet),
+nên chỉ cần so với các hash cùng dải thay vì duyệt toàn bộ index.
+"""
+import io
+from collections import OrderedDict
+from threading import Lock
+
+from PIL import Image, UnidentifiedImageError
+
+HASH_BANDS = 8
+BAND_BITS = 64 // HASH_BANDS
+
+
+def dhash(data: bytes) -> int | None:
+    """dHash 64 bit của ảnh, None nếu không đọc được ảnh. Tốn CPU - gọi qua threadpool."""
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            image.draft("L", (64, 64))  # JPEG: giải mã thẳng ở độ phân giải thấp
+            pixels = list(image.convert("L").resize((9, 8), Image.Resampling.LANCZOS).getdata())
+    except (UnidentifiedImageError, OSError, ValueError, Image.DecompressionBombError):
+        return None
+
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            left = pixels[row * 9 + col]
+            right = pixels[row * 9 + col + 1]
+            value = (value << 1) | (left > right)
+    return value
+
+
+def _bands(value: int):
+    mask = (1 << BAND_BITS) - 1
+    for band in range(HASH_BANDS):
+        yield band, (value >> (band * BAND_BITS)) & mask
+
+
+class HammingIndex:
+    def __init__(self, max_entries: int, max_distance: int):
+        if max_distance >= HASH_BANDS:
+            raise ValueError(f"max_distance phải nhỏ hơn {HASH_BANDS}")
+        self.max_entries = max_entries
+        self.max_distance = max_distance
+        self._verdicts: OrderedDict[int, bool] = OrderedDict()
+        self._buckets: list[dict[int, set[int]]] = [{} for _ in range(HASH_BANDS)]
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._verdicts)
+
+    def add(self, value: int, verdict: bool):
+        with self._lock:
+            if value in self._verdicts:
+                # Đã từng bị gắn cờ thì giữ cờ
+                self._verdicts[value] = self._verdicts[value] or verdict
+                self._verdicts.move_to_end(value)
+                return
+            self._verdicts[value] = verdict
+            for band, key in _bands(value):
+                self._buckets[band].setdefault(key, set()).add(value)
+            while len(self._verdicts) > self.max_entries:
+                self._remove(next(iter(self._verdicts)))
+                self.evictions += 1
+
+    def _remove(self, value: int):
+        del self._verdicts[value]
+        for band, key in _bands(value):
+            bucket = self._buckets[band][key]
+            bucket.discard(value)
+            if not bucket:
+                del self._buckets[band][key]
+
+    def find(self, value: int) -> bool | None:
+        """
+        Kết quả của ảnh trong index cách value không quá max_distance bit, None nếu không có.
+        Nhiều ảnh gần giống mà có ảnh bị gắn cờ -> True.
+        """
+        with self._lock:
+            candidates = set()
+            for band, key in _bands(value):
+                candidates |= self._buckets[band].get(key, set())
+            matches = [c for c in candidates if (c ^ value).bit_count() <= self.max_distance]
+            if not matches:
+                self.misses += 1
+                return None
+            self.hits += 1
+            for match in matches:
+                self._verdicts.move_to_end(match)
+            return any(self._verdicts[match] for match in matches)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": len(self._verdicts),
+            "evictions": self.evictions,
+        }
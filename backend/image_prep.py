@@ -0,0 +1,50 @@
+"""
+Thu nhỏ ảnh trước khi gửi lên Vision (tag.py) và OpenAI moderation (sensitive.py).
+
+Ảnh upload (tới 5MB, ~6.7MB sau base64) trước đây được nhét nguyên vào JSON, trong khi
+Vision LABEL_DETECTION chỉ cần khoảng 640x480 và OpenAI cũng thu ảnh về vài trăm px
+trước khi xử lý. prepare() giải mã ảnh, xoay theo EXIF, bỏ toàn bộ metadata (EXIF, GPS,
+ICC) và thu về cạnh dài tối đa max_side, mã hóa lại JPEG.
+
+So sánh kích thước payload và độ trễ: python benchmarks/image_payload_bench.py
+"""
+import io
+from os import getenv
+
+from fastapi.concurrency import run_in_threadpool
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+VISION_IMAGE_MAX_SIDE = int(getenv("VISION_IMAGE_MAX_SIDE", "640"))
+MODERATION_IMAGE_MAX_SIDE = int(getenv("MODERATION_IMAGE_MAX_SIDE", "768"))
+API_IMAGE_QUALITY = int(getenv("API_IMAGE_QUALITY", "85"))
+
+
+def downscale(data: bytes, max_side: int, quality: int = API_IMAGE_QUALITY) -> bytes | None:
+    """JPEG cạnh dài <= max_side, không metadata. None nếu Pillow không đọc được ảnh."""
+    try:
+        with Image.open(io.BytesIO(data)) as source:
+            # JPEG: giải mã thẳng ở độ phân giải gần max_side (nhanh hơn nhiều so với full size)
+            source.draft("RGB", (max_side, max_side))
+            image = ImageOps.exif_transpose(source)
+            if image.has_transparency_data:
+                # JPEG không có alpha: phần trong suốt thành nền trắng
+                rgba = image.convert("RGBA")
+                image = Image.new("RGB", rgba.size, (255, 255, 255))
+                image.paste(rgba, mask=rgba.getchannel("A"))
+            else:
+                image = image.convert("RGB")
+            image.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+    except (UnidentifiedImageError, OSError, ValueError, Image.DecompressionBombError):
+        return None
+
+    out = io.BytesIO()
+    image.save(out, "JPEG", quality=quality)
+    return out.getvalue()
+
+
+async def prepare(data: bytes, content_type: str | None, max_side: int) -> tuple[bytes, str | None]:
+    """(ảnh đã thu nhỏ, "image/jpeg"), ảnh không đọc được thì trả nguyên (data, content_type)."""
+    small = await run_in_threadpool(downscale, data, max_side)
+    if small is None:
+        return data, content_type
+    return small, "image/jpeg"
@@ -0,0 +1,79 @@
+"""
+Tạo các bản ảnh theo kích thước (thumbnail / feed / full) khi upload.
+
+Ảnh gốc từ điện thoại thường là JPEG vài MB; feed và preview pin chỉ cần bản nhỏ.
+make_variants() giải mã ảnh một lần (xoay theo EXIF, bỏ metadata) rồi thu nhỏ dần từ bản
+lớn xuống bản nhỏ, mã hóa sang IMAGE_VARIANT_FORMAT (WEBP mặc định, AVIF nếu Pillow hỗ trợ).
+
+Giải mã + mã hóa tốn CPU nên chạy trong process pool (IMAGE_WORKERS tiến trình),
+không chiếm event loop hay GIL của worker API.
+"""
+import asyncio
+import io
+from concurrent.futures import ProcessPoolExecutor
+from os import getenv
+
+from PIL import Image, ImageOps, UnidentifiedImageError, features
+
+# tên bản -> cạnh dài tối đa (px), xếp từ lớn đến nhỏ
+VARIANTS = {
+    "full": int(getenv("IMAGE_FULL_SIZE", "2048")),
+    "feed": int(getenv("IMAGE_FEED_SIZE", "1080")),
+    "thumbnail": int(getenv("IMAGE_THUMBNAIL_SIZE", "320")),
+}
+IMAGE_VARIANT_FORMAT = getenv("IMAGE_VARIANT_FORMAT", "WEBP").upper()
+IMAGE_VARIANT_QUALITY = int(getenv("IMAGE_VARIANT_QUALITY", "80"))
+IMAGE_WORKERS = int(getenv("IMAGE_WORKERS", "2"))
+
+FORMATS = {
+    "WEBP": ("webp", "image/webp"),
+    "AVIF": ("avif", "image/avif"),
+}
+if IMAGE_VARIANT_FORMAT not in FORMATS:
+    raise RuntimeError(f"IMAGE_VARIANT_FORMAT phải là một trong {list(FORMATS)}")
+# Bản Pillow không build kèm libavif -> mọi job trong process pool sẽ lỗi, dùng WEBP thay thế
+if IMAGE_VARIANT_FORMAT == "AVIF" and not features.check("avif"):
+    print("[image_variants] Pillow không hỗ trợ mã hóa AVIF, dùng WEBP")
+    IMAGE_VARIANT_FORMAT = "WEBP"
+EXTENSION, CONTENT_TYPE = FORMATS[IMAGE_VARIANT_FORMAT]
+
+_pool: ProcessPoolExecutor | None = None
+
+
+def make_variants(data: bytes) -> dict[str, bytes] | None:
+    """name -> bytes đã mã hóa, None nếu Pillow không đọc được ảnh (vd. HEIC)."""
+    try:
+        with Image.open(io.BytesIO(data)) as source:
+            # JPEG: giải mã thẳng ở độ phân giải gần bản lớn nhất thay vì full sensor
+            source.draft("RGB", (VARIANTS["full"], VARIANTS["full"]))
+            image = ImageOps.exif_transpose(source)
+            image = image.convert("RGBA" if image.has_transparency_data else "RGB")
+    except (UnidentifiedImageError, OSError, ValueError, Image.DecompressionBombError):
+        return None
+
+    variants = {}
+    for name, size in VARIANTS.items():
+        # thumbnail() chỉ thu nhỏ, giữ tỉ lệ; bản sau thu nhỏ từ bản trước
+        image.thumbnail((size, size), Image.Resampling.LANCZOS)
+        out = io.BytesIO()
+        image.save(out, IMAGE_VARIANT_FORMAT, quality=IMAGE_VARIANT_QUALITY)
+        variants[name] = out.getvalue()
+    return variants
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=IMAGE_WORKERS)
+    return _pool
+
+
+async def generate(data: bytes) -> dict[str, bytes] | None:
+    return await asyncio.get_running_loop().run_in_executor(_get_pool(), make_variants, data)
+
+
+def shutdown():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
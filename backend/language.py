@@ -0,0 +1,45 @@
+"""
+Nhận diện nhanh văn bản tiếng Anh (offline, không cần model) để bỏ qua bước dịch.
+
+Quy tắc thận trọng - chỉ trả True khi khá chắc là tiếng Anh, còn lại để dịch như cũ:
+- có chữ cái ngoài bảng ASCII (tiếng Việt có dấu, CJK, ...) -> không phải tiếng Anh
+- không có chữ cái nào (số, emoji, dấu câu) -> không cần dịch
+- còn lại đếm từ chức năng tiếng Anh và âm tiết tiếng Việt không dấu hay gặp:
+  đủ tỉ lệ từ tiếng Anh và rõ ràng nhiều hơn từ tiếng Việt -> tiếng Anh
+"""
+import re
+
+_WORD = re.compile(r"[^\W\d_]+", re.UNICODE)
+
+ENGLISH_WORDS = frozenset("""
+a about after again all also am an and any are as at be because been before being but by
+can could did do does doing down for from get go going good got great had has have
+he her here him his how i if in into is it its just know like love me more most my
+new no not now of off on one only or our out over people please really see she so some
+than thank thanks that the their them then there these they this those to too up us very
+was we well were what when where which who why will with would yes you your
+amazing awesome beautiful best cool food nice photo place pretty view wow
+""".split())
+
+# Âm tiết tiếng Việt gõ không dấu hay gặp (trùng với từ tiếng Anh thì không đưa vào)
+VIETNAMESE_WORDS = frozenset("""
+anh ban bao biet cai cam chi cho chua co con cua cung da dang day de den di dep duoc em gi
+hay hoi khi khong la lam len lai luon mai minh moi mot nay ne nen nguoi nha nhe nhieu nhung
+nhu nua oi ong qua ra roi rat sao se sau thi thay thich toi tot trong uoc va vay vi voi
+xau xin
+""".split())
+
+MIN_ENGLISH_RATIO = 0.25
+
+
+def is_probably_english(text: str) -> bool:
+    if not text.isascii():
+        return False
+
+    words = [word.lower() for word in _WORD.findall(text)]
+    if not words:
+        return True
+
+    english = sum(word in ENGLISH_WORDS for word in words)
+    vietnamese = sum(word in VIETNAMESE_WORDS for word in words)
+    return english / len(words) >= MIN_ENGLISH_RATIO and english > 2 * vietnamese
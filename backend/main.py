@@ -1,4 +1,11 @@
+import asyncio
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
+from connection import create_async_database_pool, get_async_database_pool, get_database_pool
+import http_client
+import image_variants
+import pin_index
+import result_cache
 from users import router as user_router
 from pins import router as pin_router
 from posts import router as post_router
@@ -6,10 +13,48 @@ from sensitive import router as sensitive_router
 from tag import router as tag_router
 from badges import router as badge_router
 
-app = FastAPI()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Mỗi worker mở pool async riêng khi khởi động
+    pool = create_async_database_pool()
+    await pool.open(wait=False)
+
+    # Cây cụm pin (/pins/clusters) luôn nằm trong bộ nhớ; lưới pin chỉ dùng khi PIN_INDEX_ENABLED=1
+    try:
+        await pin_index.load(pool)
+    except Exception as e:
+        print(f"[pin_index] Nạp lỗi, thử lại trong vòng refresh: {e}")
+    refresh_task = asyncio.create_task(pin_index.refresh_forever(pool))
+
+    yield
+
+    refresh_task.cancel()
+    await http_client.aclose()
+    image_variants.shutdown()
+    await pool.close()
+
+
+app = FastAPI(lifespan=lifespan)
 app.include_router(user_router)
 app.include_router(pin_router)
 app.include_router(post_router)
 app.include_router(sensitive_router)
 app.include_router(tag_router)
 app.include_router(badge_router)
+
+
+@app.get("/metrics/db-pool")
+def db_pool_metrics():
+    # Số liệu pool của worker đang phục vụ request này
+    return {
+        "sync": get_database_pool().stats(),
+        "async": get_async_database_pool().get_stats(),
+    }
+
+
+@app.get("/metrics/caches")
+def cache_metrics():
+    # Hit/miss của các cache kết quả API ngoài (result_cache.py) trong worker này
+    return result_cache.cache_stats()
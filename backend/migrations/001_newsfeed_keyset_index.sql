@@ -0,0 +1,5 @@
+-- Keyset pagination cho /posts/newsfeed:
+-- ORDER BY created_at DESC, post_id DESC và điều kiện (created_at, post_id) < (cursor)
+-- đi thẳng vào index thay vì sort rồi bỏ qua OFFSET dòng.
+CREATE INDEX IF NOT EXISTS posts_pin_id_created_at_post_id_idx
+    ON posts (pin_id, created_at DESC, post_id DESC);
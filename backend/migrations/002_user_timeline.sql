@@ -0,0 +1,39 @@
+-- Timeline dựng sẵn cho từng user (fan-out-on-write, bật bằng NEWSFEED_MODE=timeline).
+-- Mỗi dòng: một bài viết thuộc pin mà user đã lưu (user_pins).
+-- created_at sao chép từ posts.created_at để đọc feed không cần sort lại. Cột lấy đúng kiểu
+-- của posts.created_at (timestamp hay timestamptz) để so sánh keyset giữa hai bảng không
+-- phải ép kiểu ngầm (ép kiểu làm mất index).
+DO $$
+DECLARE
+    posts_type    TEXT;
+    timeline_type TEXT;
+BEGIN
+    SELECT format_type(atttypid, atttypmod) INTO posts_type
+    FROM pg_attribute
+    WHERE attrelid = 'posts'::regclass AND attname = 'created_at' AND NOT attisdropped;
+
+    EXECUTE format(
+        'CREATE TABLE IF NOT EXISTS user_timeline (
+            user_id    INTEGER NOT NULL,
+            post_id    INTEGER NOT NULL REFERENCES posts (post_id) ON DELETE CASCADE,
+            created_at %s      NOT NULL,
+            PRIMARY KEY (user_id, post_id)
+        )',
+        posts_type
+    );
+
+    -- Bảng tạo bởi bản cũ của migration này (luôn TIMESTAMPTZ) -> đổi về kiểu của posts,
+    -- sau đó chạy lại: python timeline.py rebuild
+    SELECT format_type(atttypid, atttypmod) INTO timeline_type
+    FROM pg_attribute
+    WHERE attrelid = 'user_timeline'::regclass AND attname = 'created_at' AND NOT attisdropped;
+
+    IF timeline_type <> posts_type THEN
+        EXECUTE format('ALTER TABLE user_timeline ALTER COLUMN created_at TYPE %s', posts_type);
+    END IF;
+END $$;
+
+CREATE INDEX IF NOT EXISTS user_timeline_user_id_created_at_post_id_idx
+    ON user_timeline (user_id, created_at DESC, post_id DESC);
+
+-- Sau khi tạo bảng: python timeline.py rebuild
@@ -0,0 +1,5 @@
+-- Index cho truy vấn pin theo vùng (/pins/get/in-radius, /pins/get-or-create-by-coord, /pins/find-random).
+-- Truy vấn lọc thô bằng bounding box trên biểu thức ::double precision rồi mới tính khoảng cách
+-- chính xác, nên index phải dựng trên đúng biểu thức đó (chạy được dù cột là numeric hay float).
+CREATE INDEX IF NOT EXISTS pins_latitude_longitude_idx
+    ON pins ((latitude::double precision), (longitude::double precision));
@@ -0,0 +1,15 @@
+-- Bộ đếm hoạt động của từng user, được các API ghi (insert_post, react, comment,
+-- send_contact, respond_contact, ...) cập nhật ngay trong transaction của chúng.
+-- login, /users/get, /badges/check, /badges/progress đọc từ đây thay vì COUNT(*).
+CREATE TABLE IF NOT EXISTS user_stats (
+    user_id                 INTEGER PRIMARY KEY,
+    pin_count               INTEGER NOT NULL DEFAULT 0,  -- số pin đã lưu (user_pins)
+    post_count              INTEGER NOT NULL DEFAULT 0,  -- số bài đã đăng
+    reaction_received_count INTEGER NOT NULL DEFAULT 0,  -- số tim trên bài của user
+    comment_received_count  INTEGER NOT NULL DEFAULT 0,  -- số comment trên bài của user
+    comment_made_count      INTEGER NOT NULL DEFAULT 0,  -- số comment user đã viết
+    pending_contact_count   INTEGER NOT NULL DEFAULT 0,  -- lời mời kết bạn đang chờ user trả lời
+    friend_count            INTEGER NOT NULL DEFAULT 0
+);
+
+-- Sau khi tạo bảng, điền số liệu ban đầu: python user_stats.py reconcile
@@ -0,0 +1,22 @@
+-- Hàng đợi huy hiệu mới: huy hiệu được cấp theo sự kiện (badge_awards.py) có
+-- notified_at IS NULL cho tới khi client lấy về qua /badges/check.
+-- Chỉ lần chạy đầu (cột chưa có) mới đánh dấu huy hiệu cũ là đã thông báo; chạy lại
+-- migration không được đụng tới huy hiệu đang chờ trong hàng đợi.
+DO $$
+BEGIN
+    IF NOT EXISTS (
+        SELECT 1 FROM pg_attribute
+        WHERE attrelid = 'user_badges'::regclass AND attname = 'notified_at' AND NOT attisdropped
+    ) THEN
+        ALTER TABLE user_badges ADD COLUMN notified_at TIMESTAMPTZ;
+
+        -- Huy hiệu đã cấp trước đây coi như đã thông báo
+        UPDATE user_badges SET notified_at = earned_at;
+    END IF;
+END $$;
+
+CREATE INDEX IF NOT EXISTS user_badges_unnotified_idx
+    ON user_badges (user_id)
+    WHERE notified_at IS NULL;
+
+-- Sau khi chạy: python badge_awards.py backfill (cấp bù huy hiệu đã đủ điều kiện)
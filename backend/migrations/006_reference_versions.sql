@@ -0,0 +1,28 @@
+-- Số version của các bảng tham chiếu được cache trong process (cache.py).
+-- Worker so version khi cache hết hạn để biết có cần nạp lại bảng hay không.
+CREATE TABLE IF NOT EXISTS reference_versions (
+    name    TEXT PRIMARY KEY,
+    version BIGINT NOT NULL DEFAULT 0
+);
+
+INSERT INTO reference_versions (name) VALUES ('badges'), ('tags')
+ON CONFLICT (name) DO NOTHING;
+
+CREATE OR REPLACE FUNCTION bump_reference_version() RETURNS trigger AS $$
+BEGIN
+    UPDATE reference_versions SET version = version + 1 WHERE name = TG_ARGV[0];
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- badges: mọi thay đổi
+DROP TRIGGER IF EXISTS badges_bump_reference_version ON badges;
+CREATE TRIGGER badges_bump_reference_version
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON badges
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_reference_version('badges');
+
+-- tags: thêm tag mới không cần nạp lại (tag chưa có trong cache được tra DB), chỉ sửa/xóa
+DROP TRIGGER IF EXISTS tags_bump_reference_version ON tags;
+CREATE TRIGGER tags_bump_reference_version
+    AFTER UPDATE OR DELETE OR TRUNCATE ON tags
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_reference_version('tags');
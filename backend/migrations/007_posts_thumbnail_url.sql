@@ -0,0 +1,3 @@
+-- Bản thumbnail của ảnh bài viết (tạo khi /posts/upload-image, xem image_variants.py).
+-- Feed, /posts/pinpreview và ảnh preview cụm pin dùng thumbnail_url, bài cũ (NULL) dùng image_url.
+ALTER TABLE posts ADD COLUMN IF NOT EXISTS thumbnail_url TEXT;
@@ -0,0 +1,12 @@
+-- Ảnh đã lưu trên Supabase Storage, khóa theo sha256 nội dung file client gửi lên.
+-- /posts/upload-image tra bảng này trước: ảnh đã có thì trả lại URL cũ, không xử lý / upload lại.
+-- Ảnh mới được lưu ở posts/<sha256>/<bản>.webp (hoặc posts/<sha256>.<ext> nếu không tạo được bản nhỏ).
+-- Ảnh upload trước đó (posts/<uuid>.<ext>): python uploads.py backfill
+CREATE TABLE IF NOT EXISTS image_objects (
+    sha256        TEXT PRIMARY KEY,
+    path          TEXT NOT NULL,      -- path trong bucket của bản full / ảnh gốc
+    url           TEXT NOT NULL,      -- public URL của path
+    feed_url      TEXT,               -- NULL nếu không có bản nhỏ (ảnh cũ, định dạng Pillow không đọc được)
+    thumbnail_url TEXT,
+    created_at    TIMESTAMPTZ NOT NULL DEFAULT now()
+);
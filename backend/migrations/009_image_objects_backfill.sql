@@ -0,0 +1,9 @@
+-- Tiến độ của python uploads.py backfill: mỗi file đã đọc trong bucket một dòng.
+-- Chạy lại backfill bỏ qua các file đã băm xong (kể cả file trùng nội dung với file khác),
+-- chỉ thử lại các file lỗi (error khác NULL).
+CREATE TABLE IF NOT EXISTS image_objects_backfill (
+    path       TEXT PRIMARY KEY,
+    sha256     TEXT,              -- NULL nếu lỗi
+    error      TEXT,
+    scanned_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
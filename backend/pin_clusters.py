@@ -0,0 +1,146 @@
+"""
+Cụm pin nhiều mức zoom cho màn hình bản đồ (/pins/clusters).
+
+Mỗi mức zoom z chia bản đồ Web Mercator thành lưới ô rộng CLUSTER_RADIUS_PX pixel
+(tile 256px). Mỗi ô giữ số pin, tổng tọa độ (để tính tâm), 1 pin mẫu và 1 ảnh preview.
+Kinh độ của tâm là trung bình trên vòng tròn (cộng sin/cos rồi atan2): pin ở +179 và -179
+cho tâm ở 180 chứ không phải 0.
+Thêm 1 pin chỉ cập nhật đúng 1 ô ở mỗi mức zoom, nên cây cụm được giữ cập nhật
+theo từng pin thay vì tính lại toàn bộ.
+"""
+from math import atan2, cos, degrees, floor, log, pi, radians, sin, tan
+from os import getenv
+
+CLUSTER_MAX_ZOOM = int(getenv("CLUSTER_MAX_ZOOM", "16"))
+CLUSTER_RADIUS_PX = int(getenv("CLUSTER_RADIUS_PX", "60"))
+TILE_SIZE = 256
+MAX_MERCATOR_LAT = 85.05112878
+
+
+def cells_per_axis(zoom: int) -> int:
+    return max(1, (TILE_SIZE << zoom) // CLUSTER_RADIUS_PX)
+
+
+def project(lat: float, lng: float) -> tuple[float, float]:
+    """(lat, lng) -> (x, y) trong [0, 1) theo Web Mercator."""
+    lat = max(-MAX_MERCATOR_LAT, min(MAX_MERCATOR_LAT, lat))
+    x = (lng + 180.0) / 360.0
+    y = (1.0 - log(tan(radians(lat)) + 1.0 / cos(radians(lat))) / pi) / 2.0
+    return min(max(x, 0.0), 0.999999999), min(max(y, 0.0), 0.999999999)
+
+
+class _Cell:
+    __slots__ = ("count", "sum_lat", "sum_lng_sin", "sum_lng_cos", "sample_pin_id", "preview_image_url")
+
+    def __init__(self, pin_id: int):
+        self.count = 0
+        self.sum_lat = 0.0
+        self.sum_lng_sin = 0.0
+        self.sum_lng_cos = 0.0
+        self.sample_pin_id = pin_id
+        self.preview_image_url = None
+
+
+class ClusterHierarchy:
+    """
+    Pin mẫu của mỗi ô giống hệt nhánh SQL trong pins.py: pin_id nhỏ nhất trong số các pin
+    có bài viết (không có thì pin_id nhỏ nhất), ảnh preview là ảnh bài mới nhất của pin đó.
+    """
+
+    def __init__(self, max_zoom: int):
+        self.max_zoom = max_zoom
+        self._levels: list[dict[tuple[int, int], _Cell]] = [{} for _ in range(max_zoom + 1)]
+        self._pins: dict[int, tuple[float, float]] = {}
+        self._images: dict[int, str] = {}  # pin_id -> ảnh bài mới nhất
+
+    def _cell_key(self, zoom: int, x: float, y: float) -> tuple[int, int]:
+        n = cells_per_axis(zoom)
+        return floor(x * n), floor(y * n)
+
+    def _is_better_sample(self, cell: _Cell, pin_id: int) -> bool:
+        has_image = pin_id in self._images
+        sample_has_image = cell.sample_pin_id in self._images
+        if has_image != sample_has_image:
+            return has_image
+        return pin_id < cell.sample_pin_id
+
+    def _set_sample(self, cell: _Cell, pin_id: int):
+        cell.sample_pin_id = pin_id
+        cell.preview_image_url = self._images.get(pin_id)
+
+    def add_pin(self, pin_id: int, lat: float, lng: float, image_url: str | None = None):
+        if pin_id in self._pins:
+            self.set_preview(pin_id, image_url)
+            return
+        lat, lng = float(lat), float(lng)
+        self._pins[pin_id] = (lat, lng)
+        if image_url:
+            self._images[pin_id] = image_url
+        x, y = project(lat, lng)
+        lng_sin, lng_cos = sin(radians(lng)), cos(radians(lng))
+        for zoom, level in enumerate(self._levels):
+            key = self._cell_key(zoom, x, y)
+            cell = level.get(key)
+            if cell is None:
+                cell = level[key] = _Cell(pin_id)
+                self._set_sample(cell, pin_id)
+            elif self._is_better_sample(cell, pin_id):
+                self._set_sample(cell, pin_id)
+            cell.count += 1
+            cell.sum_lat += lat
+            cell.sum_lng_sin += lng_sin
+            cell.sum_lng_cos += lng_cos
+
+    def set_preview(self, pin_id: int, image_url: str | None):
+        """Pin vừa có bài viết mới có ảnh -> cập nhật ảnh của pin, có thể thành pin mẫu của ô."""
+        if not image_url or pin_id not in self._pins:
+            return
+        self._images[pin_id] = image_url
+        x, y = project(*self._pins[pin_id])
+        for zoom, level in enumerate(self._levels):
+            cell = level[self._cell_key(zoom, x, y)]
+            if cell.sample_pin_id == pin_id or self._is_better_sample(cell, pin_id):
+                self._set_sample(cell, pin_id)
+
+    def _keys(self, zoom: int, min_lat: float, min_lng: float, max_lat: float, max_lng: float):
+        level = self._levels[zoom]
+        min_x, max_y = project(min_lat, min_lng)
+        max_x, min_y = project(max_lat, max_lng)
+        min_i, min_j = self._cell_key(zoom, min_x, min_y)
+        max_i, max_j = self._cell_key(zoom, max_x, max_y)
+
+        if (max_i - min_i + 1) * (max_j - min_j + 1) > len(level):
+            return [key for key in level if min_i <= key[0] <= max_i and min_j <= key[1] <= max_j]
+        return [
+            (i, j)
+            for i in range(min_i, max_i + 1)
+            for j in range(min_j, max_j + 1)
+            if (i, j) in level
+        ]
+
+    def query(self, min_lat: float, min_lng: float, max_lat: float, max_lng: float, zoom: int) -> list[dict]:
+        """Khung nhìn vượt kinh tuyến 180 (min_lng > max_lng) được tách thành 2 khoảng kinh độ."""
+        zoom = max(0, min(zoom, self.max_zoom))
+        level = self._levels[zoom]
+        if min_lng <= max_lng:
+            keys = self._keys(zoom, min_lat, min_lng, max_lat, max_lng)
+        else:
+            # Ở zoom thấp một ô có thể nằm trong cả 2 khoảng -> bỏ trùng, giữ thứ tự
+            keys = dict.fromkeys(
+                self._keys(zoom, min_lat, min_lng, max_lat, 180.0)
+                + self._keys(zoom, min_lat, -180.0, max_lat, max_lng)
+            )
+
+        return [
+            {
+                "latitude": cell.sum_lat / cell.count,
+                "longitude": degrees(atan2(cell.sum_lng_sin, cell.sum_lng_cos)),
+                "count": cell.count,
+                "sample_pin_id": cell.sample_pin_id,
+                "preview_image_url": cell.preview_image_url,
+            }
+            for cell in (level[key] for key in keys)
+        ]
+
+
+CLUSTERS = ClusterHierarchy(CLUSTER_MAX_ZOOM)
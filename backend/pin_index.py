@@ -0,0 +1,207 @@
+"""
+Index không gian trong bộ nhớ cho bảng pins.
+
+Pins nhỏ (id, lat, lng, created_at), đọc nhiều hơn ghi rất nhiều, nên mỗi worker
+giữ một lưới (grid) ô CELL_DEGREES độ -> danh sách pin_id và trả lời các truy vấn
+in-radius / nearest / annulus mà không phải xuống Postgres.
+
+- Nạp toàn bộ khi app khởi động (lifespan trong main.py).
+- Worker tự thêm pin do chính nó tạo (/pins/insert, get-or-create).
+- Pin do worker khác tạo được kéo về định kỳ bằng truy vấn delta theo pin_id.
+
+Cây cụm pin cho /pins/clusters (pin_clusters.py) được cập nhật cùng lúc với index và
+luôn được dùng (clusters_ready). PIN_INDEX_ENABLED=1 chỉ bật việc trả lời in-radius /
+nearest / find-random từ lưới trong bộ nhớ (ready); tắt thì các endpoint đó truy vấn SQL.
+"""
+import asyncio
+import random
+from datetime import datetime
+from math import floor
+from os import getenv
+
+from geo import bounding_box, haversine_m
+from pin_clusters import CLUSTERS
+
+PIN_INDEX_ENABLED = getenv("PIN_INDEX_ENABLED", "0") == "1"
+PIN_INDEX_CELL_DEGREES = float(getenv("PIN_INDEX_CELL_DEGREES", "0.01"))  # ~1.1km theo vĩ độ
+PIN_INDEX_REFRESH_SECONDS = float(getenv("PIN_INDEX_REFRESH_SECONDS", "5"))
+# pin_id là serial nhưng transaction có id nhỏ hơn có thể commit sau id lớn hơn,
+# nên mỗi lần refresh đọc lùi lại một đoạn để không bỏ sót (add() là idempotent)
+PIN_INDEX_REFRESH_LOOKBACK = int(getenv("PIN_INDEX_REFRESH_LOOKBACK", "200"))
+
+
+class PinGridIndex:
+    def __init__(self, cell_degrees: float):
+        self.cell_degrees = cell_degrees
+        self._pins: dict[int, tuple[float, float, datetime | None]] = {}
+        self._cells: dict[tuple[int, int], list[int]] = {}
+        self.max_pin_id = 0
+        self.loaded = False
+
+    def __len__(self) -> int:
+        return len(self._pins)
+
+    def _cell(self, lat: float, lng: float) -> tuple[int, int]:
+        return floor(lat / self.cell_degrees), floor(lng / self.cell_degrees)
+
+    def add(self, pin_id: int, lat: float, lng: float, created_at: datetime | None = None):
+        if pin_id in self._pins:
+            return
+        lat, lng = float(lat), float(lng)
+        self._pins[pin_id] = (lat, lng, created_at)
+        self._cells.setdefault(self._cell(lat, lng), []).append(pin_id)
+        self.max_pin_id = max(self.max_pin_id, pin_id)
+
+    def _candidates(self, lat: float, lng: float, radius_m: float):
+        """pin_id nằm trong các ô giao với bounding box của hình tròn."""
+        min_lat, max_lat, min_lng, max_lng = bounding_box(lat, lng, radius_m)
+        min_i, min_j = self._cell(min_lat, min_lng)
+        max_i, max_j = self._cell(max_lat, max_lng)
+
+        # Vùng quá rộng so với số pin -> duyệt thẳng danh sách pin còn nhanh hơn duyệt ô
+        if (max_i - min_i + 1) * (max_j - min_j + 1) > len(self._pins):
+            yield from self._pins
+            return
+
+        for i in range(min_i, max_i + 1):
+            for j in range(min_j, max_j + 1):
+                yield from self._cells.get((i, j), ())
+
+    def within(self, lat: float, lng: float, min_m: float, max_m: float) -> list[tuple[int, float]]:
+        """[(pin_id, khoảng cách)] với min_m <= khoảng cách <= max_m."""
+        result = []
+        for pin_id in self._candidates(lat, lng, max_m):
+            pin_lat, pin_lng, _ = self._pins[pin_id]
+            distance = haversine_m(lat, lng, pin_lat, pin_lng)
+            if min_m <= distance <= max_m:
+                result.append((pin_id, distance))
+        return result
+
+    def nearest(self, lat: float, lng: float, radius_m: float | None = None) -> tuple[int, float] | None:
+        """Pin gần nhất trong radius_m (None = không giới hạn, nới dần bán kính)."""
+        if not self._pins:
+            return None
+        search_m = radius_m if radius_m is not None else self.cell_degrees * 111_000
+        while True:
+            found = self.within(lat, lng, 0, search_m)
+            if found:
+                return min(found, key=lambda item: item[1])
+            if radius_m is not None or search_m > 20_100_000:  # nửa chu vi Trái Đất
+                return None
+            search_m *= 4
+
+    def random_between(self, lat: float, lng: float, min_m: float, max_m: float) -> tuple[int, float] | None:
+        found = self.within(lat, lng, min_m, max_m)
+        return random.choice(found) if found else None
+
+    def row(self, pin_id: int, distance: float | None = None) -> dict:
+        lat, lng, created_at = self._pins[pin_id]
+        row = {"pin_id": pin_id, "latitude": lat, "longitude": lng, "created_at": created_at}
+        if distance is not None:
+            row["distance_meters"] = distance
+        return row
+
+
+INDEX = PinGridIndex(PIN_INDEX_CELL_DEGREES)
+_max_post_id = 0
+
+
+def ready() -> bool:
+    return PIN_INDEX_ENABLED and INDEX.loaded
+
+
+def clusters_ready() -> bool:
+    return INDEX.loaded
+
+
+def add_pin(pin_id: int, lat: float, lng: float, created_at: datetime | None = None, image_url: str | None = None):
+    INDEX.add(pin_id, lat, lng, created_at)
+    CLUSTERS.add_pin(pin_id, lat, lng, image_url)
+
+
+def add_post_image(pin_id: int, image_url: str | None):
+    CLUSTERS.set_preview(pin_id, image_url)
+
+
+def _add_pin_rows(rows):
+    for row in rows:
+        add_pin(row["pin_id"], row["latitude"], row["longitude"], row["created_at"], row["image_url"])
+
+
+async def refresh(pool, since_pin_id: int) -> int:
+    """Nạp các pin có pin_id > since_pin_id và ảnh của bài viết mới, trả về số pin mới."""
+    global _max_post_id
+    before = len(INDEX)
+    async with pool.connection() as connection:
+        async with connection.cursor() as cur:
+            await cur.execute(
+                """
+                SELECT p.pin_id, p.latitude, p.longitude, p.created_at, img.image_url
+                FROM pins p
+                LEFT JOIN LATERAL (
+                    SELECT COALESCE(thumbnail_url, image_url) AS image_url
+                    FROM posts
+                    WHERE posts.pin_id = p.pin_id
+                    ORDER BY created_at DESC
+                    LIMIT 1
+                ) img ON true
+                WHERE p.pin_id > %s
+                ORDER BY p.pin_id;
+                """,
+                (since_pin_id,)
+            )
+            _add_pin_rows(await cur.fetchall())
+
+            # Bài viết mới (của worker khác) vào pin đã có -> cập nhật ảnh preview của cụm
+            await cur.execute(
+                """
+                SELECT post_id, pin_id, COALESCE(thumbnail_url, image_url) AS image_url
+                FROM posts
+                WHERE post_id > %s
+                ORDER BY post_id;
+                """,
+                (max(0, _max_post_id - PIN_INDEX_REFRESH_LOOKBACK),)
+            )
+            for row in await cur.fetchall():
+                add_post_image(row["pin_id"], row["image_url"])
+                _max_post_id = max(_max_post_id, row["post_id"])
+    return len(INDEX) - before
+
+
+async def load(pool):
+    """Nạp toàn bộ pin, mỗi pin kèm ảnh của bài mới nhất (không đọc lại cả bảng posts)."""
+    global _max_post_id
+    async with pool.connection() as connection:
+        async with connection.cursor() as cur:
+            # Lấy mốc post_id trước: bài đăng sau mốc này sẽ được refresh đọc lại
+            await cur.execute("SELECT COALESCE(max(post_id), 0) AS max_post_id FROM posts;")
+            max_post_id = (await cur.fetchone())["max_post_id"]
+            await cur.execute(
+                """
+                SELECT p.pin_id, p.latitude, p.longitude, p.created_at, latest.image_url
+                FROM pins p
+                LEFT JOIN (
+                    SELECT DISTINCT ON (pin_id) pin_id, COALESCE(thumbnail_url, image_url) AS image_url
+                    FROM posts
+                    ORDER BY pin_id, created_at DESC
+                ) latest ON latest.pin_id = p.pin_id
+                ORDER BY p.pin_id;
+                """
+            )
+            _add_pin_rows(await cur.fetchall())
+    _max_post_id = max(_max_post_id, max_post_id)
+    INDEX.loaded = True
+    print(f"[pin_index] Đã nạp {len(INDEX)} pin")
+
+
+async def refresh_forever(pool):
+    while True:
+        await asyncio.sleep(PIN_INDEX_REFRESH_SECONDS)
+        try:
+            # Lần nạp lúc khởi động lỗi (Postgres chưa sẵn sàng...) -> nạp lại từ đầu
+            if not INDEX.loaded:
+                await load(pool)
+            else:
+                await refresh(pool, max(0, INDEX.max_pin_id - PIN_INDEX_REFRESH_LOOKBACK))
+        except Exception as e:
+            print(f"[pin_index] Refresh lỗi: {e}")
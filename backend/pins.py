@@ -1,7 +1,9 @@
-from fastapi import APIRouter, HTTPException
-from connection import get_database_connection
-from pydantic import BaseModel
-import random
+from fastapi import APIRouter, Depends, HTTPException
+from connection import async_db_connection, get_async_db
+from geo import bounding_box
+import pin_index
+from pin_clusters import CLUSTER_MAX_ZOOM, MAX_MERCATOR_LAT, cells_per_axis
+from pydantic import BaseModel, Field
 from math import atan2, degrees
 
 router = APIRouter(
@@ -9,6 +11,26 @@ router = APIRouter(
     tags=["pins"]
 )
 
+# Khoảng cách (m) từ (%(lat)s, %(lng)s) tới pin p theo định luật cos mặt cầu.
+# LEAST/GREATEST giữ đối số của acos trong [-1, 1] khi 2 điểm trùng nhau.
+DISTANCE_SQL = """
+    (
+        6371000 * acos(
+            LEAST(1.0, GREATEST(-1.0,
+                cos(radians(%(lat)s)) * cos(radians(p.latitude::double precision)) *
+                cos(radians(p.longitude::double precision) - radians(%(lng)s)) +
+                sin(radians(%(lat)s)) * sin(radians(p.latitude::double precision))
+            ))
+        )
+    )
+"""
+
+# Lọc thô theo bounding box, khớp với index pins_latitude_longitude_idx (migrations/003)
+BBOX_FILTER_SQL = """
+    p.latitude::double precision BETWEEN %(min_lat)s AND %(max_lat)s
+    AND p.longitude::double precision BETWEEN %(min_lng)s AND %(max_lng)s
+"""
+
 # ==================================================
 #              TẠO MỘT GHIM MỚI
 # ==================================================
@@ -21,24 +43,23 @@ class InsertPinSuccess(BaseModel):
     insert_pin_success: bool = True
 
 @router.post("/insert")
-def insert(body: InsertPinRequest):
-    connection = get_database_connection()
-    try:
-        with connection.cursor() as cur:
-            # Check username exists
-            cur.execute(
-                """
-                INSERT INTO pins (latitude, longitude)
-                VALUES (%s, %s)
-                """,
-                (body.latitude,body.longitude)
-            )
-            
-        connection.commit()
-        return InsertPinSuccess()
+async def insert(body: InsertPinRequest, connection = Depends(get_async_db)):
+    async with connection.cursor() as cur:
+        # Check username exists
+        await cur.execute(
+            """
+            INSERT INTO pins (latitude, longitude)
+            VALUES (%s, %s)
+            RETURNING pin_id, created_at;
+            """,
+            (body.latitude,body.longitude)
+        )
+        new_pin = await cur.fetchone()
+        
+    await connection.commit()
+    pin_index.add_pin(new_pin["pin_id"], body.latitude, body.longitude, new_pin["created_at"])
+    return InsertPinSuccess()
 
-    finally:
-        connection.close()
         
 # ==================================================
 #              LẤY DANH SÁCH GHIM THEO USER_ID
@@ -48,23 +69,19 @@ class GetPinListByUserIdRequest(BaseModel):
     user_id: int
 
 @router.post("/get/user-id")
-def get_pins_by_user_id(body: GetPinListByUserIdRequest):
-    connection = get_database_connection()
-    try:
-        with connection.cursor() as cur:
-            cur.execute(
-                """
-                SELECT pins.*
-                FROM pins
-                INNER JOIN user_pins ON pins.pin_id = user_pins.pin_id
-                WHERE user_pins.user_id = %s;
-                """,
-                (body.user_id,)  
-            )
-            pins = cur.fetchall()   
-        return pins
-    finally:
-        connection.close()
+async def get_pins_by_user_id(body: GetPinListByUserIdRequest, connection = Depends(get_async_db)):
+    async with connection.cursor() as cur:
+        await cur.execute(
+            """
+            SELECT pins.*
+            FROM pins
+            INNER JOIN user_pins ON pins.pin_id = user_pins.pin_id
+            WHERE user_pins.user_id = %s;
+            """,
+            (body.user_id,)  
+        )
+        pins = await cur.fetchall()   
+    return pins
 
 # ==================================================
 #       LẤY DANH SÁCH GHIM TRONG VÙNG BÁN KÍNH
@@ -77,36 +94,34 @@ class GetPinsInRadiusRequest(BaseModel):
 
 
 @router.post("/get/in-radius")
-def get_pins_in_radius(body: GetPinsInRadiusRequest):
-    connection = get_database_connection()
-    try:
-        with connection.cursor() as cur:
-            # Haversine: tính khoảng cách giữa (center_lat, center_lng) và (p.latitude, p.longitude)
-            # 6371000: bán kính Trái Đất ~ 6,371km (đơn vị mét)
-            cur.execute(
-                """
-                SELECT *
-                FROM pins p
-                WHERE (
-                    6371000 * acos(
-                        cos(radians(%s)) * cos(radians(p.latitude::double precision)) *
-                        cos(radians(p.longitude::double precision) - radians(%s)) +
-                        sin(radians(%s)) * sin(radians(p.latitude::double precision))
-                    )
-                  ) <= %s;
-                """,
-                (
-                    body.center_lat,        # %s thứ 2: lat tâm
-                    body.center_lng,        # %s thứ 3: lng tâm
-                    body.center_lat,        # %s thứ 4: lat tâm
-                    body.radius_meters      # %s thứ 5: bán kính (m)
-                )
-            )
+async def get_pins_in_radius(body: GetPinsInRadiusRequest):
+    if pin_index.ready():
+        return [
+            pin_index.INDEX.row(pin_id)
+            for pin_id, _ in pin_index.INDEX.within(body.center_lat, body.center_lng, 0, body.radius_meters)
+        ]
 
-            pins = cur.fetchall()
-            return pins
-    finally:
-        connection.close()
+    min_lat, max_lat, min_lng, max_lng = bounding_box(body.center_lat, body.center_lng, body.radius_meters)
+    async with async_db_connection() as connection, connection.cursor() as cur:
+        # Lọc thô bằng bounding box (dùng index), rồi mới tính khoảng cách chính xác
+        await cur.execute(
+            f"""
+            SELECT *
+            FROM pins p
+            WHERE {BBOX_FILTER_SQL}
+              AND {DISTANCE_SQL} <= %(radius)s;
+            """,
+            {
+                "lat": body.center_lat,
+                "lng": body.center_lng,
+                "radius": body.radius_meters,
+                "min_lat": min_lat, "max_lat": max_lat,
+                "min_lng": min_lng, "max_lng": max_lng,
+            }
+        )
+
+        pins = await cur.fetchall()
+        return pins
 
 # ==================================================
 #   TÌM HOẶC TẠO PIN DựA TRÊN TỌA ĐỘ
@@ -122,78 +137,77 @@ class PinByCoordResponse(BaseModel):
     is_new_pin: bool  # True nếu tạo pin mới, False nếu dùng pin có sẵn
 
 @router.post("/get-or-create-by-coord")
-def add_post_into_pin_by_coord(body: PinByCoordRequest):
+async def add_post_into_pin_by_coord(body: PinByCoordRequest):
     """
     Tìm pin gần nhất trong bán kính cho trước.
     Nếu không tìm thấy -> tạo pin mới tại tọa độ đó.
     Trả về pin_id để sử dụng khi tạo post.
     """
-    connection = get_database_connection()
-    try:
-        with connection.cursor() as cur:
-            # 1. Tìm pin gần nhất trong bán kính
-            cur.execute(
-                """
+    if pin_index.ready():
+        nearest = pin_index.INDEX.nearest(body.center_lat, body.center_lng, body.radius_meters)
+        if nearest:
+            return PinByCoordResponse(pin_id=nearest[0], is_new_pin=False)
+        async with async_db_connection() as connection, connection.cursor() as cur:
+            return await _create_pin(connection, cur, body.center_lat, body.center_lng)
+
+    async with async_db_connection() as connection, connection.cursor() as cur:
+        # 1. Tìm pin gần nhất trong bán kính (lọc thô bằng bounding box trước)
+        min_lat, max_lat, min_lng, max_lng = bounding_box(body.center_lat, body.center_lng, body.radius_meters)
+        await cur.execute(
+            f"""
+            SELECT *
+            FROM (
                 SELECT 
                     p.pin_id,
-                    (
-                        6371000 * acos(
-                            cos(radians(%s)) * cos(radians(p.latitude::double precision)) *
-                            cos(radians(p.longitude::double precision) - radians(%s)) +
-                            sin(radians(%s)) * sin(radians(p.latitude::double precision))
-                        )
-                    ) AS distance_meters
+                    {DISTANCE_SQL} AS distance_meters
                 FROM pins p
-                WHERE (
-                    6371000 * acos(
-                        cos(radians(%s)) * cos(radians(p.latitude::double precision)) *
-                        cos(radians(p.longitude::double precision) - radians(%s)) +
-                        sin(radians(%s)) * sin(radians(p.latitude::double precision))
-                    )
-                ) <= %s
-                ORDER BY distance_meters ASC
-                LIMIT 1;
-                """,
-                (
-                    body.center_lat,        # %s thứ 1
-                    body.center_lng,        # %s thứ 2
-                    body.center_lat,        # %s thứ 3
-                    body.center_lat,        # %s thứ 4
-                    body.center_lng,        # %s thứ 5
-                    body.center_lat,        # %s thứ 6
-                    body.radius_meters      # %s thứ 7
-                )
-            )
-
-            existing_pin = cur.fetchone()
-
-            # 2. Nếu tìm thấy pin → trả về pin_id có sẵn
-            if existing_pin:
-                return PinByCoordResponse(
-                    pin_id=existing_pin["pin_id"],
-                    is_new_pin=False
-                )
-
-            # 3. Nếu không tìm thấy → tạo pin mới
-            cur.execute(
-                """
-                INSERT INTO pins (latitude, longitude)
-                VALUES (%s, %s)
-                RETURNING pin_id;
-                """,
-                (body.center_lat, body.center_lng)
-            )
+                WHERE {BBOX_FILTER_SQL}
+            ) candidates
+            WHERE distance_meters <= %(radius)s
+            ORDER BY distance_meters ASC
+            LIMIT 1;
+            """,
+            {
+                "lat": body.center_lat,
+                "lng": body.center_lng,
+                "radius": body.radius_meters,
+                "min_lat": min_lat, "max_lat": max_lat,
+                "min_lng": min_lng, "max_lng": max_lng,
+            }
+        )
 
-            new_pin = cur.fetchone()
-            connection.commit()
+        existing_pin = await cur.fetchone()
 
+        # 2. Nếu tìm thấy pin → trả về pin_id có sẵn
+        if existing_pin:
             return PinByCoordResponse(
-                pin_id=new_pin["pin_id"],
-                is_new_pin=True
+                pin_id=existing_pin["pin_id"],
+                is_new_pin=False
             )
 
-    finally:
-        connection.close()
+        # 3. Nếu không tìm thấy → tạo pin mới
+        return await _create_pin(connection, cur, body.center_lat, body.center_lng)
+
+
+async def _create_pin(connection, cur, lat: float, lng: float) -> PinByCoordResponse:
+    await cur.execute(
+        """
+        INSERT INTO pins (latitude, longitude)
+        VALUES (%s, %s)
+        RETURNING pin_id, created_at;
+        """,
+        (lat, lng)
+    )
+
+    new_pin = await cur.fetchone()
+    await connection.commit()
+    pin_index.add_pin(new_pin["pin_id"], lat, lng, new_pin["created_at"])
+
+    return PinByCoordResponse(
+        pin_id=new_pin["pin_id"],
+        is_new_pin=True
+    )
+
 
 
 
@@ -214,109 +228,170 @@ class RandomPinResponse(BaseModel):
 
 
 @router.post("/find-random")
-def find_random_pin(body: FindRandomPinRequest):
+async def find_random_pin(body: FindRandomPinRequest):
     """
     Tìm một pin ngẫu nhiên có khoảng cách gần với target_distance nhất
     trong phạm vi ±50% của target_distance
     """
-    connection = get_database_connection()
-    try:
-        with connection.cursor() as cur:
-            # Tìm tất cả pins trong khoảng target_distance ±50%
-            min_distance = body.target_distance * 0.5
-            max_distance = body.target_distance * 1.5
-            
-            # Sử dụng GREATEST để tránh acos > 1 hoặc < -1 gây lỗi
-            cur.execute(
-                """
-                WITH distance_calc AS (
-                    SELECT 
+    # Tìm tất cả pins trong khoảng target_distance ±50%
+    min_distance = body.target_distance * 0.5
+    max_distance = body.target_distance * 1.5
+
+    if pin_index.ready():
+        selected = (
+            pin_index.INDEX.random_between(body.user_lat, body.user_lng, min_distance, max_distance)
+            or pin_index.INDEX.nearest(body.user_lat, body.user_lng)
+        )
+        if selected is None:
+            raise HTTPException(status_code=404, detail="Không tìm thấy pin nào trong hệ thống")
+        pin = pin_index.INDEX.row(*selected)
+        return RandomPinResponse(
+            pin_id=pin["pin_id"],
+            latitude=pin["latitude"],
+            longitude=pin["longitude"],
+            actual_distance=pin["distance_meters"]
+        )
+
+    async with async_db_connection() as connection, connection.cursor() as cur:
+        # 1 truy vấn duy nhất:
+        #  - nhánh 1: lọc thô vành khuyên bằng bounding box (index), lọc đúng khoảng cách,
+        #    chọn ngẫu nhiên 1 pin ngay trong SQL thay vì kéo hết về Python
+        #  - nhánh 2: pin gần nhất, chỉ được Postgres chạy khi nhánh 1 rỗng (UNION ALL + LIMIT 1)
+        min_lat, max_lat, min_lng, max_lng = bounding_box(body.user_lat, body.user_lng, max_distance)
+        await cur.execute(
+            f"""
+            (
+                SELECT *
+                FROM (
+                    SELECT
                         p.pin_id,
                         p.latitude,
                         p.longitude,
-                        (
-                            6371000 * acos(
-                                LEAST(1.0, GREATEST(-1.0,
-                                    cos(radians(%s)) * cos(radians(p.latitude)) *
-                                    cos(radians(p.longitude) - radians(%s)) +
-                                    sin(radians(%s)) * sin(radians(p.latitude))
-                                ))
-                            )
-                        ) AS distance_meters
+                        {DISTANCE_SQL} AS distance_meters
                     FROM pins p
-                )
-                SELECT 
-                    pin_id,
-                    latitude,
-                    longitude,
-                    distance_meters
-                FROM distance_calc
-                WHERE distance_meters BETWEEN %s AND %s
-                ORDER BY distance_meters;
-                """,
-                (
-                    body.user_lat, body.user_lng, body.user_lat,
-                    min_distance, max_distance
-                )
+                    WHERE {BBOX_FILTER_SQL}
+                ) band
+                WHERE distance_meters BETWEEN %(min_distance)s AND %(max_distance)s
+                ORDER BY random()
+                LIMIT 1
+            )
+            UNION ALL
+            (
+                SELECT
+                    p.pin_id,
+                    p.latitude,
+                    p.longitude,
+                    {DISTANCE_SQL} AS distance_meters
+                FROM pins p
+                ORDER BY distance_meters
+                LIMIT 1
             )
-            
-            pins = cur.fetchall()
-            
-            # Log để debug
-            print(f"[DEBUG] Target: {body.target_distance}m, Range: {min_distance:.0f}-{max_distance:.0f}m")
-            print(f"[DEBUG] Found {len(pins)} pins")
-           
-            if not pins:
-                # Nếu không tìm thấy pin nào trong phạm vi, tìm 1 pin gần nhất
-                print("[DEBUG] No pins in range, finding nearest...")
-                cur.execute(
-                    """
-                    WITH distance_calc AS (
-                        SELECT 
-                            p.pin_id,
-                            p.latitude,
-                            p.longitude,
-                            (
-                                6371000 * acos(
-                                    LEAST(1.0, GREATEST(-1.0,
-                                        cos(radians(%s)) * cos(radians(p.latitude)) *
-                                        cos(radians(p.longitude) - radians(%s)) +
-                                        sin(radians(%s)) * sin(radians(p.latitude))
-                                    ))
-                                )
-                            ) AS distance_meters
-                        FROM pins p
-                    )
-                    SELECT 
-                        pin_id,
-                        latitude,
-                        longitude,
-                        distance_meters
-                    FROM distance_calc
-                    ORDER BY distance_meters
-                    LIMIT 1;
-                    """,
-                    (body.user_lat, body.user_lng, body.user_lat)
-                )
-                pins = cur.fetchall()
-                
-                if pins:
-                    print(f"[DEBUG] Nearest pins")
-            
-            if not pins:
-                raise HTTPException(status_code=404, detail="Không tìm thấy pin nào trong hệ thống")
-            
-            # Chọn ngẫu nhiên một pin từ danh sách
-            selected_pin = random.choice(pins)
-            
-            print(f"[DEBUG] Selected pin {selected_pin['pin_id']} at {selected_pin['distance_meters']:.0f}m")
-            
-            return RandomPinResponse(
-                pin_id=selected_pin["pin_id"],
-                latitude=float(selected_pin["latitude"]),
-                longitude=float(selected_pin["longitude"]),
-                actual_distance=float(selected_pin["distance_meters"])
+            LIMIT 1;
+            """,
+            {
+                "lat": body.user_lat,
+                "lng": body.user_lng,
+                "min_distance": min_distance,
+                "max_distance": max_distance,
+                "min_lat": min_lat, "max_lat": max_lat,
+                "min_lng": min_lng, "max_lng": max_lng,
+            }
+        )
+        selected_pin = await cur.fetchone()
+
+    if selected_pin is None:
+        raise HTTPException(status_code=404, detail="Không tìm thấy pin nào trong hệ thống")
+
+    return RandomPinResponse(
+        pin_id=selected_pin["pin_id"],
+        latitude=float(selected_pin["latitude"]),
+        longitude=float(selected_pin["longitude"]),
+        actual_distance=float(selected_pin["distance_meters"])
+    )
+
+
+# ==================================================
+#   GOM CỤM PIN CHO MÀN HÌNH BẢN ĐỒ
+# ==================================================
+
+class PinClustersRequest(BaseModel):
+    min_lat: float
+    min_lng: float
+    max_lat: float
+    max_lng: float
+    zoom: int = Field(ge=0, le=22)  # Mức zoom của bản đồ, > CLUSTER_MAX_ZOOM dùng mức cao nhất
+
+class PinCluster(BaseModel):
+    latitude: float  # Tâm của cụm
+    longitude: float
+    count: int
+    sample_pin_id: int
+    preview_image_url: str | None = None
+
+
+@router.post("/clusters", response_model=list[PinCluster])
+async def get_pin_clusters(body: PinClustersRequest):
+    """
+    Trả về các cụm pin trong khung nhìn thay vì từng pin.
+    Đọc từ cây cụm dựng sẵn trong bộ nhớ; chỉ gom cụm bằng SQL khi cây chưa nạp được.
+    Khung nhìn vượt kinh tuyến 180 gửi min_lng > max_lng (vd. 170 -> -170).
+    """
+    if body.min_lat > body.max_lat:
+        raise HTTPException(status_code=400, detail="min_lat phải nhỏ hơn hoặc bằng max_lat")
+
+    if pin_index.clusters_ready():
+        return pin_index.CLUSTERS.query(body.min_lat, body.min_lng, body.max_lat, body.max_lng, body.zoom)
+
+    if body.min_lng <= body.max_lng:
+        lng_filter = "p.longitude::double precision BETWEEN %(min_lng)s AND %(max_lng)s"
+    else:
+        lng_filter = "(p.longitude::double precision >= %(min_lng)s OR p.longitude::double precision <= %(max_lng)s)"
+
+    zoom = min(body.zoom, CLUSTER_MAX_ZOOM)
+    async with async_db_connection() as connection, connection.cursor() as cur:
+        # Cùng lưới Web Mercator với pin_clusters.py, ảnh preview lấy từ bài mới nhất của pin mẫu
+        await cur.execute(
+            f"""
+            WITH points AS (
+                SELECT
+                    p.pin_id,
+                    p.latitude::double precision AS lat,
+                    p.longitude::double precision AS lng,
+                    LEAST(GREATEST(p.latitude::double precision, -%(max_mercator_lat)s), %(max_mercator_lat)s) AS mercator_lat,
+                    EXISTS (SELECT 1 FROM posts WHERE posts.pin_id = p.pin_id) AS has_post
+                FROM pins p
+                WHERE p.latitude::double precision BETWEEN %(min_lat)s AND %(max_lat)s
+                  AND {lng_filter}
+            ),
+            cells AS (
+                SELECT
+                    avg(lat) AS latitude,
+                    -- Trung bình trên vòng tròn như pin_clusters.py (đúng cả khi cụm vắt qua kinh tuyến 180)
+                    degrees(atan2(sum(sin(radians(lng))), sum(cos(radians(lng))))) AS longitude,
+                    count(*) AS count,
+                    -- Ưu tiên pin có bài viết để cụm có ảnh preview
+                    COALESCE(min(pin_id) FILTER (WHERE has_post), min(pin_id)) AS sample_pin_id
+                FROM points
+                -- Kẹp vào [0, cells - 1] như project() trong pin_clusters.py
+                GROUP BY
+                    LEAST(floor((lng + 180) / 360 * %(cells)s), %(cells)s - 1),
+                    LEAST(floor((1 - ln(tan(radians(mercator_lat)) + 1 / cos(radians(mercator_lat))) / pi()) / 2 * %(cells)s), %(cells)s - 1)
             )
-            
-    finally:
-        connection.close()
\ No newline at end of file
+            SELECT c.*, img.image_url AS preview_image_url
+            FROM cells c
+            LEFT JOIN LATERAL (
+                SELECT COALESCE(thumbnail_url, image_url) AS image_url
+                FROM posts
+                WHERE posts.pin_id = c.sample_pin_id
+                ORDER BY created_at DESC
+                LIMIT 1
+            ) img ON true;
+            """,
+            {
+                "min_lat": body.min_lat, "max_lat": body.max_lat,
+                "min_lng": body.min_lng, "max_lng": body.max_lng,
+                "max_mercator_lat": MAX_MERCATOR_LAT,
+                "cells": cells_per_axis(zoom),
+            }
+        )
+        return await cur.fetchall()
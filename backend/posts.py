@@ -1,10 +1,18 @@
-import os
-from fastapi import APIRouter, File, HTTPException, UploadFile
-from connection import get_database_connection
-from pydantic import BaseModel
-from psycopg2.extras import RealDictCursor
-import uuid
-from supabase import create_client, Client
+import asyncio
+import base64
+import json
+from datetime import datetime
+from fastapi import APIRouter, Depends, HTTPException, Request
+from cache import aget_tag_ids
+from connection import get_async_db
+from timeline import add_pin_to_timeline, fan_out_post, timeline_enabled
+import pin_index
+import uploads
+from sensitive import moderate_image_bytes
+from tag import top_labels
+import user_stats
+from pydantic import BaseModel, Field
+from typing import List
 
 router = APIRouter(
     prefix="/posts",
@@ -25,27 +33,27 @@ class InsertPostRequest(BaseModel):
     title: str
     body: str
     image_url: str
+    thumbnail_url: str | None = None  # từ /posts/upload-image
     status: str
 
 class InsertPostSuccess(BaseModel):
     insert_post_success: bool = True
     post_id: int
 @router.post("/insert", response_model=InsertPostSuccess)
-def insert_post(body: InsertPostRequest):
-    connection = get_database_connection()
+async def insert_post(body: InsertPostRequest, connection = Depends(get_async_db)):
     try:
-        with connection.cursor() as cur:
-            cur.execute(
+        async with connection.cursor() as cur:
+            await cur.execute(
                 """
-                INSERT INTO posts (pin_id, user_id, title, body, image_url, status)
-                VALUES (%s, %s, %s, %s, %s, %s)
+                INSERT INTO posts (pin_id, user_id, title, body, image_url, thumbnail_url, status)
+                VALUES (%s, %s, %s, %s, %s, %s, %s)
                 RETURNING post_id
                 """,
-                (body.pin_id, body.user_id, body.title, body.body, body.image_url, body.status),
+                (body.pin_id, body.user_id, body.title, body.body, body.image_url, body.thumbnail_url, body.status),
             )
-            post_id = cur.fetchone()["post_id"]
+            post_id = (await cur.fetchone())["post_id"]
 
-            cur.execute(
+            await cur.execute(
                 """
                 INSERT INTO user_pins (user_id, pin_id)
                 VALUES (%s, %s)
@@ -53,15 +61,23 @@ def insert_post(body: InsertPostRequest):
                 """,
                 (body.user_id, body.pin_id),
             )
+            is_new_user_pin = cur.rowcount > 0
+
+            await user_stats.bump(cur, body.user_id, post_count=1, pin_count=int(is_new_user_pin))
+
+            # Fan-out-on-write: đẩy bài vào timeline của những user đã lưu pin
+            if timeline_enabled():
+                if is_new_user_pin:
+                    await add_pin_to_timeline(cur, body.user_id, body.pin_id)
+                await fan_out_post(cur, post_id)
 
-        connection.commit()
+        await connection.commit()
+        pin_index.add_post_image(body.pin_id, body.thumbnail_url or body.image_url)
         return InsertPostSuccess(post_id=post_id)
 
     except Exception as e:
-        connection.rollback()
+        await connection.rollback()
         raise HTTPException(status_code=500, detail=f"DB error: {e}")
-    finally:
-        connection.close()
 
 
 
@@ -77,45 +93,45 @@ class CreateCommentRequest(BaseModel):
     child_of_comment_id: int | None = None
 
 @router.post("/comment")
-def create_comment(body: CreateCommentRequest):
-    connection = get_database_connection()
-    try:
-        with connection:
-            with connection.cursor() as cur:
-                # 1. Insert comment
-                cur.execute(
-                    """
-                    INSERT INTO comments (post_id, user_id, content, child_of_comment_id)
-                    VALUES (%s, %s, %s, %s)
-                    RETURNING comment_id, created_at;
-                    """,
-                    (body.post_id, body.user_id, body.content, body.child_of_comment_id,)
-                )
-
-                # 2. Update comment_count
-                cur.execute(
-                    """
-                    UPDATE posts
-                    SET comment_count = comment_count + 1
-                    WHERE post_id = %s;
-                    """,
-                    (body.post_id,)
-                )
-
-                # 3. Update users_tags for all tags of that post
-                cur.execute(
-                    """
-                    INSERT INTO users_tags (user_id, tag_id, cnt)
-                    SELECT %s AS user_id, pt.tag_id, 1
-                    FROM post_tags pt
-                    WHERE pt.post_id = %s
-                    ON CONFLICT (user_id, tag_id)
-                    DO UPDATE SET cnt = users_tags.cnt + 1;
-                    """,
-                    (body.user_id, body.post_id)
-                )
-    finally:
-        connection.close()
+async def create_comment(body: CreateCommentRequest, connection = Depends(get_async_db)):
+    async with connection.transaction():
+        async with connection.cursor() as cur:
+            # 1. Insert comment
+            await cur.execute(
+                """
+                INSERT INTO comments (post_id, user_id, content, child_of_comment_id)
+                VALUES (%s, %s, %s, %s)
+                RETURNING comment_id, created_at;
+                """,
+                (body.post_id, body.user_id, body.content, body.child_of_comment_id,)
+            )
+
+            # 2. Update comment_count
+            await cur.execute(
+                """
+                UPDATE posts
+                SET comment_count = comment_count + 1
+                WHERE post_id = %s;
+                """,
+                (body.post_id,)
+            )
+
+            # Bộ đếm: comment đã viết (người comment) + comment nhận được (tác giả bài)
+            await user_stats.bump(cur, body.user_id, comment_made_count=1)
+            await user_stats.bump_post_owner(cur, body.post_id, comment_received_count=1)
+
+            # 3. Update users_tags for all tags of that post
+            await cur.execute(
+                """
+                INSERT INTO users_tags (user_id, tag_id, cnt)
+                SELECT %s AS user_id, pt.tag_id, 1
+                FROM post_tags pt
+                WHERE pt.post_id = %s
+                ON CONFLICT (user_id, tag_id)
+                DO UPDATE SET cnt = users_tags.cnt + 1;
+                """,
+                (body.user_id, body.post_id)
+            )
 
 # ==================================================
 #       Tương tác thả tim với bài viết
@@ -126,49 +142,46 @@ class ReactionRequest(BaseModel):
     user_id: int
 
 @router.post("/react")
-def react_post(body: ReactionRequest):
-    connection = get_database_connection()
-    try:
-        with connection:
-            with connection.cursor() as cur:
-                # 1. Insert reaction nếu chưa có
-                cur.execute(
-                    """
-                    INSERT INTO reactions (post_id, user_id)
-                    VALUES (%s, %s)
-                    ON CONFLICT (post_id, user_id) DO NOTHING;
-                    """,
-                    (body.post_id, body.user_id)
-                )
-
-                # Nếu không insert được (đã tim rồi) thì không cần cộng nữa
-                if cur.rowcount == 0:
-                    return {"status": "already_reacted"}
-
-                # 2. Tăng reaction_count
-                cur.execute(
-                    """
-                    UPDATE posts
-                    SET reaction_count = reaction_count + 1
-                    WHERE post_id = %s;
-                    """,
-                    (body.post_id,)
-                )
-
-                # 3. Update users_tags cho tất cả tag của post
-                cur.execute(
-                    """
-                    INSERT INTO users_tags (user_id, tag_id, cnt)
-                    SELECT %s AS user_id, pt.tag_id, 1
-                    FROM post_tags pt
-                    WHERE pt.post_id = %s
-                    ON CONFLICT (user_id, tag_id)
-                    DO UPDATE SET cnt = users_tags.cnt + 1;
-                    """,
-                    (body.user_id, body.post_id)
-                )
-    finally:
-        connection.close()
+async def react_post(body: ReactionRequest, connection = Depends(get_async_db)):
+    async with connection.transaction():
+        async with connection.cursor() as cur:
+            # 1. Insert reaction nếu chưa có
+            await cur.execute(
+                """
+                INSERT INTO reactions (post_id, user_id)
+                VALUES (%s, %s)
+                ON CONFLICT (post_id, user_id) DO NOTHING;
+                """,
+                (body.post_id, body.user_id)
+            )
+
+            # Nếu không insert được (đã tim rồi) thì không cần cộng nữa
+            if cur.rowcount == 0:
+                return {"status": "already_reacted"}
+
+            # 2. Tăng reaction_count
+            await cur.execute(
+                """
+                UPDATE posts
+                SET reaction_count = reaction_count + 1
+                WHERE post_id = %s;
+                """,
+                (body.post_id,)
+            )
+            await user_stats.bump_post_owner(cur, body.post_id, reaction_received_count=1)
+
+            # 3. Update users_tags cho tất cả tag của post
+            await cur.execute(
+                """
+                INSERT INTO users_tags (user_id, tag_id, cnt)
+                SELECT %s AS user_id, pt.tag_id, 1
+                FROM post_tags pt
+                WHERE pt.post_id = %s
+                ON CONFLICT (user_id, tag_id)
+                DO UPDATE SET cnt = users_tags.cnt + 1;
+                """,
+                (body.user_id, body.post_id)
+            )
 
 class CheckReactionRequest(BaseModel):
     post_id: int
@@ -178,24 +191,20 @@ class HaveReaction(BaseModel):
     have_reaction: bool = True
 
 @router.post("/react/check")
-def check_react_post(body: CheckReactionRequest):
-    connection = get_database_connection()
-    try:
-        with connection:
-            with connection.cursor() as cur:
-                cur.execute(
-                    """
-                    SELECT * FROM reactions
-                    WHERE post_id = %s AND user_id = %s;
-                    """,
-                    (body.post_id, body.user_id)
-                )
-                status: HaveReaction = HaveReaction()
-                if (cur.rowcount == 0):
-                    status.have_reaction = False
-                return status
-    finally:
-        connection.close()
+async def check_react_post(body: CheckReactionRequest, connection = Depends(get_async_db)):
+    async with connection.transaction():
+        async with connection.cursor() as cur:
+            await cur.execute(
+                """
+                SELECT * FROM reactions
+                WHERE post_id = %s AND user_id = %s;
+                """,
+                (body.post_id, body.user_id)
+            )
+            status: HaveReaction = HaveReaction()
+            if (cur.rowcount == 0):
+                status.have_reaction = False
+            return status
 
 
 # ==================================================
@@ -207,58 +216,55 @@ class CancelReactionRequest(BaseModel):
     user_id: int
 
 @router.post("/react/cancel")
-def cancel_react_post(body: CancelReactionRequest):
-    connection = get_database_connection()
-    try:
-        with connection:
-            with connection.cursor() as cur:
-                # 1. Xóa reaction (nếu có)
-                cur.execute(
-                    """
-                    DELETE FROM reactions
-                    WHERE post_id = %s AND user_id = %s;
-                    """,
-                    (body.post_id, body.user_id)
-                )
-
-                # Nếu không xóa được dòng nào thì thôi, không làm gì thêm
-                if cur.rowcount == 0:
-                    return
-
-                # 2. Giảm reaction_count của post (nếu có cột này)
-                cur.execute(
-                    """
-                    UPDATE posts
-                    SET reaction_count = GREATEST(reaction_count - 1, 0)
-                    WHERE post_id = %s;
-                    """,
-                    (body.post_id,)
-                )
-
-                # 3. Giảm cnt trong users_tags cho các tag của post đó
-                #    (1 lần hủy tim => trừ 1 điểm cho mỗi tag)
-                cur.execute(
-                    """
-                    UPDATE users_tags ut
-                    SET cnt = GREATEST(ut.cnt - 1, 0)
-                    FROM post_tags pt
-                    WHERE ut.user_id = %s
-                      AND ut.tag_id = pt.tag_id
-                      AND pt.post_id = %s;
-                    """,
-                    (body.user_id, body.post_id)
-                )
-
-                # (optional) Nếu muốn xóa luôn những dòng cnt <= 0:
-                # cur.execute(
-                #     "DELETE FROM users_tags WHERE user_id = %s AND cnt <= 0;",
-                #     (body.user_id,)
-                # )
-
-        # tạm thời không trả về gì
-        return
-    finally:
-        connection.close()
+async def cancel_react_post(body: CancelReactionRequest, connection = Depends(get_async_db)):
+    async with connection.transaction():
+        async with connection.cursor() as cur:
+            # 1. Xóa reaction (nếu có)
+            await cur.execute(
+                """
+                DELETE FROM reactions
+                WHERE post_id = %s AND user_id = %s;
+                """,
+                (body.post_id, body.user_id)
+            )
+
+            # Nếu không xóa được dòng nào thì thôi, không làm gì thêm
+            if cur.rowcount == 0:
+                return
+
+            # 2. Giảm reaction_count của post (nếu có cột này)
+            await cur.execute(
+                """
+                UPDATE posts
+                SET reaction_count = GREATEST(reaction_count - 1, 0)
+                WHERE post_id = %s;
+                """,
+                (body.post_id,)
+            )
+            await user_stats.bump_post_owner(cur, body.post_id, reaction_received_count=-1)
+
+            # 3. Giảm cnt trong users_tags cho các tag của post đó
+            #    (1 lần hủy tim => trừ 1 điểm cho mỗi tag)
+            await cur.execute(
+                """
+                UPDATE users_tags ut
+                SET cnt = GREATEST(ut.cnt - 1, 0)
+                FROM post_tags pt
+                WHERE ut.user_id = %s
+                  AND ut.tag_id = pt.tag_id
+                  AND pt.post_id = %s;
+                """,
+                (body.user_id, body.post_id)
+            )
+
+            # (optional) Nếu muốn xóa luôn những dòng cnt <= 0:
+            # await cur.execute(
+            #     "DELETE FROM users_tags WHERE user_id = %s AND cnt <= 0;",
+            #     (body.user_id,)
+            # )
+
+    # tạm thời không trả về gì
+    return
 
 
 # ==================================================
@@ -269,75 +275,73 @@ class CancelCommentRequest(BaseModel):
     comment_id: int
     user_id: int
 @router.post("/comment/cancel")
-def cancel_comment(body: CancelCommentRequest):
-    connection = get_database_connection()
-    try:
-        with connection:
-            with connection.cursor() as cur:
-                # 1. Lấy post_id của comment để còn update posts + users_tags
-                cur.execute(
-                    """
-                    SELECT post_id
-                    FROM comments
-                    WHERE comment_id = %s AND user_id = %s;
-                    """,
-                    (body.comment_id, body.user_id)
-                )
-                row = cur.fetchone()
-
-                # Không tìm thấy comment (hoặc không thuộc user này) thì thôi
-                if row is None:
-                    return
-
-                post_id = row[0]
-
-                # 2. Xóa comment
-                cur.execute(
-                    """
-                    DELETE FROM comments
-                    WHERE comment_id = %s AND user_id = %s;
-                    """,
-                    (body.comment_id, body.user_id)
-                )
-
-                if cur.rowcount == 0:
-                    # Về lý thuyết không xảy ra vì vừa SELECT, nhưng cứ check cho chắc
-                    return
-
-                # 3. Giảm comment_count của post (nếu có cột này)
-                cur.execute(
-                    """
-                    UPDATE posts
-                    SET comment_count = GREATEST(comment_count - 1, 0)
-                    WHERE post_id = %s;
-                    """,
-                    (post_id,)
-                )
-
-                # 4. Giảm cnt trong users_tags cho các tag của post đó
-                #    (mỗi lần hủy 1 comment => trừ 1 điểm cho mỗi tag)
-                cur.execute(
-                    """
-                    UPDATE users_tags ut
-                    SET cnt = GREATEST(ut.cnt - 1, 0)
-                    FROM post_tags pt
-                    WHERE ut.user_id = %s
-                      AND ut.tag_id = pt.tag_id
-                      AND pt.post_id = %s;
-                    """,
-                    (body.user_id, post_id)
-                )
-
-                # (optional) Xóa dòng users_tags nếu cnt <= 0
-                # cur.execute(
-                #     "DELETE FROM users_tags WHERE user_id = %s AND cnt <= 0;",
-                #     (body.user_id,)
-                # )
-
-        # tạm thời không trả về gì
-        return
-    finally:
-        connection.close()
+async def cancel_comment(body: CancelCommentRequest, connection = Depends(get_async_db)):
+    async with connection.transaction():
+        async with connection.cursor() as cur:
+            # 1. Lấy post_id của comment để còn update posts + users_tags
+            await cur.execute(
+                """
+                SELECT post_id
+                FROM comments
+                WHERE comment_id = %s AND user_id = %s;
+                """,
+                (body.comment_id, body.user_id)
+            )
+            row = await cur.fetchone()
+
+            # Không tìm thấy comment (hoặc không thuộc user này) thì thôi
+            if row is None:
+                return
+
+            post_id = row["post_id"]
+
+            # 2. Xóa comment
+            await cur.execute(
+                """
+                DELETE FROM comments
+                WHERE comment_id = %s AND user_id = %s;
+                """,
+                (body.comment_id, body.user_id)
+            )
+
+            if cur.rowcount == 0:
+                # Về lý thuyết không xảy ra vì vừa SELECT, nhưng cứ check cho chắc
+                return
+
+            # 3. Giảm comment_count của post (nếu có cột này)
+            await cur.execute(
+                """
+                UPDATE posts
+                SET comment_count = GREATEST(comment_count - 1, 0)
+                WHERE post_id = %s;
+                """,
+                (post_id,)
+            )
+            await user_stats.bump(cur, body.user_id, comment_made_count=-1)
+            await user_stats.bump_post_owner(cur, post_id, comment_received_count=-1)
+
+            # 4. Giảm cnt trong users_tags cho các tag của post đó
+            #    (mỗi lần hủy 1 comment => trừ 1 điểm cho mỗi tag)
+            await cur.execute(
+                """
+                UPDATE users_tags ut
+                SET cnt = GREATEST(ut.cnt - 1, 0)
+                FROM post_tags pt
+                WHERE ut.user_id = %s
+                  AND ut.tag_id = pt.tag_id
+                  AND pt.post_id = %s;
+                """,
+                (body.user_id, post_id)
+            )
+
+            # (optional) Xóa dòng users_tags nếu cnt <= 0
+            # await cur.execute(
+            #     "DELETE FROM users_tags WHERE user_id = %s AND cnt <= 0;",
+            #     (body.user_id,)
+            # )
+
+    # tạm thời không trả về gì
+    return
 
 
 # ==================================================
@@ -348,27 +352,23 @@ class GetPostRequest(BaseModel):
     post_id: int
 
 @router.post("/get")
-def get_post(body: GetPostRequest):
-    connection = get_database_connection()
-    try:
-        # dùng RealDictCursor để trả về dạng dict -> FastAPI tự convert sang JSON đẹp
-        with connection.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute(
-                """
-                SELECT 
-                    p.*, 
-                    u.user_name,
-                    u.avatar_url
-                FROM posts p
-                JOIN users u ON u.user_id = p.user_id
-                WHERE p.post_id = %s;
-                """,
-                (body.post_id,)
-            )
-            row = cur.fetchone()
-            return row
-    finally:
-        connection.close()
+async def get_post(body: GetPostRequest, connection = Depends(get_async_db)):
+    # pool trả về dict_row -> FastAPI tự convert sang JSON đẹp
+    async with connection.cursor() as cur:
+        await cur.execute(
+            """
+            SELECT 
+                p.*, 
+                u.user_name,
+                u.avatar_url
+            FROM posts p
+            JOIN users u ON u.user_id = p.user_id
+            WHERE p.post_id = %s;
+            """,
+            (body.post_id,)
+        )
+        row = await cur.fetchone()
+        return row
 
 # ==================================================
 #       Lấy danh sách comment của 1 bài viết (JOIN users)
@@ -377,58 +377,121 @@ class GetPostCommentsRequest(BaseModel):
     post_id: int
 
 @router.post("/get/comments")
-def get_comments_of_post(body: GetPostCommentsRequest):
-    connection = get_database_connection()
-    try:
-        # dùng RealDictCursor để trả về dict thay vì tuple
-        with connection.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute(
-                """
-                SELECT 
-                    c.comment_id,
-                    c.post_id,
-                    c.user_id,
-                    c.content,
-                    c.created_at,
-                    c.child_of_comment_id,
-                    u.user_name,      
-                    u.avatar_url   
-                FROM comments c
-                JOIN users u ON u.user_id = c.user_id
-                WHERE c.post_id = %s
-                ORDER BY c.created_at ASC;
-                """,
-                (body.post_id,)
-            )
-            comments = cur.fetchall()
-            return comments
-    finally:
-        connection.close()
+async def get_comments_of_post(body: GetPostCommentsRequest, connection = Depends(get_async_db)):
+    # pool trả về dict_row thay vì tuple
+    async with connection.cursor() as cur:
+        await cur.execute(
+            """
+            SELECT 
+                c.comment_id,
+                c.post_id,
+                c.user_id,
+                c.content,
+                c.created_at,
+                c.child_of_comment_id,
+                u.user_name,      
+                u.avatar_url   
+            FROM comments c
+            JOIN users u ON u.user_id = c.user_id
+            WHERE c.post_id = %s
+            ORDER BY c.created_at ASC;
+            """,
+            (body.post_id,)
+        )
+        comments = await cur.fetchall()
+        return comments
 
 
 class GetPostTagsRequest(BaseModel):
     post_id: int
 
 @router.post("/get/tags")
-def get_post_tags(body: GetPostTagsRequest):
-    connection = get_database_connection()
-    try:
-        with connection.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute(
-                """
-                SELECT t.tag_id, t.name
-                FROM post_tags pt
-                JOIN tags t ON t.tag_id = pt.tag_id
-                WHERE pt.post_id = %s
-                ORDER BY t.name;
-                """,
-                (body.post_id,)
-            )
-            return cur.fetchall()
-    finally:
-        connection.close()
+async def get_post_tags(body: GetPostTagsRequest, connection = Depends(get_async_db)):
+    async with connection.cursor() as cur:
+        await cur.execute(
+            """
+            SELECT t.tag_id, t.name
+            FROM post_tags pt
+            JOIN tags t ON t.tag_id = pt.tag_id
+            WHERE pt.post_id = %s
+            ORDER BY t.name;
+            """,
+            (body.post_id,)
+        )
+        return await cur.fetchall()
 
 
+# ==================================================
+#       LẤY NHIỀU POST CÙNG LÚC (post + tác giả + tags + đã thả tim chưa)
+# ==================================================
+
+async def _attach_tags_and_reactions(cur, posts: list[dict], viewer_id: int) -> list[dict]:
+    """
+    Gắn "tags" và "has_reacted" (của viewer_id) cho danh sách bài viết
+    bằng 2 truy vấn theo tập post_id thay vì gọi /get/tags, /react/check cho từng bài.
+    """
+    if not posts:
+        return posts
+
+    post_ids = [post["post_id"] for post in posts]
+
+    await cur.execute(
+        """
+        SELECT pt.post_id, t.tag_id, t.name
+        FROM post_tags pt
+        JOIN tags t ON t.tag_id = pt.tag_id
+        WHERE pt.post_id = ANY(%s)
+        ORDER BY t.name;
+        """,
+        (post_ids,)
+    )
+    tags_by_post = {}
+    for row in await cur.fetchall():
+        tags_by_post.setdefault(row["post_id"], []).append(
+            {"tag_id": row["tag_id"], "name": row["name"]}
+        )
+
+    await cur.execute(
+        """
+        SELECT post_id
+        FROM reactions
+        WHERE user_id = %s AND post_id = ANY(%s);
+        """,
+        (viewer_id, post_ids)
+    )
+    reacted = {row["post_id"] for row in await cur.fetchall()}
+
+    for post in posts:
+        post["tags"] = tags_by_post.get(post["post_id"], [])
+        post["has_reacted"] = post["post_id"] in reacted
+    return posts
+
+
+class GetPostsBatchRequest(BaseModel):
+    post_ids: List[int] = Field(min_length=1, max_length=100)
+    user_id: int  # Người đang xem, dùng để tính has_reacted
+
+@router.post("/get/batch")
+async def get_posts_batch(body: GetPostsBatchRequest, connection = Depends(get_async_db)):
+    async with connection.cursor() as cur:
+        await cur.execute(
+            """
+            SELECT 
+                p.*, 
+                u.user_name,
+                u.avatar_url
+            FROM posts p
+            JOIN users u ON u.user_id = p.user_id
+            WHERE p.post_id = ANY(%s);
+            """,
+            (body.post_ids,)
+        )
+        rows = {row["post_id"]: row for row in await cur.fetchall()}
+
+        # Giữ đúng thứ tự post_ids gửi lên, bỏ qua post không tồn tại
+        posts = [rows[post_id] for post_id in dict.fromkeys(body.post_ids) if post_id in rows]
+        return await _attach_tags_and_reactions(cur, posts, body.user_id)
+
 
 # ==================================================
 #       LẤY NEWSFEED - Tổng hợp bài viết từ các pin của user
@@ -436,253 +499,293 @@ def get_post_tags(body: GetPostTagsRequest):
 
 class GetNewsfeedRequest(BaseModel):
     user_id: int
-    limit: int = 20  # Số bài viết tối đa mỗi lần load
-    offset: int = 0  # Để phân trang
+    limit: int = Field(default=20, ge=1, le=100)  # Số bài viết tối đa mỗi lần load
+    offset: int = Field(default=0, ge=0)  # Để phân trang (client cũ)
     tag_name: str | None = None  # Tên tag để lọc (optional)
+    cursor: str | None = None  # next_cursor của trang trước (keyset pagination)
+    use_cursor: bool = False  # True -> trả về NewsfeedPage thay vì list
 
-@router.post("/newsfeed")
-def get_newsfeed(body: GetNewsfeedRequest):
-    conn = get_database_connection()
+
+class NewsfeedPage(BaseModel):
+    posts: list[dict]
+    next_cursor: str | None = None  # None khi đã hết bài
+
+
+def _encode_cursor(created_at: datetime, post_id: int) -> str:
+    raw = json.dumps([created_at.isoformat(), post_id])
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def _decode_cursor(cursor: str) -> tuple[datetime, int]:
     try:
-        with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            # Nếu có tag_name, lọc theo tag
-            if body.tag_name:
-                cur.execute(
-                    """
-                    SELECT
-                        p.post_id,
-                        p.pin_id,
-                        p.title,
-                        p.body,
-                        p.image_url,
-                        p.user_id,
-                        p.status,
-                        p.created_at,
-                        p.reaction_count,
-                        p.comment_count,
-                        u.user_name,
-                        u.avatar_url
-                    FROM posts p
-                    JOIN users u ON u.user_id = p.user_id
-                    JOIN post_tags pt ON p.post_id = pt.post_id
-                    JOIN tags t ON pt.tag_id = t.tag_id
-                    WHERE p.pin_id IN (
-                        SELECT pin_id
-                        FROM user_pins
-                        WHERE user_id = %s
-                    )
-                    AND t.name = %s
-                    ORDER BY p.created_at DESC
-                    LIMIT %s OFFSET %s;
-                    """,
-                    (body.user_id, body.tag_name, body.limit, body.offset)
-                )
-            else:
-                # Không lọc tag, lấy tất cả
-                cur.execute(
-                    """
-                    SELECT
-                        p.post_id,
-                        p.pin_id,
-                        p.title,
-                        p.body,
-                        p.image_url,
-                        p.user_id,
-                        p.status,
-                        p.created_at,
-                        p.reaction_count,
-                        p.comment_count,
-                        u.user_name,
-                        u.avatar_url
-                    FROM posts p
-                    JOIN users u ON u.user_id = p.user_id
-                    WHERE p.pin_id IN (
-                        SELECT pin_id
-                        FROM user_pins
-                        WHERE user_id = %s
-                    )
-                    ORDER BY p.created_at DESC
-                    LIMIT %s OFFSET %s;
-                    """,
-                    (body.user_id, body.limit, body.offset)
-                )
-
-            posts = cur.fetchall()
-            return posts
-    finally:
-        conn.close()
+        created_at, post_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return datetime.fromisoformat(created_at), int(post_id)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="cursor không hợp lệ")
+
+
+@router.post("/newsfeed")
+async def get_newsfeed(body: GetNewsfeedRequest, conn = Depends(get_async_db)):
+    keyset = body.use_cursor or body.cursor is not None
+
+    # Lọc theo tag: tra tag_id trong từ điển tag cache sẵn thay vì JOIN bảng tags
+    tag_id = None
+    if body.tag_name:
+        async with conn.cursor() as cur:
+            tag_id = (await aget_tag_ids(cur, [body.tag_name])).get(body.tag_name)
+        if tag_id is None:
+            return NewsfeedPage(posts=[]) if keyset else []
+
+    # NEWSFEED_MODE=timeline: đọc timeline dựng sẵn thay vì tính lại từ user_pins
+    if timeline_enabled():
+        source = """
+        FROM user_timeline ut
+        JOIN posts p ON p.post_id = ut.post_id
+        """
+        sort_key = "ut.created_at, ut.post_id"
+        order_by = "ut.created_at DESC, ut.post_id DESC"
+    else:
+        source = "FROM posts p"
+        sort_key = "p.created_at, p.post_id"
+        order_by = "p.created_at DESC, p.post_id DESC"
+
+    query = f"""
+        SELECT
+            p.post_id,
+            p.pin_id,
+            p.title,
+            p.body,
+            p.image_url,
+            p.thumbnail_url,
+            p.user_id,
+            p.status,
+            p.created_at,
+            p.reaction_count,
+            p.comment_count,
+            u.user_name,
+            u.avatar_url
+        {source}
+        JOIN users u ON u.user_id = p.user_id
+    """
+    params = []
+
+    # Nếu có tag_name, lọc theo tag
+    if tag_id is not None:
+        query += """
+        JOIN post_tags pt ON p.post_id = pt.post_id
+        """
+
+    if timeline_enabled():
+        query += " WHERE ut.user_id = %s"
+    else:
+        query += """
+        WHERE p.pin_id IN (
+            SELECT pin_id
+            FROM user_pins
+            WHERE user_id = %s
+        )
+        """
+    params.append(body.user_id)
+
+    if tag_id is not None:
+        query += " AND pt.tag_id = %s"
+        params.append(tag_id)
+
+    # Keyset: chỉ lấy bài cũ hơn bài cuối của trang trước, không phải bỏ qua offset dòng
+    if body.cursor is not None:
+        query += f" AND ({sort_key}) < (%s, %s)"
+        params.extend(_decode_cursor(body.cursor))
+
+    query += f" ORDER BY {order_by} LIMIT %s"
+    if keyset:
+        # Lấy dư 1 dòng để biết còn trang sau hay không
+        params.append(body.limit + 1)
+    else:
+        query += " OFFSET %s"
+        params.extend([body.limit, body.offset])
+
+    async with conn.cursor() as cur:
+        await cur.execute(query, params)
+        posts = await cur.fetchall()
+
+        next_cursor = None
+        if keyset and posts and len(posts) > body.limit:
+            posts = posts[:body.limit]
+            last = posts[-1]
+            next_cursor = _encode_cursor(last["created_at"], last["post_id"])
+
+        # Mỗi dòng feed có sẵn tags + has_reacted, app không phải gọi thêm cho từng bài
+        await _attach_tags_and_reactions(cur, posts, body.user_id)
+
+    if not keyset:
+        return posts
+    return NewsfeedPage(posts=posts, next_cursor=next_cursor)
+
+
 class GetPreviewPinsRequest(BaseModel):
     user_id: int
 
 @router.post("/pinpreview")
-def get_preview_pins(body: GetPreviewPinsRequest):
-    conn = get_database_connection()
-    try:
-        with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute(
-                """
-                SELECT
-                    p.pin_id,
-                    MIN(p.image_url) as image_url,
-                    (SELECT COUNT(*) FROM posts p2 WHERE p2.pin_id = p.pin_id) as cnt
-                FROM posts p
-                JOIN users u ON u.user_id = p.user_id
-                WHERE u.user_id = %s
-                GROUP BY p.pin_id;
-                """,
-                (body.user_id,)
-            )
-            pins = cur.fetchall()
-            return pins
-    finally:
-        conn.close()
+async def get_preview_pins(body: GetPreviewPinsRequest, conn = Depends(get_async_db)):
+    async with conn.cursor() as cur:
+        await cur.execute(
+            """
+            SELECT
+                p.pin_id,
+                MIN(p.image_url) as image_url,
+                -- thumbnail của cùng bài với MIN(image_url), bài cũ chưa có thumbnail dùng ảnh gốc
+                (array_agg(COALESCE(p.thumbnail_url, p.image_url) ORDER BY p.image_url))[1] as thumbnail_url,
+                (SELECT COUNT(*) FROM posts p2 WHERE p2.pin_id = p.pin_id) as cnt
+            FROM posts p
+            JOIN users u ON u.user_id = p.user_id
+            WHERE u.user_id = %s
+            GROUP BY p.pin_id;
+            """,
+            (body.user_id,)
+        )
+        pins = await cur.fetchall()
+        return pins
 
 class GetPostByPinIdRequest(BaseModel):
     pin_id: int
 
 @router.post("/pinId")
-def get_preview_pins(body: GetPostByPinIdRequest):
-    conn = get_database_connection()
-    try:
-        with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute(
-                """
-                SELECT
-                    *
-                FROM posts p 
-                WHERE p.pin_id = %s;
-                """,
-                (body.pin_id,)
-            )
-            pins = cur.fetchall()
-            return pins
-    finally:
-        conn.close()
+async def get_preview_pins(body: GetPostByPinIdRequest, conn = Depends(get_async_db)):
+    async with conn.cursor() as cur:
+        await cur.execute(
+            """
+            SELECT
+                *
+            FROM posts p 
+            WHERE p.pin_id = %s;
+            """,
+            (body.pin_id,)
+        )
+        pins = await cur.fetchall()
+        return pins
         
 class GetPostByPinIdRequestFromMapScreen(BaseModel):
     pin_id: int
 
 @router.post("/pinId/mapScreen")
-def get_preview_pins(body: GetPostByPinIdRequestFromMapScreen):
-    conn = get_database_connection()
-    try:
-        with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute(
-                """
-                SELECT
-                    p.post_id,
-                    p.pin_id,
-                    p.title,
-                    p.body,
-                    p.image_url,
-                    p.user_id,
-                    p.status,
-                    p.created_at,
-                    p.reaction_count,
-                    p.comment_count,
-                    u.user_name,
-                    u.avatar_url
-                FROM posts p
-                JOIN users u ON u.user_id = p.user_id
-                WHERE p.pin_id IN (
-                    SELECT pin_id
-                    FROM user_pins
-                    WHERE pin_id = %s
-                )
-                ORDER BY p.created_at DESC
-                """,
-                (body.pin_id,) # CHỈ CẦN THÊM DẤU PHẨY NÀY LÀ XONG
+async def get_preview_pins(body: GetPostByPinIdRequestFromMapScreen, conn = Depends(get_async_db)):
+    async with conn.cursor() as cur:
+        await cur.execute(
+            """
+            SELECT
+                p.post_id,
+                p.pin_id,
+                p.title,
+                p.body,
+                p.image_url,
+                p.thumbnail_url,
+                p.user_id,
+                p.status,
+                p.created_at,
+                p.reaction_count,
+                p.comment_count,
+                u.user_name,
+                u.avatar_url
+            FROM posts p
+            JOIN users u ON u.user_id = p.user_id
+            WHERE p.pin_id IN (
+                SELECT pin_id
+                FROM user_pins
+                WHERE pin_id = %s
             )
-            posts = cur.fetchall()
-            return posts
-    finally:
-        conn.close()
-
-SUPABASE_URL = os.getenv("SUPABASE_URL")
-SUPABASE_KEY = os.getenv("SUPABASE_KEY")
-BUCKET_NAME = os.getenv("SUPABASE_BUCKET", "posts")
-
-if not SUPABASE_URL or not SUPABASE_KEY:
-    raise RuntimeError("SUPABASE_URL hoặc SUPABASE_KEY chưa được cấu hình trong .env")
-
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+            ORDER BY p.created_at DESC
+            """,
+            (body.pin_id,) # CHỈ CẦN THÊM DẤU PHẨY NÀY LÀ XONG
+        )
+        posts = await cur.fetchall()
+        return posts
 
-@router.post("/upload-image")
-async def upload_image(file: UploadFile = File(...)):
+@router.post("/upload-image", openapi_extra=uploads.FILE_UPLOAD_OPENAPI)
+async def upload_image(request: Request):
     """
-    Upload ảnh lên Supabase Storage và trả về 1 public URL duy nhất
+    Upload ảnh lên Supabase Storage, trả về URL bản full (url) và các bản nhỏ hơn (variants).
+    Body multipart được đọc dạng stream, vượt UPLOAD_MAX_BYTES là dừng ngay (xem uploads.py).
     """
-    print("DEBUG content_type:", file.content_type)
+    # 1. Đọc field 'file' (giới hạn dung lượng trong lúc đọc)
+    file = await uploads.read_file_field(request, "file")
 
-    # 1. Check loại file
+    # 2. Check loại file
     if not file.content_type or not file.content_type.startswith("image/"):
         raise HTTPException(
             status_code=400,
             detail=f"Chỉ chấp nhận file ảnh, content_type hiện tại: {file.content_type}",
         )
 
+    # 3. Lưu ảnh theo sha256 nội dung: ảnh đã có thì trả URL cũ, mới thì tạo bản nhỏ rồi upload
+    saved = await uploads.save_image(file)
 
-    # 2. Đọc nội dung file
-    contents = await file.read()
+    return {
+        "success": True,
+        **saved,  # url (image_url của bài), path, thumbnail_url (gửi kèm /posts/insert), variants
+    }
 
-    # 3. Giới hạn dung lượng 5MB
-    if len(contents) > 5 * 1024 * 1024:
+@router.post("/upload-image/analyze", openapi_extra=uploads.FILE_UPLOAD_OPENAPI)
+async def upload_image_analyze(request: Request, k: int = 3):
+    """
+    Gộp /sensitive/image + /tag/label_top3 + /posts/upload-image: client gửi ảnh 1 lần.
+    Kiểm duyệt, gắn nhãn và tạo bản nhỏ chạy song song; ảnh bị gắn cờ thì không ghi lên Storage.
+    Response: {"success", "is_sensitive", "tags", "url", "path", "thumbnail_url", "variants"}
+    """
+    file = await uploads.read_file_field(request, "file")
+    if not file.content_type or not file.content_type.startswith("image/"):
         raise HTTPException(
             status_code=400,
-            detail="File quá lớn (tối đa 5MB)",
+            detail=f"Chỉ chấp nhận file ảnh, content_type hiện tại: {file.content_type}",
         )
 
-    # 4. Tạo tên file unique trong bucket
-    ext = file.filename.split(".")[-1]
-    unique_name = f"{uuid.uuid4()}.{ext}"
-    file_path = f"posts/{unique_name}"  # folder 'posts/' trong bucket
-
-    # 5. Upload lên Supabase Storage
-    try:
-        result = supabase.storage.from_(BUCKET_NAME).upload(
-            path=file_path,
-            file=contents,
-            file_options={
-                "content-type": file.content_type,
-                "cache-control": "3600",
-                "upsert": "false",
-            },
-        )
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Upload thất bại: {e}")
+    moderation = asyncio.create_task(moderate_image_bytes(file.data, file.content_type))
+    labels = asyncio.create_task(top_labels(file.data, k))
 
-    # Nếu SDK trả về object có 'error'
-    if isinstance(result, dict) and result.get("error"):
-        raise HTTPException(status_code=500, detail=f"Upload thất bại: {result['error']}")
+    async def not_flagged() -> bool:
+        return not await moderation
 
-    # 6. Lấy public URL (bucket phải là public hoặc có policy cho phép)
-    public_url = supabase.storage.from_(BUCKET_NAME).get_public_url(file_path)
+    store_allowed = asyncio.create_task(not_flagged())
+    saving = asyncio.create_task(uploads.save_image(file, allow_store=store_allowed))
+    tasks = (moderation, labels, store_allowed, saving)
+    try:
+        if await moderation:
+            return {
+                "success": False,
+                "is_sensitive": True,
+                "tags": [],
+                "url": None,
+                "path": None,
+                "thumbnail_url": None,
+                "variants": None,
+            }
+        saved = await saving
+        # Gắn nhãn lỗi (Vision hết quota...) không chặn việc đăng ảnh
+        try:
+            tags = await labels
+        except HTTPException:
+            tags = []
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
 
-    return {
-        "success": True,
-        "url": public_url,   # URL duy nhất bạn cần
-        "path": file_path,   # nếu muốn lưu DB sau này
-    }
+    return {"success": True, "is_sensitive": False, "tags": tags, **saved}
 
 class GetPostByUserRequest(BaseModel):
     user_id:int
 
 
 @router.post("/postByUser")
-def getPostByUser(body: GetPostByUserRequest):
-    conn = get_database_connection()
-    try:
-        with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute(
-                """
-                SELECT
-                    *
-                FROM posts p
-                WHERE p.user_id = %s;
-                """,
-                (body.user_id,)
-            )
-            posts = cur.fetchall()
-            return posts
-    finally:
-        conn.close()
\ No newline at end of file
+async def getPostByUser(body: GetPostByUserRequest, conn = Depends(get_async_db)):
+    async with conn.cursor() as cur:
+        await cur.execute(
+            """
+            SELECT
+                *
+            FROM posts p
+            WHERE p.user_id = %s;
+            """,
+            (body.user_id,)
+        )
+        posts = await cur.fetchall()
+        return posts
\ No newline at end of file
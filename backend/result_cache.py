@@ -0,0 +1,204 @@
+"""
+Cache kết quả gọi API bên ngoài (Vision, moderation, translate...).
+
+Hai tầng:
+- LRUCache: trong bộ nhớ của worker, giới hạn số phần tử, TTL tùy chọn
+- SqliteCache: file SQLite trên đĩa (tùy chọn), dùng chung giữa các worker trên cùng máy,
+  giới hạn số dòng - vượt thì xóa các dòng lâu không dùng nhất
+
+TieredCache đọc bộ nhớ trước rồi tới đĩa (trúng đĩa thì nạp lại lên bộ nhớ), ghi cả hai.
+Giá trị phải serialize được bằng JSON. Số liệu hit/miss: GET /metrics/caches (main.py).
+"""
+import hashlib
+import json
+import sqlite3
+from collections import OrderedDict
+from os import getenv
+from threading import Lock
+from time import time
+
+from fastapi.concurrency import run_in_threadpool
+
+_MISSING = object()
+
+
+def sha256_key(*parts) -> str:
+    """Khóa cache từ các phần bytes/str (vd. nội dung ảnh, tham số): sha256 hex."""
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part if isinstance(part, bytes) else str(part).encode())
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class LRUCache:
+    def __init__(self, max_entries: int, ttl: float | None = None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._data: OrderedDict[str, tuple[object, float | None]] = OrderedDict()
+        self._lock = Lock()
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: str, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+            value, expires_at = entry
+            if expires_at is not None and expires_at <= time():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: str, value, ttl: float | None = None):
+        ttl = self.ttl if ttl is None else ttl
+        with self._lock:
+            self._data[key] = (value, time() + ttl if ttl is not None else None)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+
+class SqliteCache:
+    # Chỉ kiểm tra số dòng sau mỗi PRUNE_EVERY lần ghi để việc ghi luôn rẻ
+    PRUNE_EVERY = 100
+
+    def __init__(self, path: str, table: str, max_entries: int, ttl: float | None = None):
+        self.path = path
+        self.table = table
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.evictions = 0
+        self._writes = 0
+        self._lock = Lock()
+        self._connection = sqlite3.connect(path, timeout=5, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL;")
+            self._connection.execute(
+                f"""
+                CREATE TABLE IF NOT EXISTS {table} (
+                    key        TEXT PRIMARY KEY,
+                    value      TEXT NOT NULL,
+                    expires_at REAL,
+                    used_at    REAL NOT NULL
+                )
+                """
+            )
+            self._connection.execute(f"CREATE INDEX IF NOT EXISTS {table}_used_at_idx ON {table} (used_at);")
+
+    def get(self, key: str, default=None):
+        now = time()
+        with self._lock, self._connection:
+            row = self._connection.execute(
+                f"SELECT value, expires_at FROM {self.table} WHERE key = ?;", (key,)
+            ).fetchone()
+            if row is None:
+                return default
+            if row[1] is not None and row[1] <= now:
+                self._connection.execute(f"DELETE FROM {self.table} WHERE key = ?;", (key,))
+                return default
+            self._connection.execute(f"UPDATE {self.table} SET used_at = ? WHERE key = ?;", (now, key))
+        return json.loads(row[0])
+
+    def set(self, key: str, value, ttl: float | None = None):
+        ttl = self.ttl if ttl is None else ttl
+        now = time()
+        with self._lock, self._connection:
+            self._connection.execute(
+                f"INSERT OR REPLACE INTO {self.table} (key, value, expires_at, used_at) VALUES (?, ?, ?, ?);",
+                (key, json.dumps(value), now + ttl if ttl is not None else None, now)
+            )
+            self._writes += 1
+            if self._writes % self.PRUNE_EVERY == 0:
+                self._prune(now)
+
+    def _prune(self, now: float):
+        self._connection.execute(
+            f"DELETE FROM {self.table} WHERE expires_at IS NOT NULL AND expires_at <= ?;", (now,)
+        )
+        (count,) = self._connection.execute(f"SELECT COUNT(*) FROM {self.table};").fetchone()
+        if count > self.max_entries:
+            deleted = self._connection.execute(
+                f"""
+                DELETE FROM {self.table} WHERE key IN (
+                    SELECT key FROM {self.table} ORDER BY used_at LIMIT ?
+                );
+                """,
+                (count - self.max_entries,)
+            ).rowcount
+            self.evictions += deleted
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._connection.execute(f"SELECT COUNT(*) FROM {self.table};").fetchone()[0]
+
+
+class TieredCache:
+    def __init__(self, name: str, memory: LRUCache, disk: SqliteCache | None = None):
+        self.name = name
+        self.memory = memory
+        self.disk = disk
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        CACHES[name] = self
+
+    async def get(self, key: str, default=None):
+        value = self.memory.get(key, _MISSING)
+        if value is not _MISSING:
+            self.hits += 1
+            return value
+        if self.disk is not None:
+            value = await run_in_threadpool(self.disk.get, key, _MISSING)
+            if value is not _MISSING:
+                self.hits += 1
+                self.disk_hits += 1
+                self.memory.set(key, value)
+                return value
+        self.misses += 1
+        return default
+
+    async def set(self, key: str, value, ttl: float | None = None):
+        self.memory.set(key, value, ttl)
+        if self.disk is not None:
+            await run_in_threadpool(self.disk.set, key, value, ttl)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "memory_entries": len(self.memory),
+            "memory_evictions": self.memory.evictions,
+            "disk_evictions": self.disk.evictions if self.disk is not None else 0,
+        }
+
+
+# name -> cache có stats() (TieredCache, image_hash.HammingIndex...), để /metrics/caches liệt kê
+CACHES: dict[str, TieredCache] = {}
+
+
+def from_env(name: str, env_prefix: str, size: int = 1000, ttl: float | None = None) -> TieredCache:
+    """
+    Tạo TieredCache theo biến môi trường <env_prefix>_SIZE, _TTL (giây, 0 = không hết hạn),
+    _DISK_PATH (để trống = không dùng đĩa), _DISK_MAX.
+    """
+    size = int(getenv(f"{env_prefix}_SIZE", str(size)))
+    ttl = float(getenv(f"{env_prefix}_TTL", str(ttl or 0))) or None
+    disk_path = getenv(f"{env_prefix}_DISK_PATH", "")
+    disk = None
+    if disk_path:
+        disk_max = int(getenv(f"{env_prefix}_DISK_MAX", str(size * 100)))
+        disk = SqliteCache(disk_path, name, disk_max, ttl)
+    return TieredCache(name, LRUCache(size, ttl), disk)
+
+
+def cache_stats() -> dict:
+    return {name: cache.stats() for name, cache in CACHES.items()}
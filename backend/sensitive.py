@@ -1,9 +1,19 @@
 import os
+import asyncio
 import base64
-import requests
+import unicodedata
+import httpx
 from fastapi import APIRouter, HTTPException
-from pydantic import BaseModel
-from connection import get_openai_connection
+from fastapi.concurrency import run_in_threadpool
+from pydantic import BaseModel, Field
+from typing import List
+from connection import get_async_openai_connection
+import http_client
+import image_prep
+import result_cache
+from language import is_probably_english
+from blocklist import BLOCKLIST
+from image_hash import HammingIndex, dhash
 from fastapi import File, UploadFile
 
 router = APIRouter(
@@ -11,6 +21,34 @@ router = APIRouter(
     tags=["sensitive"]
 )
 
+MODERATION_MODEL = "omni-moderation-latest"
+TRANSLATE_ENDPOINT = "https://translation.googleapis.com/language/translate/v2"
+# Văn bản nhận diện được là tiếng Anh thì không dịch và kiểm tra lại lần 2
+SKIP_TRANSLATE_ENGLISH = os.getenv("SKIP_TRANSLATE_ENGLISH", "1") == "1"
+# 1 = kiểm tra bản gốc và (dịch -> kiểm tra) song song: nhanh hơn nhưng luôn tốn lượt dịch
+MODERATION_PARALLEL = os.getenv("MODERATION_PARALLEL", "0") == "1"
+# Số văn bản tối đa trong 1 lời gọi moderation / translate của /text/batch
+MODERATION_BATCH_SIZE = int(os.getenv("MODERATION_BATCH_SIZE", "32"))
+TRANSLATE_BATCH_SIZE = int(os.getenv("TRANSLATE_BATCH_SIZE", "128"))  # giới hạn của Translate v2
+
+# Kết quả cuối của /text (sau cả bước dịch) theo văn bản đã chuẩn hóa (MODERATION_CACHE_*)
+VERDICT_CACHE = result_cache.from_env("moderation_verdicts", "MODERATION_CACHE", size=10000, ttl=7 * 24 * 3600)
+# Bản dịch tiếng Anh theo văn bản đã chuẩn hóa (TRANSLATION_CACHE_*)
+TRANSLATION_CACHE = result_cache.from_env("translations", "TRANSLATION_CACHE", size=10000, ttl=30 * 24 * 3600)
+# Kết quả /image theo sha256 nội dung ảnh (IMAGE_VERDICT_CACHE_*)
+IMAGE_VERDICT_CACHE = result_cache.from_env("image_verdicts", "IMAGE_VERDICT_CACHE", size=10000, ttl=30 * 24 * 3600)
+# Ảnh gần giống (dHash lệch <= IMAGE_HASH_MAX_DISTANCE bit) dùng lại kết quả kiểm duyệt
+IMAGE_HASH_INDEX = HammingIndex(
+    max_entries=int(os.getenv("IMAGE_HASH_INDEX_SIZE", "100000")),
+    max_distance=int(os.getenv("IMAGE_HASH_MAX_DISTANCE", "5")),
+)
+result_cache.CACHES["image_dhash"] = IMAGE_HASH_INDEX
+
+
+def normalize_text(text: str) -> str:
+    """Chuẩn hóa để các câu chỉ khác khoảng trắng / hoa thường / dạng Unicode dùng chung cache."""
+    return unicodedata.normalize("NFC", " ".join(text.split())).casefold()
+
 class CheckSensitiveTextRequest(BaseModel):
     text: str
     
@@ -19,58 +57,178 @@ class SensitiveTextRespond(BaseModel):
     is_sensitive: bool
 
 @router.post("/text")
-def isSensitiveText(body: CheckSensitiveTextRequest):
+async def isSensitiveText(body: CheckSensitiveTextRequest):
     if (body.text == ""):
         return SensitiveTextRespond(is_sensitive=False)
-    connection = get_openai_connection()
-    try:
-        response = connection.moderations.create(
-            model="omni-moderation-latest",
-            input=body.text,
+
+    # Khớp danh sách từ cấm cục bộ -> chặn ngay, không gọi API
+    if BLOCKLIST.match(body.text):
+        return SensitiveTextRespond(is_sensitive=True)
+
+    cache_key = result_cache.sha256_key(MODERATION_MODEL, normalize_text(body.text))
+    cached = await VERDICT_CACHE.get(cache_key)
+    if cached is not None:
+        return SensitiveTextRespond(is_sensitive=cached)
+
+    is_sensitive = await _moderate_text(body.text)
+    await VERDICT_CACHE.set(cache_key, is_sensitive)
+    return SensitiveTextRespond(is_sensitive=is_sensitive)
+
+
+def _chunks(items: list, size: int) -> list[list]:
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+async def _is_flagged(connection, text: str) -> bool:
+    return (await _flagged_many(connection, [text]))[0]
+
+
+async def _flagged_many(connection, texts: list[str]) -> list[bool]:
+    """flagged cho từng văn bản, mỗi MODERATION_BATCH_SIZE văn bản 1 lời gọi (chạy song song)."""
+    async def moderate_chunk(chunk: list[str]) -> list[bool]:
+        response = await connection.moderations.create(
+            model=MODERATION_MODEL,
+            input=chunk if len(chunk) > 1 else chunk[0],
         )
-    except Exception as error:
-        raise HTTPException(status_code=500, detail=f"The error occurs when checking sensitive text: {error}")
-    result: SensitiveTextRespond = SensitiveTextRespond(is_sensitive = bool(response.results[0].flagged))
-    if (result.is_sensitive):
-        return result
+        return [bool(result.flagged) for result in response.results]
 
-    body.text = translate_to_english(body.text)
-    # print(body.text)
     try:
-        response = connection.moderations.create(
-            model="omni-moderation-latest",
-            input=body.text,
-        )
+        results = await asyncio.gather(*(moderate_chunk(chunk) for chunk in _chunks(texts, MODERATION_BATCH_SIZE)))
     except Exception as error:
         raise HTTPException(status_code=500, detail=f"The error occurs when checking sensitive text: {error}")
-    result = SensitiveTextRespond(is_sensitive = bool(response.results[0].flagged))
-    return result
+    return [flagged for chunk in results for flagged in chunk]
+
+
+async def _moderate_text(text: str) -> bool:
+    """Kiểm tra văn bản gốc, rồi bản dịch tiếng Anh (trừ khi văn bản đã là tiếng Anh)."""
+    connection = get_async_openai_connection()
+    if SKIP_TRANSLATE_ENGLISH and is_probably_english(text):
+        return await _is_flagged(connection, text)
+
+    async def translated_is_flagged() -> bool:
+        return await _is_flagged(connection, await translate_to_english(text))
+
+    if MODERATION_PARALLEL:
+        original, translated = await asyncio.gather(_is_flagged(connection, text), translated_is_flagged())
+        return original or translated
+
+    if await _is_flagged(connection, text):
+        return True
+    return await translated_is_flagged()
+
+# ==================================================
+#       KIỂM TRA NHIỀU VĂN BẢN CÙNG LÚC
+# ==================================================
+
+class CheckSensitiveTextBatchRequest(BaseModel):
+    texts: List[str] = Field(min_length=1, max_length=200)
+
+
+class SensitiveTextBatchRespond(BaseModel):
+    results: List[SensitiveTextRespond]  # Cùng thứ tự với texts
+
+
+@router.post("/text/batch", response_model=SensitiveTextBatchRespond)
+async def isSensitiveTextBatch(body: CheckSensitiveTextBatchRequest):
+    """
+    Như /text cho nhiều văn bản (tiêu đề, nội dung, comment...) trong 1 request:
+    văn bản trùng nhau / đã có trong cache không gọi API, phần còn lại được kiểm tra
+    theo lô (1 lời gọi moderation cho mỗi MODERATION_BATCH_SIZE văn bản, dịch cũng theo lô).
+    """
+    verdicts: dict[str, bool] = {}   # cache_key -> is_sensitive
+    pending: dict[str, str] = {}     # cache_key -> văn bản cần kiểm tra
+    keys: list[str | bool] = []    # cache_key, hoặc kết quả có ngay (rỗng / khớp từ cấm)
+    for text in body.texts:
+        if text == "":
+            keys.append(False)
+            continue
+        if BLOCKLIST.match(text):
+            keys.append(True)
+            continue
+        cache_key = result_cache.sha256_key(MODERATION_MODEL, normalize_text(text))
+        keys.append(cache_key)
+        if cache_key in verdicts or cache_key in pending:
+            continue
+        cached = await VERDICT_CACHE.get(cache_key)
+        if cached is not None:
+            verdicts[cache_key] = cached
+        else:
+            pending[cache_key] = text
+
+    if pending:
+        pending_keys = list(pending)
+        connection = get_async_openai_connection()
+
+        # 1. Kiểm tra văn bản gốc
+        flagged = await _flagged_many(connection, [pending[key] for key in pending_keys])
+        verdicts.update(zip(pending_keys, flagged))
+
+        # 2. Văn bản chưa bị gắn cờ và không phải tiếng Anh -> dịch rồi kiểm tra lại
+        recheck = [
+            key for key in pending_keys
+            if not verdicts[key] and not (SKIP_TRANSLATE_ENGLISH and is_probably_english(pending[key]))
+        ]
+        if recheck:
+            translated = await translate_many_to_english([pending[key] for key in recheck])
+            flagged = await _flagged_many(connection, translated)
+            verdicts.update(zip(recheck, flagged))
+
+        for key in pending_keys:
+            await VERDICT_CACHE.set(key, verdicts[key])
+
+    return SensitiveTextBatchRespond(results=[
+        SensitiveTextRespond(is_sensitive=verdicts[key] if isinstance(key, str) else key)
+        for key in keys
+    ])
 
-class SensitiveTextRespond(BaseModel):
-    is_sensitive: bool
 
 def encode_image_to_base64(file_bytes: bytes) -> str:
     return base64.b64encode(file_bytes).decode("utf-8")
 
 @router.post("/image", response_model=SensitiveTextRespond)
 async def moderate_image(file: UploadFile = File(...)):
-    
-    connection = get_openai_connection()
-    print(connection.api_key)
     try:
         file_bytes = await file.read()
-        base64_image = encode_image_to_base64(file_bytes)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Lỗi khi đọc hoặc mã hóa tệp: {e}")
 
+    is_flagged = await moderate_image_bytes(file_bytes, file.content_type)
+    result: SensitiveTextRespond = SensitiveTextRespond(is_sensitive = is_flagged)
+    return result
+
+
+async def moderate_image_bytes(file_bytes: bytes, content_type: str | None) -> bool:
+    """
+    Kiểm duyệt ảnh: ảnh trùng byte (sha256) hoặc gần giống (dHash) ảnh đã kiểm tra thì
+    dùng lại kết quả, chỉ ảnh mới thật sự mới gửi lên OpenAI.
+    """
+    cache_key = result_cache.sha256_key(MODERATION_MODEL, file_bytes)
+    cached = await IMAGE_VERDICT_CACHE.get(cache_key)
+    if cached is not None:
+        return cached
+
+    image_hash = await run_in_threadpool(dhash, file_bytes)
+    if image_hash is not None:
+        near = IMAGE_HASH_INDEX.find(image_hash)
+        if near is not None:
+            return near
+
+    # Gửi bản JPEG nhỏ, không metadata thay vì ảnh gốc (image_prep.py)
+    image_bytes, content_type = await image_prep.prepare(file_bytes, content_type, image_prep.MODERATION_IMAGE_MAX_SIDE)
+    try:
+        base64_image = encode_image_to_base64(image_bytes)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Lỗi khi đọc hoặc mã hóa tệp: {e}")
+
+    connection = get_async_openai_connection()
     try:
-        response = connection.moderations.create(
-            model="omni-moderation-latest",
+        response = await connection.moderations.create(
+            model=MODERATION_MODEL,
             input=[
                 {
                     "type": "image_url",
                     "image_url": {
-                        "url": f"data:{file.content_type};base64,{base64_image}"
+                        "url": f"data:{content_type};base64,{base64_image}"
                     },
                 }
             ],
@@ -79,17 +237,42 @@ async def moderate_image(file: UploadFile = File(...)):
         
     except Exception as error:
         raise HTTPException(status_code=500, detail=f"Lỗi khi kiểm tra hình ảnh: {error}")
-    
-    result: SensitiveTextRespond = SensitiveTextRespond(is_sensitive = is_flagged)
-    return result
 
-def translate_to_english(text: str) -> str:
-    URL = "https://translation.googleapis.com/language/translate/v2"
+    await IMAGE_VERDICT_CACHE.set(cache_key, is_flagged)
+    if image_hash is not None:
+        IMAGE_HASH_INDEX.add(image_hash, is_flagged)
+    return is_flagged
+
+async def translate_to_english(text: str) -> str:
+    return (await translate_many_to_english([text]))[0]
+
+
+async def translate_many_to_english(texts: list[str]) -> list[str]:
+    """Dịch sang tiếng Anh, bản dịch đã cache không gọi API, còn lại mỗi TRANSLATE_BATCH_SIZE văn bản 1 lời gọi."""
     API_KEY = os.environ["TRANSLATE_API_KEY"]
-    payload = {"q": text, "target": "en", "format": "text"}
-    try:
-        r = requests.post(URL, params={"key": API_KEY}, json=payload, timeout=10)
-        r.raise_for_status()
-        return r.json()["data"]["translations"][0]["translatedText"]
-    except requests.RequestException as e:
-        raise HTTPException(status_code=502, detail=f"Translate error: {e}")
\ No newline at end of file
+    cache_keys = [result_cache.sha256_key("en", normalize_text(text)) for text in texts]
+    translations: dict[str, str] = {}
+    missing: dict[str, str] = {}
+    for cache_key, text in zip(cache_keys, texts):
+        if cache_key in translations or cache_key in missing:
+            continue
+        cached = await TRANSLATION_CACHE.get(cache_key)
+        if cached is not None:
+            translations[cache_key] = cached
+        else:
+            missing[cache_key] = text
+
+    missing_keys = list(missing)
+    for chunk in _chunks(missing_keys, TRANSLATE_BATCH_SIZE):
+        payload = {"q": [missing[key] for key in chunk], "target": "en", "format": "text"}
+        try:
+            r = await http_client.post(TRANSLATE_ENDPOINT, params={"key": API_KEY}, json=payload, timeout=10)
+            r.raise_for_status()
+            translated = [item["translatedText"] for item in r.json()["data"]["translations"]]
+        except httpx.HTTPError as e:
+            raise HTTPException(status_code=502, detail=f"Translate error: {e}")
+        for cache_key, text in zip(chunk, translated):
+            translations[cache_key] = text
+            await TRANSLATION_CACHE.set(cache_key, text)
+
+    return [translations[cache_key] for cache_key in cache_keys]
@@ -1,10 +1,14 @@
 import os
 import base64
-import requests
-from fastapi import APIRouter, HTTPException, UploadFile, File
+import httpx
+from fastapi import APIRouter, Depends, HTTPException, UploadFile, File
 from pydantic import BaseModel
 from typing import List
-from connection import get_database_connection
+from cache import LOOKUP_TAGS_SQL, get_tag_ids, remember_tags
+from connection import get_db
+import http_client
+import image_prep
+import result_cache
 from pydantic import BaseModel, Field
 import psycopg2
 from fastapi import HTTPException
@@ -14,6 +18,11 @@ router = APIRouter(prefix="/tag", tags=["tag"])
 
 VISION_API_KEY = os.getenv("VISION_API_KEY")
 VISION_ENDPOINT = "https://vision.googleapis.com/v1/images:annotate"
+# Hạn chót cho cả lời gọi Vision kể cả thử lại (ảnh đã thu nhỏ về VISION_IMAGE_MAX_SIDE)
+VISION_TIMEOUT = float(os.getenv("VISION_TIMEOUT", "15"))
+
+# sha256(ảnh) + maxResults -> toàn bộ label đã sắp theo score (LABEL_CACHE_SIZE, LABEL_CACHE_DISK_PATH...)
+LABEL_CACHE = result_cache.from_env("vision_labels", "LABEL_CACHE", size=1000)
 
 
 class TagResponse(BaseModel):
@@ -27,24 +36,44 @@ async def label_top3(file: UploadFile = File(...), k: int = 3):
     form-data: file=<image>
     Response: {"tags": ["tag1","tag2","tag3"]}
     """
-    if not VISION_API_KEY:
-        raise HTTPException(status_code=500, detail="Missing env var VISION_API_KEY")
-
     data = await file.read()
     if not data:
         raise HTTPException(status_code=400, detail="Empty file")
 
+    return TagResponse(tags=await top_labels(data, k))
+
+
+async def top_labels(data: bytes, k: int) -> List[str]:
+    """k label có score cao nhất của ảnh (dùng chung cho /label_top3 và /posts/upload-image/analyze)."""
+    if not VISION_API_KEY:
+        raise HTTPException(status_code=500, detail="Missing env var VISION_API_KEY")
+
+    # Ảnh trùng nội dung (upload lại) -> trả luôn label đã có, không tốn quota Vision
+    max_results = max(10, k)
+    cache_key = result_cache.sha256_key(data, max_results)
+    labels_sorted = await LABEL_CACHE.get(cache_key)
+    if labels_sorted is None:
+        # Vision chỉ cần ~640px: gửi bản JPEG nhỏ, không metadata (image_prep.py)
+        image_bytes, _ = await image_prep.prepare(data, None, image_prep.VISION_IMAGE_MAX_SIDE)
+        labels_sorted = await _detect_labels(image_bytes, max_results)
+        await LABEL_CACHE.set(cache_key, labels_sorted)
+
+    return [x.get("description") for x in labels_sorted if x.get("description")][:k]
+
+
+async def _detect_labels(data: bytes, max_results: int) -> list[dict]:
+    """Gọi Vision LABEL_DETECTION, trả về labelAnnotations sắp theo score giảm dần."""
     content_b64 = base64.b64encode(data).decode("utf-8")
 
     payload = {
         "requests": [{
             "image": {"content": content_b64},
-            "features": [{"type": "LABEL_DETECTION", "maxResults": max(10, k)}],
+            "features": [{"type": "LABEL_DETECTION", "maxResults": max_results}],
         }]
     }
 
     try:
-        r = requests.post(f"{VISION_ENDPOINT}?key={VISION_API_KEY}", json=payload, timeout=60)
+        r = await http_client.post(VISION_ENDPOINT, params={"key": VISION_API_KEY}, json=payload, timeout=VISION_TIMEOUT)
         if r.status_code != 200:
             raise HTTPException(status_code=r.status_code, detail=r.text)
 
@@ -52,14 +81,11 @@ async def label_top3(file: UploadFile = File(...), k: int = 3):
         resp0 = (res.get("responses") or [{}])[0]
         labels = resp0.get("labelAnnotations") or []
 
-        labels_sorted = sorted(labels, key=lambda x: x.get("score", 0.0), reverse=True)
-        topk = [x.get("description") for x in labels_sorted if x.get("description")][:k]
+        return sorted(labels, key=lambda x: x.get("score", 0.0), reverse=True)
 
-        return TagResponse(tags=topk)
-
-    except requests.RequestException as e:
+    except httpx.HTTPError as e:
         raise HTTPException(status_code=502, detail=str(e))
-    
+
 
 class AssignTagsRequest(BaseModel):
     post_id: int
@@ -71,65 +97,99 @@ def _norm(t: str) -> str:
     return t.strip().lower()
 
 
-@router.post("/assign")
-def assign_tags(req: AssignTagsRequest):
-    tags = [_norm(t) for t in req.tags]
-    tags = [t for t in tags if t]
-    if not tags:
-        raise HTTPException(status_code=400, detail="tags empty")
-
-    # unique giữ thứ tự
-    seen = set()
+# Tạo các tag chưa có (sắp xếp theo tên để các request đồng thời khóa theo cùng thứ tự)
+INSERT_TAGS_SQL = """
+    INSERT INTO tags (name)
+    SELECT name FROM unnest(%s::text[]) AS t(name)
+    ORDER BY name
+    ON CONFLICT (name) DO NOTHING
+    RETURNING tag_id, name
+"""
+
+# Gắn tất cả tag vào post và tăng cnt users_tags trong 1 câu lệnh
+LINK_TAGS_SQL = """
+    WITH ids AS (
+        SELECT DISTINCT unnest(%(tag_ids)s::integer[]) AS tag_id
+    ),
+    linked AS (
+        INSERT INTO post_tags (post_id, tag_id)
+        SELECT %(post_id)s, tag_id FROM ids ORDER BY tag_id
+        ON CONFLICT (post_id, tag_id) DO NOTHING
+    )
+    INSERT INTO users_tags (user_id, tag_id, cnt)
+    SELECT %(user_id)s, tag_id, 1 FROM ids ORDER BY tag_id
+    ON CONFLICT (user_id, tag_id)
+    DO UPDATE SET cnt = users_tags.cnt + 1
+"""
+
+
+def normalize_tags(raw_tags: List[str]) -> List[str]:
+    """strip + lower, bỏ tag rỗng, bỏ trùng nhưng giữ thứ tự."""
     tags_unique = []
-    for t in tags:
-        if t not in seen:
+    seen = set()
+    for t in raw_tags:
+        t = _norm(t)
+        if t and t not in seen:
             seen.add(t)
             tags_unique.append(t)
+    return tags_unique
+
+
+def resolve_tag_ids(cur, names: List[str]) -> tuple[dict, dict]:
+    """
+    ({name: tag_id} cho mọi name, {name: tag_id} của tag vừa tạo).
+    Tag đã có lấy từ cache, tag mới tạo bằng 1 INSERT cho cả mảng.
+    """
+    tag_ids = get_tag_ids(cur, names)
+    missing = [name for name in names if name not in tag_ids]
+    if not missing:
+        return tag_ids, {}
+
+    cur.execute(INSERT_TAGS_SQL, (missing,))
+    created = {row["name"]: row["tag_id"] for row in cur.fetchall()}
+    tag_ids.update(created)
+
+    # Request khác vừa tạo cùng tên (ON CONFLICT bỏ qua) -> đọc lại id đã commit
+    raced = [name for name in missing if name not in created]
+    if raced:
+        cur.execute(LOOKUP_TAGS_SQL, (raced,))
+        tag_ids.update({row["name"]: row["tag_id"] for row in cur.fetchall()})
+    return tag_ids, created
+
+
+def assign_tag_names(cur, post_id: int, user_id: int, tags_unique: List[str]) -> dict:
+    """
+    Gắn tags_unique (đã chuẩn hóa) vào post, trả về {name: tag_id} của tag vừa tạo.
+    Tối đa 3 câu lệnh dù có bao nhiêu tag (1 nếu mọi tag đã có trong cache).
+    """
+    # (1) tags: lấy tag_id, tạo tag nếu chưa có
+    tag_ids, created = resolve_tag_ids(cur, tags_unique)
+
+    # (2) post_tags + (3) users_tags cho tất cả tag cùng lúc
+    cur.execute(
+        LINK_TAGS_SQL,
+        {
+            "post_id": post_id,
+            "user_id": user_id,
+            "tag_ids": [tag_ids[name] for name in tags_unique],
+        },
+    )
+    return created
+
+
+@router.post("/assign")
+def assign_tags(req: AssignTagsRequest, conn = Depends(get_db)):
+    tags_unique = normalize_tags(req.tags)
+    if not tags_unique:
+        raise HTTPException(status_code=400, detail="tags empty")
 
-    conn = get_database_connection()
     try:
         with conn:
             with conn.cursor() as cur:
-                for tag_name in tags_unique:
-                    # (1) tags: tạo tag nếu chưa có, rồi lấy tag_id
-                    cur.execute(
-                        """
-                        INSERT INTO tags(name)
-                        VALUES (%s)
-                        ON CONFLICT (name) DO NOTHING
-                        RETURNING tag_id
-                        """,
-                        (tag_name,),
-                    )
-                    row = cur.fetchone()
-                    if row is None:
-                        cur.execute("SELECT tag_id FROM tags WHERE name = %s", (tag_name,))
-                        row = cur.fetchone()
-
-                    tag_id = row["tag_id"] if isinstance(row, dict) else row[0]
-
-                    # (2) post_tags: gắn tag vào post (nếu chưa có)
-                    cur.execute(
-                        """
-                        INSERT INTO post_tags(post_id, tag_id)
-                        VALUES (%s, %s)
-                        ON CONFLICT (post_id, tag_id) DO NOTHING
-                        """,
-                        (req.post_id, tag_id),
-                    )
-
-                    # (3) users_tags: tăng cnt nếu đã có, chưa có thì tạo cnt=1
-                    cur.execute(
-                        """
-                        INSERT INTO users_tags(user_id, tag_id, cnt)
-                        VALUES (%s, %s, 1)
-                        ON CONFLICT (user_id, tag_id)
-                        DO UPDATE SET cnt = users_tags.cnt + 1
-                        """,
-                        (req.user_id, tag_id),
-                    )
+                created = assign_tag_names(cur, req.post_id, req.user_id, tags_unique)
 
     except psycopg2.Error as e:
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        conn.close()
+
+    # Chỉ đưa tag mới vào cache sau khi transaction đã commit
+    remember_tags(created)
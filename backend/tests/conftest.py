@@ -0,0 +1,10 @@
+import os
+import sys
+from pathlib import Path
+
+# connection.py / uploads.py đọc các biến này lúc import; test không gọi ra ngoài
+os.environ.setdefault("SUPABASE_URL", "https://test.supabase.co")
+os.environ.setdefault("SUPABASE_KEY", "eyJhbGciOiJIUzI1NiJ9.eyJyb2xlIjoiYW5vbiJ9.test")
+os.environ.setdefault("OPENAI_API_KEY", "test")
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
@@ -0,0 +1,93 @@
+import asyncio
+from time import monotonic
+
+import httpx
+import pytest
+
+import connection
+import http_client
+
+
+def _shared_client(handler) -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        timeout=http_client.DEFAULT_TIMEOUT,
+        transport=http_client.SharedTransport(httpx.MockTransport(handler)),
+    )
+
+
+@pytest.fixture
+def max_per_host(monkeypatch):
+    monkeypatch.setattr(http_client, "HTTP_MAX_PER_HOST", 3)
+    http_client._host_limits.clear()
+    yield 3
+    http_client._host_limits.clear()
+    monkeypatch.setattr(http_client, "_client", None)
+    monkeypatch.setattr(connection, "_async_openai", None)
+
+
+def test_concurrent_moderation_calls_are_capped_per_host(max_per_host, monkeypatch):
+    in_flight = peak = 0
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        nonlocal in_flight, peak
+        in_flight += 1
+        peak = max(peak, in_flight)
+        await asyncio.sleep(0.02)
+        in_flight -= 1
+        return httpx.Response(200, json={
+            "id": "modr-test",
+            "model": "omni-moderation-latest",
+            "results": [{"flagged": False, "categories": {}, "category_scores": {}}],
+        })
+
+    async def run():
+        monkeypatch.setattr(http_client, "_client", _shared_client(handler))
+        openai = connection.get_async_openai_connection()
+        await asyncio.gather(*(
+            openai.moderations.create(model="omni-moderation-latest", input="xin chào") for _ in range(12)
+        ))
+        await http_client.aclose()
+
+    asyncio.run(run())
+    assert peak == max_per_host
+
+
+def test_retries_share_one_deadline(max_per_host, monkeypatch):
+    attempts = 0
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        # Giả lập server treo: hết timeout của lần thử thì ReadTimeout
+        nonlocal attempts
+        attempts += 1
+        await asyncio.sleep(request.extensions["timeout"]["read"])
+        raise httpx.ReadTimeout("timeout", request=request)
+
+    async def run():
+        monkeypatch.setattr(http_client, "_client", _shared_client(handler))
+        monkeypatch.setattr(http_client, "HTTP_BACKOFF", 0.01)
+        started = monotonic()
+        with pytest.raises(httpx.ReadTimeout):
+            await http_client.post("https://vision.example/annotate", json={}, timeout=0.3, retries=5)
+        elapsed = monotonic() - started
+        await http_client.aclose()
+        return elapsed
+
+    elapsed = asyncio.run(run())
+    assert elapsed < 0.45
+    assert attempts >= 1
+
+
+def test_retries_on_server_error(max_per_host, monkeypatch):
+    statuses = iter([503, 503, 200])
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        return httpx.Response(next(statuses))
+
+    async def run():
+        monkeypatch.setattr(http_client, "_client", _shared_client(handler))
+        monkeypatch.setattr(http_client, "HTTP_BACKOFF", 0.01)
+        response = await http_client.post("https://translate.example/", json={}, retries=2)
+        await http_client.aclose()
+        return response.status_code
+
+    assert asyncio.run(run()) == 200
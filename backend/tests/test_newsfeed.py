@@ -0,0 +1,31 @@
+import pytest
+from pydantic import ValidationError
+
+from posts import GetNewsfeedRequest
+
+
+@pytest.mark.parametrize("limit", [0, -1, 101])
+def test_newsfeed_rejects_out_of_range_limit(limit):
+    with pytest.raises(ValidationError):
+        GetNewsfeedRequest(user_id=1, limit=limit, use_cursor=True)
+
+
+def test_newsfeed_accepts_limit_one():
+    assert GetNewsfeedRequest(user_id=1, limit=1, use_cursor=True).limit == 1
+
+
+def test_newsfeed_endpoint_returns_422_for_zero_limit():
+    from fastapi.testclient import TestClient
+
+    from connection import get_async_db
+    from main import app
+
+    async def no_db():
+        yield None
+
+    app.dependency_overrides[get_async_db] = no_db
+    try:
+        response = TestClient(app).post("/posts/newsfeed", json={"user_id": 1, "limit": 0, "use_cursor": True})
+    finally:
+        app.dependency_overrides.clear()
+    assert response.status_code == 422
@@ -0,0 +1,26 @@
+import pytest
+
+import pin_clusters
+from pin_clusters import ClusterHierarchy
+
+
+def test_cluster_centroid_across_antimeridian(monkeypatch):
+    # Bán kính lớn hơn 1 tile -> zoom 0 chỉ có 1 ô cho cả thế giới
+    monkeypatch.setattr(pin_clusters, "CLUSTER_RADIUS_PX", 512)
+    clusters = ClusterHierarchy(max_zoom=2)
+    clusters.add_pin(1, 10.0, 179.0)
+    clusters.add_pin(2, 12.0, -179.0)
+
+    [cluster] = clusters.query(-85, -180, 85, 180, zoom=0)
+    assert cluster["count"] == 2
+    assert cluster["latitude"] == pytest.approx(11.0)
+    assert abs(cluster["longitude"]) == pytest.approx(180.0)
+
+
+def test_cluster_centroid_single_pin():
+    clusters = ClusterHierarchy(max_zoom=2)
+    clusters.add_pin(1, 21.03, 105.85)
+
+    [cluster] = clusters.query(-85, -180, 85, 180, zoom=2)
+    assert cluster["latitude"] == pytest.approx(21.03)
+    assert cluster["longitude"] == pytest.approx(105.85)
@@ -0,0 +1,87 @@
+"""
+Timeline dựng sẵn cho newsfeed (fan-out-on-write).
+
+NEWSFEED_MODE=timeline: insert_post đẩy bài viết vào user_timeline của mọi user
+đã lưu pin đó, /posts/newsfeed đọc thẳng từ user_timeline.
+NEWSFEED_MODE=query (mặc định): giữ cách tính feed lúc đọc như cũ.
+
+Khi bật lần đầu (hoặc nghi timeline bị lệch), dựng lại bằng:
+    python timeline.py rebuild [--user-id N]
+"""
+import argparse
+from os import getenv
+
+from connection import get_database_connection
+
+NEWSFEED_MODE = getenv("NEWSFEED_MODE", "query")
+
+
+def timeline_enabled() -> bool:
+    return NEWSFEED_MODE == "timeline"
+
+
+# Đẩy 1 bài viết vào timeline của tất cả user đang lưu pin của bài
+FAN_OUT_POST_SQL = """
+    INSERT INTO user_timeline (user_id, post_id, created_at)
+    SELECT up.user_id, p.post_id, p.created_at
+    FROM posts p
+    JOIN user_pins up ON up.pin_id = p.pin_id
+    WHERE p.post_id = %s
+    ON CONFLICT (user_id, post_id) DO NOTHING;
+"""
+
+# User vừa lưu thêm 1 pin -> đưa các bài cũ của pin vào timeline của user
+ADD_PIN_TO_TIMELINE_SQL = """
+    INSERT INTO user_timeline (user_id, post_id, created_at)
+    SELECT %s, p.post_id, p.created_at
+    FROM posts p
+    WHERE p.pin_id = %s
+    ON CONFLICT (user_id, post_id) DO NOTHING;
+"""
+
+
+async def fan_out_post(cur, post_id: int):
+    await cur.execute(FAN_OUT_POST_SQL, (post_id,))
+
+
+async def add_pin_to_timeline(cur, user_id: int, pin_id: int):
+    await cur.execute(ADD_PIN_TO_TIMELINE_SQL, (user_id, pin_id))
+
+
+def rebuild(connection, user_id: int | None = None) -> int:
+    """Xóa và dựng lại timeline (toàn bộ hoặc 1 user) từ user_pins + posts."""
+    user_filter = "" if user_id is None else "WHERE up.user_id = %(user_id)s"
+    with connection:
+        with connection.cursor() as cur:
+            if user_id is None:
+                cur.execute("TRUNCATE user_timeline;")
+            else:
+                cur.execute("DELETE FROM user_timeline WHERE user_id = %(user_id)s;", {"user_id": user_id})
+
+            cur.execute(
+                f"""
+                INSERT INTO user_timeline (user_id, post_id, created_at)
+                SELECT up.user_id, p.post_id, p.created_at
+                FROM user_pins up
+                JOIN posts p ON p.pin_id = up.pin_id
+                {user_filter}
+                ON CONFLICT (user_id, post_id) DO NOTHING;
+                """,
+                {"user_id": user_id}
+            )
+            return cur.rowcount
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Quản lý bảng user_timeline")
+    sub = parser.add_subparsers(dest="command", required=True)
+    rebuild_parser = sub.add_parser("rebuild", help="Dựng lại timeline từ user_pins + posts")
+    rebuild_parser.add_argument("--user-id", type=int, default=None)
+    args = parser.parse_args()
+
+    connection = get_database_connection()
+    try:
+        inserted = rebuild(connection, args.user_id)
+        print(f"Đã dựng lại timeline: {inserted} dòng")
+    finally:
+        connection.close()
@@ -0,0 +1,337 @@
+"""
+Nhận và lưu ảnh upload cho /posts/upload-image.
+
+- read_file_field(): đọc body multipart theo từng chunk từ request.stream() và dừng ngay
+  khi phần file vượt UPLOAD_MAX_BYTES, không đọc hết / không ghi file tạm trước khi kiểm tra.
+- store(): SDK Supabase là đồng bộ nên upload chạy trong threadpool, tối đa
+  UPLOAD_CONCURRENCY upload cùng lúc mỗi worker, event loop không bị chặn khi truyền file.
+- save_image(): lưu ảnh theo sha256 nội dung (bảng image_objects, migration 008) - ảnh đã
+  lưu rồi thì trả lại URL cũ, không tạo bản nhỏ hay upload lại.
+
+Ảnh upload trước khi có image_objects: python uploads.py backfill (migration 009, chạy lại được)
+"""
+import argparse
+import asyncio
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from collections.abc import Awaitable
+from dataclasses import dataclass
+from os import getenv
+
+from fastapi import HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
+
+import image_variants
+from connection import get_async_database_pool, get_database_connection
+from python_multipart.exceptions import FormParserError
+from python_multipart.multipart import MultipartParser, parse_options_header
+from supabase import Client, create_client
+
+UPLOAD_MAX_BYTES = int(getenv("UPLOAD_MAX_BYTES", str(5 * 1024 * 1024)))
+UPLOAD_CONCURRENCY = int(getenv("UPLOAD_CONCURRENCY", "4"))
+# Phần header multipart + các field nhỏ được phép ngoài dung lượng file
+MULTIPART_OVERHEAD_BYTES = 64 * 1024
+
+SUPABASE_URL = getenv("SUPABASE_URL")
+SUPABASE_KEY = getenv("SUPABASE_KEY")
+BUCKET_NAME = getenv("SUPABASE_BUCKET", "posts")
+
+if not SUPABASE_URL or not SUPABASE_KEY:
+    raise RuntimeError("SUPABASE_URL hoặc SUPABASE_KEY chưa được cấu hình trong .env")
+
+supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+
+_upload_slots = asyncio.Semaphore(UPLOAD_CONCURRENCY)
+
+# Dùng cho openapi_extra của endpoint nhận file qua read_file_field()
+FILE_UPLOAD_OPENAPI = {
+    "requestBody": {
+        "required": True,
+        "content": {
+            "multipart/form-data": {
+                "schema": {
+                    "type": "object",
+                    "required": ["file"],
+                    "properties": {"file": {"type": "string", "format": "binary"}},
+                }
+            }
+        },
+    }
+}
+
+
+@dataclass
+class UploadedFile:
+    filename: str
+    content_type: str | None
+    data: bytes
+
+
+def _too_large() -> HTTPException:
+    return HTTPException(
+        status_code=400,
+        detail=f"File quá lớn (tối đa {UPLOAD_MAX_BYTES // (1024 * 1024)}MB)",
+    )
+
+
+class _FileFieldCollector:
+    """Callback cho MultipartParser: chỉ giữ dữ liệu của field file cần lấy."""
+
+    def __init__(self, field_name: str, max_bytes: int):
+        self.field_name = field_name
+        self.max_bytes = max_bytes
+        self.result: UploadedFile | None = None
+        self._headers: dict[bytes, bytes] = {}
+        self._header_name = b""
+        self._header_value = b""
+        self._collecting = False
+        self._filename = ""
+        self._content_type: str | None = None
+        self._data = bytearray()
+
+    def callbacks(self) -> dict:
+        return {
+            "on_part_begin": self.on_part_begin,
+            "on_part_data": self.on_part_data,
+            "on_part_end": self.on_part_end,
+            "on_header_field": self.on_header_field,
+            "on_header_value": self.on_header_value,
+            "on_header_end": self.on_header_end,
+            "on_headers_finished": self.on_headers_finished,
+        }
+
+    def on_part_begin(self):
+        self._headers = {}
+        self._collecting = False
+
+    def on_header_field(self, data: bytes, start: int, end: int):
+        self._header_name += data[start:end]
+
+    def on_header_value(self, data: bytes, start: int, end: int):
+        self._header_value += data[start:end]
+
+    def on_header_end(self):
+        self._headers[self._header_name.lower()] = self._header_value
+        self._header_name = b""
+        self._header_value = b""
+
+    def on_headers_finished(self):
+        _, options = parse_options_header(self._headers.get(b"content-disposition", b""))
+        name = options.get(b"name", b"").decode("utf-8", "replace")
+        if name == self.field_name and b"filename" in options and self.result is None:
+            self._collecting = True
+            self._filename = options[b"filename"].decode("utf-8", "replace")
+            content_type = self._headers.get(b"content-type")
+            self._content_type = content_type.decode("latin-1") if content_type else None
+
+    def on_part_data(self, data: bytes, start: int, end: int):
+        if not self._collecting:
+            return
+        if len(self._data) + (end - start) > self.max_bytes:
+            raise _too_large()
+        self._data += data[start:end]
+
+    def on_part_end(self):
+        if self._collecting:
+            self.result = UploadedFile(self._filename, self._content_type, bytes(self._data))
+            self._collecting = False
+
+
+async def read_file_field(request: Request, field_name: str = "file",
+                          max_bytes: int = UPLOAD_MAX_BYTES) -> UploadedFile:
+    """Đọc field file của request multipart/form-data, 400 ngay khi vượt max_bytes."""
+    content_type, params = parse_options_header(request.headers.get("content-type", ""))
+    if content_type != b"multipart/form-data" or b"boundary" not in params:
+        raise HTTPException(status_code=400, detail="Cần gửi multipart/form-data")
+
+    # Client báo trước Content-Length quá lớn -> từ chối trước khi đọc byte nào
+    content_length = request.headers.get("content-length", "")
+    if content_length.isdigit() and int(content_length) > max_bytes + MULTIPART_OVERHEAD_BYTES:
+        raise _too_large()
+
+    collector = _FileFieldCollector(field_name, max_bytes)
+    parser = MultipartParser(params[b"boundary"], collector.callbacks())
+    try:
+        async for chunk in request.stream():
+            parser.write(chunk)
+        parser.finalize()
+    except FormParserError as e:
+        raise HTTPException(status_code=400, detail=f"Body multipart không hợp lệ: {e}")
+
+    if collector.result is None:
+        raise HTTPException(status_code=400, detail=f"Thiếu file trong field '{field_name}'")
+    return collector.result
+
+
+async def store(path: str, data: bytes, content_type: str | None, upsert: bool = False) -> str:
+    """Upload lên Supabase Storage (ngoài event loop), trả về public URL."""
+    bucket = supabase.storage.from_(BUCKET_NAME)
+    async with _upload_slots:
+        try:
+            result = await run_in_threadpool(
+                bucket.upload,
+                path=path,
+                file=data,
+                file_options={
+                    "content-type": content_type,
+                    "cache-control": "3600",
+                    "upsert": "true" if upsert else "false",
+                },
+            )
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Upload thất bại: {e}")
+
+    # Nếu SDK trả về object có 'error'
+    if isinstance(result, dict) and result.get("error"):
+        raise HTTPException(status_code=500, detail=f"Upload thất bại: {result['error']}")
+
+    # Bucket phải là public hoặc có policy cho phép
+    return bucket.get_public_url(path)
+
+
+FIND_IMAGE_SQL = """
+    SELECT path, url, feed_url, thumbnail_url
+    FROM image_objects
+    WHERE sha256 = %s;
+"""
+
+INSERT_IMAGE_SQL = """
+    INSERT INTO image_objects (sha256, path, url, feed_url, thumbnail_url)
+    VALUES (%s, %s, %s, %s, %s)
+    ON CONFLICT (sha256) DO NOTHING;
+"""
+
+
+def _saved(row: dict) -> dict:
+    """Dòng image_objects -> phần response của /posts/upload-image."""
+    variants = None
+    if row["thumbnail_url"] is not None:
+        variants = {"full": row["url"], "feed": row["feed_url"], "thumbnail": row["thumbnail_url"]}
+    return {
+        "url": row["url"],
+        "path": row["path"],
+        "thumbnail_url": row["thumbnail_url"],
+        "variants": variants,
+    }
+
+
+async def save_image(file: UploadedFile, allow_store: Awaitable[bool] | None = None) -> dict | None:
+    """
+    Lưu ảnh (bản full / feed / thumbnail nếu đọc được), trả về url, path, thumbnail_url, variants.
+    Path lấy từ sha256 nội dung nên upload trùng nhau (kể cả chạy song song) ghi đè đúng file cũ.
+
+    allow_store: chờ ngay trước khi ghi lên Storage (vd. kết quả kiểm duyệt chạy song song),
+    False -> không ghi gì, trả về None.
+    """
+    digest = await run_in_threadpool(lambda: hashlib.sha256(file.data).hexdigest())
+    pool = get_async_database_pool()
+    async with pool.connection() as connection, connection.cursor() as cur:
+        await cur.execute(FIND_IMAGE_SQL, (digest,))
+        row = await cur.fetchone()
+    if row is not None:
+        return _saved(row)
+
+    # Tạo bản thumbnail / feed / full (process pool), đọc không được thì lưu ảnh gốc
+    variants = await image_variants.generate(file.data)
+    if allow_store is not None and not await allow_store:
+        return None
+    if variants is None:
+        ext = file.filename.split(".")[-1]
+        path = f"posts/{digest}.{ext}"
+        url = await store(path, file.data, file.content_type, upsert=True)
+        row = {"path": path, "url": url, "feed_url": None, "thumbnail_url": None}
+    else:
+        # Upload các bản song song: posts/<sha256>/<tên bản>.<ext>
+        paths = {name: f"posts/{digest}/{name}.{image_variants.EXTENSION}" for name in variants}
+        urls = await asyncio.gather(*(
+            store(paths[name], data, image_variants.CONTENT_TYPE, upsert=True)
+            for name, data in variants.items()
+        ))
+        urls = dict(zip(variants, urls))
+        row = {"path": paths["full"], "url": urls["full"], "feed_url": urls["feed"], "thumbnail_url": urls["thumbnail"]}
+
+    async with pool.connection() as connection, connection.cursor() as cur:
+        await cur.execute(
+            INSERT_IMAGE_SQL, (digest, row["path"], row["url"], row["feed_url"], row["thumbnail_url"])
+        )
+    return _saved(row)
+
+
+BACKFILL_DONE_SQL = """
+    SELECT path
+    FROM image_objects_backfill
+    WHERE path = ANY(%s) AND error IS NULL;
+"""
+
+BACKFILL_PROGRESS_SQL = """
+    INSERT INTO image_objects_backfill (path, sha256, error)
+    VALUES (%s, %s, %s)
+    ON CONFLICT (path) DO UPDATE
+    SET sha256 = EXCLUDED.sha256, error = EXCLUDED.error, scanned_at = now();
+"""
+
+
+def _list_pages(bucket, prefix: str, page_size: int):
+    """Từng trang file nằm ngay trong prefix (không đi vào thư mục con - đó là các bộ bản nhỏ)."""
+    offset = 0
+    while True:
+        items = bucket.list(prefix, {"limit": page_size, "offset": offset, "sortBy": {"column": "name", "order": "asc"}})
+        # thư mục không có id
+        yield [f"{prefix}/{item['name']}" for item in items if item.get("id") is not None]
+        if len(items) < page_size:
+            return
+        offset += page_size
+
+
+def backfill(connection, prefix: str = "posts", page_size: int = 100, workers: int = 8) -> tuple[int, int, int]:
+    """
+    Tải và băm các ảnh cũ trong bucket vào image_objects, trả về (số file đã đọc, số dòng
+    thêm mới, số file lỗi). Commit sau mỗi trang, tiến độ lưu ở image_objects_backfill nên
+    dừng giữa chừng thì chạy lại sẽ tiếp tục từ các file chưa xong.
+    """
+    bucket = supabase.storage.from_(BUCKET_NAME)
+
+    def digest(path: str) -> tuple[str, str | None, str | None]:
+        try:
+            return path, hashlib.sha256(bucket.download(path)).hexdigest(), None
+        except Exception as e:
+            return path, None, str(e) or type(e).__name__
+
+    scanned = inserted = failed = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for page in _list_pages(bucket, prefix, page_size):
+            with connection.cursor() as cur:
+                cur.execute(BACKFILL_DONE_SQL, (page,))
+                done = {row["path"] for row in cur.fetchall()}
+                for path, sha256, error in executor.map(digest, [p for p in page if p not in done]):
+                    scanned += 1
+                    cur.execute(BACKFILL_PROGRESS_SQL, (path, sha256, error))
+                    if error is not None:
+                        failed += 1
+                        print(f"[backfill] Lỗi {path}: {error}")
+                        continue
+                    # Nhiều file trùng nội dung -> giữ file đầu tiên
+                    cur.execute(INSERT_IMAGE_SQL, (sha256, path, bucket.get_public_url(path), None, None))
+                    inserted += cur.rowcount
+            connection.commit()
+    return scanned, inserted, failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Quản lý bảng image_objects")
+    sub = parser.add_subparsers(dest="command", required=True)
+    backfill_parser = sub.add_parser("backfill", help="Băm các ảnh đã có trong bucket vào image_objects")
+    backfill_parser.add_argument("--prefix", default="posts")
+    backfill_parser.add_argument("--page-size", type=int, default=100)
+    backfill_parser.add_argument("--workers", type=int, default=8, help="Số luồng tải ảnh song song")
+    args = parser.parse_args()
+
+    connection = get_database_connection()
+    try:
+        scanned, inserted, failed = backfill(connection, args.prefix, args.page_size, args.workers)
+        print(
+            f"Đã đọc {scanned} file, thêm {inserted} dòng image_objects "
+            f"({scanned - inserted - failed} trùng nội dung, {failed} lỗi - chạy lại để thử lại)"
+        )
+    finally:
+        connection.close()
@@ -0,0 +1,123 @@
+"""
+Bộ đếm hoạt động của user (bảng user_stats, migrations/004).
+
+Các API ghi gọi bump()/bump_post_owner() trong cùng transaction với thay đổi của chúng,
+các API đọc lấy số liệu từ user_stats thay vì chạy COUNT(*) mỗi lần.
+Mỗi lần bộ đếm tăng cũng là lúc xét cấp huy hiệu (badge_awards.py).
+
+Đối soát lại với dữ liệu gốc (lần đầu tạo bảng hoặc khi nghi lệch):
+    python user_stats.py reconcile [--user-id N]
+"""
+import argparse
+
+import badge_awards
+from connection import get_database_connection
+
+STAT_COLUMNS = (
+    "pin_count",
+    "post_count",
+    "reaction_received_count",
+    "comment_received_count",
+    "comment_made_count",
+    "pending_contact_count",
+    "friend_count",
+)
+
+# Số liệu hiển thị trên profile (login, /users/get), dùng với LEFT JOIN user_stats s
+PROFILE_STATS_COLUMNS = """
+    COALESCE(s.pin_count, 0) AS total_pin,
+    COALESCE(s.reaction_received_count, 0) AS total_reaction,
+    COALESCE(s.comment_received_count, 0) AS total_comment,
+    COALESCE(s.pending_contact_count, 0) AS total_contact
+"""
+
+# Số liệu dùng để xét huy hiệu (/badges/check, /badges/progress)
+BADGE_STATS_COLUMNS = """
+    COALESCE(s.post_count, 0) AS total_posts,
+    COALESCE(s.reaction_received_count, 0) AS total_reactions,
+    COALESCE(s.comment_made_count, 0) AS total_comments,
+    COALESCE(s.pin_count, 0) AS total_pins,
+    COALESCE(s.friend_count, 0) AS total_friends
+"""
+
+
+def _upsert_sql(columns, source: str) -> str:
+    for column in columns:
+        if column not in STAT_COLUMNS:
+            raise ValueError(f"Không có cột thống kê {column}")
+    return f"""
+        INSERT INTO user_stats (user_id, {", ".join(columns)})
+        SELECT src.user_id, {", ".join(f"GREATEST(%({c})s, 0)" for c in columns)}
+        FROM ({source}) src
+        ON CONFLICT (user_id) DO UPDATE SET
+            {", ".join(f"{c} = GREATEST(user_stats.{c} + %({c})s, 0)" for c in columns)}
+        RETURNING *;
+    """
+
+
+async def bump(cur, user_id: int, **deltas: int) -> dict | None:
+    """Cộng deltas (vd. post_count=1) vào user_stats của user_id, trả về dòng sau khi cập nhật."""
+    await cur.execute(_upsert_sql(deltas, "SELECT %(user_id)s::integer AS user_id"), {"user_id": user_id, **deltas})
+    row = await cur.fetchone()
+    await badge_awards.award_crossed(cur, row, deltas)
+    return row
+
+
+async def bump_post_owner(cur, post_id: int, **deltas: int) -> dict | None:
+    """Như bump() nhưng cho tác giả của post_id (tim/comment nhận được)."""
+    await cur.execute(
+        _upsert_sql(deltas, "SELECT user_id FROM posts WHERE post_id = %(post_id)s"),
+        {"post_id": post_id, **deltas}
+    )
+    row = await cur.fetchone()
+    await badge_awards.award_crossed(cur, row, deltas)
+    return row
+
+
+def reconcile(connection, user_id: int | None = None) -> int:
+    """Tính lại toàn bộ bộ đếm từ bảng gốc, trả về số user được thêm mới hoặc sửa lệch."""
+    user_filter = "" if user_id is None else "WHERE u.user_id = %(user_id)s"
+    with connection:
+        with connection.cursor() as cur:
+            cur.execute(
+                f"""
+                INSERT INTO user_stats (user_id, {", ".join(STAT_COLUMNS)})
+                SELECT
+                    u.user_id,
+                    (SELECT COUNT(*) FROM user_pins WHERE user_id = u.user_id),
+                    (SELECT COUNT(*) FROM posts WHERE user_id = u.user_id),
+                    (SELECT COUNT(*) FROM reactions r
+                     JOIN posts p ON r.post_id = p.post_id
+                     WHERE p.user_id = u.user_id),
+                    (SELECT COUNT(*) FROM comments c
+                     JOIN posts p ON c.post_id = p.post_id
+                     WHERE p.user_id = u.user_id),
+                    (SELECT COUNT(*) FROM comments WHERE user_id = u.user_id),
+                    (SELECT COUNT(*) FROM request_contact
+                     WHERE followed_user_id = u.user_id AND status = 'PENDING'),
+                    (SELECT COUNT(*) FROM friends WHERE user_id = u.user_id)
+                FROM users u
+                {user_filter}
+                ON CONFLICT (user_id) DO UPDATE SET
+                    {", ".join(f"{c} = EXCLUDED.{c}" for c in STAT_COLUMNS)}
+                WHERE ({", ".join(f"user_stats.{c}" for c in STAT_COLUMNS)})
+                    IS DISTINCT FROM ({", ".join(f"EXCLUDED.{c}" for c in STAT_COLUMNS)});
+                """,
+                {"user_id": user_id}
+            )
+            return cur.rowcount
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Quản lý bảng user_stats")
+    sub = parser.add_subparsers(dest="command", required=True)
+    reconcile_parser = sub.add_parser("reconcile", help="Tính lại bộ đếm từ dữ liệu gốc")
+    reconcile_parser.add_argument("--user-id", type=int, default=None)
+    args = parser.parse_args()
+
+    connection = get_database_connection()
+    try:
+        changed = reconcile(connection, args.user_id)
+        print(f"Đã đối soát user_stats: {changed} user được thêm mới/sửa lệch")
+    finally:
+        connection.close()
@@ -1,5 +1,7 @@
-from fastapi import APIRouter, HTTPException
-from connection import get_database_connection
+from fastapi import APIRouter, Depends, HTTPException
+from fastapi.concurrency import run_in_threadpool
+from connection import get_async_db
+import user_stats
 from pydantic import BaseModel
 
 import bcrypt
@@ -49,76 +51,40 @@ def verify_password(plain_password: str, hashed_password: str) -> bool:
 
 
 @router.post("/login", response_model=LoginResponse)
-def login(body: LoginRequest):
-    connection = get_database_connection()
-    try:
-        with connection.cursor() as cur:
-            cur.execute(
-                "SELECT * FROM users WHERE user_name = %s;",
-                (body.user_name,)
-            )
-            user = cur.fetchone()
-
-        if user is None:
-            return LoginResponse(
-                success=False,
-                user=None
-            )
-
-        if not verify_password(body.user_password, user["password"]):
-            return LoginResponse(
-                success=False,
-                user=None
-            )
-
-        user.pop("password", None)
-
-        user_id = user["user_id"]
-
-        with connection.cursor() as cur:
-            # Query tính toán số liệu
-            query_stats = """
-                SELECT 
-                    -- Đếm số pin người dùng đã lưu
-                    (SELECT COUNT(*) FROM user_pins WHERE user_id = %s) AS total_pin,
-                    
-                    -- Đếm tổng số reaction trên tất cả bài viết của người dùng
-                    (
-                        SELECT COUNT(*)
-                        FROM reactions r
-                        JOIN posts p ON r.post_id = p.post_id
-                        WHERE p.user_id = %s
-                    ) AS total_reaction,
-                    
-                    -- Đếm tổng số comment trên tất cả bài viết của người dùng
-                    (
-                        SELECT COUNT(*)
-                        FROM comments c
-                        JOIN posts p ON c.post_id = p.post_id
-                        WHERE p.user_id = %s
-                    ) AS total_comment,
-                    (
-                       SELECT COUNT(*) 
-                        FROM request_contact 
-                        WHERE followed_user_id = %s 
-                        AND status = 'PENDING'
-                    ) as total_contact;
-            """
+async def login(body: LoginRequest, connection = Depends(get_async_db)):
+    async with connection.cursor() as cur:
+        # Lấy luôn số liệu từ user_stats (được cập nhật khi ghi) thay vì COUNT(*) mỗi lần đăng nhập
+        await cur.execute(
+            f"""
+            SELECT u.*, {user_stats.PROFILE_STATS_COLUMNS}
+            FROM users u
+            LEFT JOIN user_stats s ON s.user_id = u.user_id
+            WHERE u.user_name = %s;
+            """,
+            (body.user_name,)
+        )
+        user = await cur.fetchone()
 
-            # Thực thi query, truyền user_id vào 3 vị trí %s
-            cur.execute(query_stats, (user_id, user_id, user_id, user_id))
-            stats = cur.fetchone()
+    if user is None:
+        return LoginResponse(
+            success=False,
+            user=None
+        )
 
-            # Nếu lấy được số liệu, cập nhật vào dictionary user
-            if stats:
-                user.update(stats)
+    # bcrypt tốn CPU -> chạy ngoài event loop
+    if not await run_in_threadpool(verify_password, body.user_password, user["password"]):
         return LoginResponse(
-            success=True,
-            user=user
+            success=False,
+            user=None
         )
 
-    finally:
-        connection.close()
+    user.pop("password", None)
+
+    return LoginResponse(
+        success=True,
+        user=user
+    )
+
 
 
 # ====================================
@@ -146,45 +112,41 @@ class RegisterSuccess(BaseModel):
 
 
 @router.post("/register")
-def register(body: RegisterRequest):
-    connection = get_database_connection()
-    try:
-        with connection.cursor() as cur:
+async def register(body: RegisterRequest, connection = Depends(get_async_db)):
+    async with connection.cursor() as cur:
 
-            # Check username exists
-            cur.execute(
-                "SELECT 1 FROM users WHERE user_name = %s;",
-                (body.user_name,)
-            )
-            if cur.fetchone():
-                return RegisterNameInvalid()
+        # Check username exists
+        await cur.execute(
+            "SELECT 1 FROM users WHERE user_name = %s;",
+            (body.user_name,)
+        )
+        if await cur.fetchone():
+            return RegisterNameInvalid()
 
-            # Check email exists
-            cur.execute(
-                "SELECT 1 FROM users WHERE user_email = %s;",
-                (body.user_email,)
-            )
-            if cur.fetchone():
-                return RegisterEmailInvalid()
+        # Check email exists
+        await cur.execute(
+            "SELECT 1 FROM users WHERE user_email = %s;",
+            (body.user_email,)
+        )
+        if await cur.fetchone():
+            return RegisterEmailInvalid()
 
-            # Hash password
-            hashed_pw = hash_password(body.user_password)
+        # Hash password
+        hashed_pw = await run_in_threadpool(hash_password, body.user_password)
 
-            # Insert new user
-            cur.execute(
-                """
-                INSERT INTO users (user_name, name, password, user_email, avatar_url)
-                VALUES (%s, %s, %s, %s, %s);
-                """,
-                (body.user_name, body.name, hashed_pw,
-                 body.user_email, body.avatar_url)
-            )
+        # Insert new user
+        await cur.execute(
+            """
+            INSERT INTO users (user_name, name, password, user_email, avatar_url)
+            VALUES (%s, %s, %s, %s, %s);
+            """,
+            (body.user_name, body.name, hashed_pw,
+             body.user_email, body.avatar_url)
+        )
 
-        connection.commit()
-        return RegisterSuccess()
+    await connection.commit()
+    return RegisterSuccess()
 
-    finally:
-        connection.close()
 
 # ==================================================
 #              THAY ĐỔI THÔNG TIN CÁ NHÂN
@@ -206,33 +168,29 @@ class UpdateUserByUserIdSuccess(BaseModel):
 
 
 @router.post("/update")
-def update(body: UpdateUserByUserIdRequest):
-    connection = get_database_connection()
-    try:
-        with connection.cursor() as cur:
+async def update(body: UpdateUserByUserIdRequest, connection = Depends(get_async_db)):
+    async with connection.cursor() as cur:
 
-            # Check username exists
-            cur.execute(
-                """
-                UPDATE users
-                SET
-                name=%s,
-                quotes = %s ,
-                avatar_url = %s,
-                location=%s,
-                user_email=%s,
-                website=%s
-                WHERE user_id = %s
-                """,
-                (body.name, body.quotes, body.avatar_url,
-                 body.location, body.email, body.website, body.user_id)
-            )
+        # Check username exists
+        await cur.execute(
+            """
+            UPDATE users
+            SET
+            name=%s,
+            quotes = %s ,
+            avatar_url = %s,
+            location=%s,
+            user_email=%s,
+            website=%s
+            WHERE user_id = %s
+            """,
+            (body.name, body.quotes, body.avatar_url,
+             body.location, body.email, body.website, body.user_id)
+        )
 
-        connection.commit()
-        return UpdateUserByUserIdSuccess()
+    await connection.commit()
+    return UpdateUserByUserIdSuccess()
 
-    finally:
-        connection.close()
 
 
 class GetUserByUserIdRequest(BaseModel):
@@ -245,76 +203,53 @@ class GetUserByUserIdInvalid(BaseModel):
 
 
 @router.post("/get")
-def get(body: GetUserByUserIdRequest):
-    connection = get_database_connection()
-    try:
-        # === BƯỚC 1: LẤY INFO USER ===
-        with connection.cursor() as cur:
-            cur.execute(
-                "SELECT * FROM users WHERE user_id = %s;",
-                (body.got_user_id,) # <--- SỬA: Phải dùng got_user_id
-            )
-            user = cur.fetchone()
-
-        if user is None:
-            return GetUserByUserIdInvalid()
-
-        user.pop("password", None)
-
-        # === BƯỚC 2: LẤY SỐ LIỆU (STATS) ===
-        with connection.cursor() as cur:
-            query_stats = """
-                SELECT 
-                    (SELECT COUNT(*) FROM user_pins WHERE user_id = %s) AS total_pin,
-                    
-                    (SELECT COUNT(*) FROM reactions r
-                     JOIN posts p ON r.post_id = p.post_id
-                     WHERE p.user_id = %s) AS total_reaction,
-                    
-                    (SELECT COUNT(*) FROM comments c
-                     JOIN posts p ON c.post_id = p.post_id
-                     WHERE p.user_id = %s) AS total_comment,
-                     
-                     -- Sửa: Nên đếm số bạn bè (Friends) thay vì đếm Request Pending
-                    (SELECT COUNT(*) FROM request_contact WHERE followed_user_id = %s AND status = 'PENDING') as total_contact
-            """
-            # <--- SỬA: Truyền body.got_user_id vào cả 4 vị trí
-            cur.execute(query_stats, (body.got_user_id, body.got_user_id, 
-                                      body.got_user_id, body.got_user_id))
-            quantity = cur.fetchone()
-            if quantity:
-                user.update(quantity)
-
-        # === BƯỚC 3: CHECK QUAN HỆ ===
-        with connection.cursor() as cur:
-            query_relation = """
-                SELECT 
-                    CASE 
-                        WHEN %s = %s THEN 'SELF'
-                        WHEN EXISTS (SELECT 1 FROM friends WHERE user_id = %s AND friend_id = %s) THEN 'FRIEND'
-                        WHEN EXISTS (SELECT 1 FROM request_contact WHERE following_user_id = %s AND followed_user_id = %s AND status = 'PENDING') THEN 'SENT_REQUEST'
-                        WHEN EXISTS (SELECT 1 FROM request_contact WHERE following_user_id = %s AND followed_user_id = %s AND status = 'PENDING') THEN 'INCOMING_REQUEST'
-                        ELSE 'STRANGER'
-                    END AS relationship_status;
-            """
-            # Tham số truyền vào phải đúng thứ tự logic CASE WHEN
-            params = (
-                body.current_user_id, body.got_user_id,      # SELF
-                body.current_user_id, body.got_user_id,      # FRIEND
-                body.current_user_id, body.got_user_id,      # SENT (Mình gửi)
-                body.got_user_id, body.current_user_id       # INCOMING (Họ gửi - lưu ý ngược lại)
-            )
-            
-            cur.execute(query_relation, params)
-            stats = cur.fetchone()
-
-            if stats:
-                user.update(stats) # Gộp kết quả 'relationship_status' vào user
+async def get(body: GetUserByUserIdRequest, connection = Depends(get_async_db)):
+    # === BƯỚC 1: LẤY INFO USER + SỐ LIỆU (STATS) ===
+    async with connection.cursor() as cur:
+        await cur.execute(
+            f"""
+            SELECT u.*, {user_stats.PROFILE_STATS_COLUMNS}
+            FROM users u
+            LEFT JOIN user_stats s ON s.user_id = u.user_id
+            WHERE u.user_id = %s;
+            """,
+            (body.got_user_id,) # <--- SỬA: Phải dùng got_user_id
+        )
+        user = await cur.fetchone()
+
+    if user is None:
+        return GetUserByUserIdInvalid()
+
+    user.pop("password", None)
+
+    # === BƯỚC 2: CHECK QUAN HỆ ===
+    async with connection.cursor() as cur:
+        query_relation = """
+            SELECT 
+                CASE 
+                    WHEN %s = %s THEN 'SELF'
+                    WHEN EXISTS (SELECT 1 FROM friends WHERE user_id = %s AND friend_id = %s) THEN 'FRIEND'
+                    WHEN EXISTS (SELECT 1 FROM request_contact WHERE following_user_id = %s AND followed_user_id = %s AND status = 'PENDING') THEN 'SENT_REQUEST'
+                    WHEN EXISTS (SELECT 1 FROM request_contact WHERE following_user_id = %s AND followed_user_id = %s AND status = 'PENDING') THEN 'INCOMING_REQUEST'
+                    ELSE 'STRANGER'
+                END AS relationship_status;
+        """
+        # Tham số truyền vào phải đúng thứ tự logic CASE WHEN
+        params = (
+            body.current_user_id, body.got_user_id,      # SELF
+            body.current_user_id, body.got_user_id,      # FRIEND
+            body.current_user_id, body.got_user_id,      # SENT (Mình gửi)
+            body.got_user_id, body.current_user_id       # INCOMING (Họ gửi - lưu ý ngược lại)
+        )
         
-        return user
+        await cur.execute(query_relation, params)
+        stats = await cur.fetchone()
+
+        if stats:
+            user.update(stats) # Gộp kết quả 'relationship_status' vào user
+    
+    return user
 
-    finally:
-        connection.close()
 
 
 class CheckIsFriend(BaseModel):
@@ -327,24 +262,20 @@ class IsFriendRespond(BaseModel):
 
 
 @router.post("/isfriend")
-def is_friend(body: CheckIsFriend):
-    connection = get_database_connection()
-    try:
-        with connection.cursor() as cur:
-            cur.execute(
-                """
-                    SELECT 1 FROM friends
-                    WHERE user_id = %s AND friend_id = %s;
-                """,
-                (body.own_id, body.other_id,)
-            )
-            status: IsFriendRespond = IsFriendRespond()
-            if (cur.rowcount == 0):
-                status.is_friend = False
-            return status
+async def is_friend(body: CheckIsFriend, connection = Depends(get_async_db)):
+    async with connection.cursor() as cur:
+        await cur.execute(
+            """
+                SELECT 1 FROM friends
+                WHERE user_id = %s AND friend_id = %s;
+            """,
+            (body.own_id, body.other_id,)
+        )
+        status: IsFriendRespond = IsFriendRespond()
+        if (cur.rowcount == 0):
+            status.is_friend = False
+        return status
 
-    finally:
-        connection.close()
 
 
 class showContactRequest(BaseModel):
@@ -352,32 +283,28 @@ class showContactRequest(BaseModel):
 
 
 @router.post("/contact_request")
-def showContactList(body: showContactRequest):
-    connection = get_database_connection()
-    try:
-        with connection.cursor() as cur:
-            cur.execute(
-                """
-                    SELECT 
-                    u.user_id, 
-                    u.user_name, 
-                    u.avatar_url,
-                    r.status, 
-                    r.created_at,
-                    r.message 
-                FROM request_contact r
-                JOIN users u ON r.following_user_id = u.user_id
-                WHERE r.followed_user_id = %s
-                AND r.status = 'PENDING'
-                ORDER BY r.created_at DESC;
-                    """,
-                (body.user_id,)
-            )
-            contacts = cur.fetchall()
-            return contacts
+async def showContactList(body: showContactRequest, connection = Depends(get_async_db)):
+    async with connection.cursor() as cur:
+        await cur.execute(
+            """
+                SELECT 
+                u.user_id, 
+                u.user_name, 
+                u.avatar_url,
+                r.status, 
+                r.created_at,
+                r.message 
+            FROM request_contact r
+            JOIN users u ON r.following_user_id = u.user_id
+            WHERE r.followed_user_id = %s
+            AND r.status = 'PENDING'
+            ORDER BY r.created_at DESC;
+                """,
+            (body.user_id,)
+        )
+        contacts = await cur.fetchall()
+        return contacts
 
-    finally:
-        connection.close()
 
 
 class RespondContactRequest(BaseModel):
@@ -391,15 +318,14 @@ class IsSuccessRespond(BaseModel):
 
 
 @router.post("/respond_contact")
-def respondContact(body: RespondContactRequest):
-    connection = get_database_connection()
+async def respondContact(body: RespondContactRequest, connection = Depends(get_async_db)):
     try:
-        with connection.cursor() as cur:
+        async with connection.cursor() as cur:
             new_status = 'CANCELED'
             if body.isAccept:
                 new_status = 'ACCEPTED'
 
-            cur.execute(
+            await cur.execute(
                 """
                 UPDATE request_contact
                 SET status = %s
@@ -415,26 +341,33 @@ def respondContact(body: RespondContactRequest):
                 )
             )
 
-            if cur.rowcount == 0:
+            # Chỉ trừ đúng số lời mời vừa được trả lời (đã trả lời rồi / id sai -> 0 dòng)
+            answered = cur.rowcount
+            if answered == 0:
                 return IsSuccessRespond(is_success=False)
 
+            await user_stats.bump(cur, body.own_id, pending_contact_count=-answered)
+
             if body.isAccept:
-                cur.execute(
+                # Đã là bạn từ trước thì không thêm dòng, không cộng friend_count
+                await cur.execute(
                     """
                 INSERT INTO friends (user_id, friend_id)
                 VALUES (%s, %s), (%s, %s)
+                ON CONFLICT DO NOTHING
+                RETURNING user_id
                 """,
                     (body.own_id, body.other_id, body.other_id, body.own_id,)
                 )
-            connection.commit()
+                for row in await cur.fetchall():
+                    await user_stats.bump(cur, row["user_id"], friend_count=1)
+            await connection.commit()
             return IsSuccessRespond(is_success=True)
 
     except Exception as e:
-        connection.rollback()
+        await connection.rollback()
         print(f"Error: {e}")
         return IsSuccessRespond(is_success=False)
-    finally:
-        connection.close()
 
 
 class SendContactRequestSchema(BaseModel):
@@ -448,46 +381,40 @@ class SendContactResult(BaseModel):
 
 
 @router.post("/send_contact")
-def sendContact(body: SendContactRequestSchema):
-    connection = get_database_connection()
-    try:
-        with connection.cursor() as cur:
-            cur.execute(
-                """
-                INSERT INTO request_contact 
-                (following_user_id, followed_user_id, message, status, created_at)
-                VALUES (%s, %s, %s, 'PENDING', NOW())
-                RETURNING request_id;
-                    """,
-                (body.following_user_id, body.followed_user_id, body.message)
-            )
-            if cur.rowcount == 0:
-                return SendContactResult(is_success=False)
-        connection.commit()
-        return SendContactResult(is_success=True)
-    finally:
-        connection.close()
+async def sendContact(body: SendContactRequestSchema, connection = Depends(get_async_db)):
+    async with connection.cursor() as cur:
+        await cur.execute(
+            """
+            INSERT INTO request_contact 
+            (following_user_id, followed_user_id, message, status, created_at)
+            VALUES (%s, %s, %s, 'PENDING', NOW())
+            RETURNING request_id;
+                """,
+            (body.following_user_id, body.followed_user_id, body.message)
+        )
+        if cur.rowcount == 0:
+            return SendContactResult(is_success=False)
+
+        await user_stats.bump(cur, body.followed_user_id, pending_contact_count=1)
+    await connection.commit()
+    return SendContactResult(is_success=True)
       
 class UserFavoriteTagsRequest(BaseModel):
     user_id: int
     number_tags: int
 
 @router.post("/tags")
-def get_favorite_tags_by_user_id(body: UserFavoriteTagsRequest):
-    connection = get_database_connection()
-    try:
-        with connection.cursor() as cur:
-            cur.execute(
-                """
-                SELECT ut.tag_id, t.name FROM users_tags AS ut
-                INNER JOIN tags AS t ON ut.tag_id = t.tag_id
-                WHERE user_id = %s
-                ORDER BY ut.cnt DESC
-                LIMIT %s;
-                """,
-                (body.user_id, body.number_tags)
-            )
-            tags = cur.fetchall()
-            return tags
-    finally:
-        connection.close()
+async def get_favorite_tags_by_user_id(body: UserFavoriteTagsRequest, connection = Depends(get_async_db)):
+    async with connection.cursor() as cur:
+        await cur.execute(
+            """
+            SELECT ut.tag_id, t.name FROM users_tags AS ut
+            INNER JOIN tags AS t ON ut.tag_id = t.tag_id
+            WHERE user_id = %s
+            ORDER BY ut.cnt DESC
+            LIMIT %s;
+            """,
+            (body.user_id, body.number_tags)
+        )
+        tags = await cur.fetchall()
+        return tags